@@ -0,0 +1,498 @@
+"""
+A local stand-in for a Rapid Pro workspace, serving the v2 API endpoints and archive downloads used by
+`RapidProClient` from deterministic synthetic data, so that the client can be load-tested without network access.
+
+The server supports cursor pagination, configurable per-request latency, and injected 429 (with `Retry-After`),
+500 and 504 responses. Archive downloads support HTTP Range requests, and can be made to drop part way through or to
+use download links which expire.
+"""
+import argparse
+import datetime
+import gzip
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs, urlencode
+
+import synthetic_data
+
+API_PREFIX = "/api/v2/"
+ARCHIVES_PREFIX = "/archives/"
+RANGE_PATTERN = re.compile(r"bytes=(\d+)-$")
+
+# Endpoints which `RapidProClient.export_all_data` reads but which the fake workspace has no data for.
+EMPTY_ENDPOINTS = {
+    "boundaries", "campaigns", "campaign_events", "channels", "channel_events", "classifiers", "flow_starts",
+    "globals", "labels", "resthooks", "resthook_events", "resthook_subscribers"
+}
+
+
+def _parse_iso8601(s):
+    return datetime.datetime.strptime(s, "%Y-%m-%dT%H:%M:%S.%fZ").replace(tzinfo=datetime.timezone.utc)
+
+
+class FakeWorkspaceConfig(object):
+    def __init__(self, run_count=10000, message_count=10000, contact_count=1000, archived_fraction=0.5,
+                 page_size=250, latency_seconds=0.0, rate_limit_probability=0.0, retry_after_seconds=1,
+                 error_500_probability=0.0, error_504_probability=0.0, error_methods=("POST",),
+                 archive_drop_probability=0.0, archive_link_ttl_seconds=None, broadcast_send_seconds=0.0, seed=0):
+        """
+        :param run_count: Number of runs in the workspace.
+        :type run_count: int
+        :param message_count: Number of messages in the workspace.
+        :type message_count: int
+        :param contact_count: Number of contacts in the workspace.
+        :type contact_count: int
+        :param archived_fraction: Fraction of the oldest runs and messages to serve from daily archives rather than
+                                  from the runs and messages endpoints.
+        :type archived_fraction: float
+        :param page_size: Maximum number of results in each page of a paginated response.
+        :type page_size: int
+        :param latency_seconds: Number of seconds to wait before responding to each request.
+        :type latency_seconds: float
+        :param rate_limit_probability: Probability of responding to a request with 429 Too Many Requests.
+        :type rate_limit_probability: float
+        :param retry_after_seconds: Value of the Retry-After header sent with 429 responses. Must be at least 1,
+                                    because Rapid Pro's python client does not retry 429s with a Retry-After of 0.
+        :type retry_after_seconds: int
+        :param error_500_probability: Probability of responding to a request with 500 Internal Server Error.
+        :type error_500_probability: float
+        :param error_504_probability: Probability of responding to a request with 504 Gateway Timeout.
+        :type error_504_probability: float
+        :param error_methods: HTTP methods that 500 and 504 errors may be injected into. Defaults to POST only,
+                              because Rapid Pro's python client does not retry failed GETs. These errors are never
+                              injected into POSTs to broadcasts, which RapidProClient doesn't retry because a real
+                              server may have sent the broadcast anyway.
+        :type error_methods: iterable of str
+        :param archive_drop_probability: Probability of closing the connection part way through sending an archive.
+        :type archive_drop_probability: float
+        :param archive_link_ttl_seconds: Number of seconds each archive download link is valid for after the archive is
+                                         listed. Downloads from expired links are rejected with 403 Forbidden.
+                                         If None, links never expire.
+        :type archive_link_ttl_seconds: float | None
+        :param broadcast_send_seconds: Number of seconds after a broadcast is created that it is reported as 'sent'
+                                       rather than 'queued'.
+        :type broadcast_send_seconds: float
+        :param seed: Seed for generating the workspace's data and for deciding which requests to fail.
+        :type seed: int
+        """
+        self.run_count = run_count
+        self.message_count = message_count
+        self.contact_count = contact_count
+        self.archived_fraction = archived_fraction
+        self.page_size = page_size
+        self.latency_seconds = latency_seconds
+        self.rate_limit_probability = rate_limit_probability
+        self.retry_after_seconds = retry_after_seconds
+        self.error_500_probability = error_500_probability
+        self.error_504_probability = error_504_probability
+        self.error_methods = set(error_methods)
+        self.archive_drop_probability = archive_drop_probability
+        self.archive_link_ttl_seconds = archive_link_ttl_seconds
+        self.broadcast_send_seconds = broadcast_send_seconds
+        self.seed = seed
+
+
+class FakeWorkspace(object):
+    def __init__(self, config):
+        """
+        The data served by a `FakeRapidProServer`.
+
+        :param config: Configuration of the workspace.
+        :type config: FakeWorkspaceConfig
+        """
+        assert config.retry_after_seconds >= 1, "retry_after_seconds must be at least 1"
+
+        self.config = config
+        self.lock = threading.Lock()
+
+        self.org = {
+            "uuid": "00000000-0000-0000-0000-000000000000", "name": "Fake Workspace", "country": "SO",
+            "languages": ["eng"], "primary_language": "eng", "timezone": "UTC", "date_style": "day_first",
+            "credits": {"used": 0, "remaining": 1000000}, "anon": False
+        }
+        self.contacts = list(synthetic_data.generate_contacts(config.contact_count, config.seed))
+        self.contacts.sort(key=lambda c: c["modified_on"], reverse=True)
+
+        # Runs and messages are listed by Rapid Pro in descending order of modification/creation date.
+        runs = list(synthetic_data.generate_runs(config.run_count, config.contact_count, duplicate_fraction=0,
+                                                 seed=config.seed))
+        runs.sort(key=lambda r: r["modified_on"])
+        messages = list(synthetic_data.generate_messages(config.message_count, config.contact_count, config.seed))
+
+        self.archives = dict()  # of archive file name -> gzipped JSONL bytes
+        self.archive_metadata = []
+        self.runs = self._archive_oldest(runs, "run", "modified_on")
+        self.messages = self._archive_oldest(messages, "message", "created_on")
+        self.runs.reverse()
+        self.messages.reverse()
+
+        flows = {r["flow"]["uuid"]: r["flow"] for r in runs}
+        self.flows = [
+            {"uuid": flow["uuid"], "name": flow["name"], "type": "message", "archived": False, "labels": [],
+             "expires": 10080, "runs": {"active": 0, "completed": 0, "interrupted": 0, "expired": 0},
+             "results": [], "parent_refs": [], "created_on": synthetic_data.format_iso8601(synthetic_data.EPOCH)}
+            for flow in flows.values()
+        ]
+        self.fields = [{"key": "age", "label": "Age", "value_type": "text"},
+                       {"key": "gender", "label": "Gender", "value_type": "text"}]
+        self.groups = []
+        self.broadcasts = []
+        self.broadcast_sent_times = []  # of time each broadcast in `broadcasts` is reported as sent from
+
+    def _archive_oldest(self, records, archive_type, date_key):
+        """
+        Moves the oldest `config.archived_fraction` of the given records, rounded down to a whole day, into daily
+        archives.
+
+        :return: The records which were not archived.
+        :rtype: list of dict
+        """
+        archive_count = int(len(records) * self.config.archived_fraction)
+        if archive_count == 0:
+            return records
+        cutoff = _parse_iso8601(records[archive_count][date_key])
+        cutoff = cutoff.replace(hour=0, minute=0, second=0, microsecond=0)
+
+        archived_by_day = dict()
+        unarchived = []
+        for record in records:
+            record_date = _parse_iso8601(record[date_key])
+            if record_date < cutoff:
+                day = record_date.replace(hour=0, minute=0, second=0, microsecond=0)
+                archived_by_day.setdefault(day, []).append(record)
+            else:
+                unarchived.append(record)
+
+        for day, day_records in sorted(archived_by_day.items()):
+            file_name = f"{archive_type}_{day.strftime('%Y-%m-%d')}.jsonl.gz"
+            body = gzip.compress("".join(json.dumps(r) + "\n" for r in day_records).encode("utf-8"))
+            self.archives[file_name] = body
+            self.archive_metadata.append({
+                "archive_type": archive_type, "start_date": synthetic_data.format_iso8601(day), "period": "daily",
+                "record_count": len(day_records), "size": len(body), "hash": hashlib.md5(body).hexdigest(),
+                "download_url": ARCHIVES_PREFIX + file_name
+            })
+
+        return unarchived
+
+
+class _FakeRapidProRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        # Don't log every request to stderr.
+        pass
+
+    @property
+    def workspace(self):
+        return self.server.workspace
+
+    def _send_json(self, status, body=None, headers=None):
+        content = b"" if body is None else json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        for key, value in (headers or dict()).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _inject_failure(self, method, allow_server_errors=True):
+        """
+        Sleeps for the configured latency, then decides whether to fail this request.
+
+        :param method: HTTP method of this request.
+        :type method: str
+        :param allow_server_errors: Whether this request may be failed with a 500 or 504 error, as well as rate limited.
+        :type allow_server_errors: bool
+        :return: Whether a failure response was sent.
+        :rtype: bool
+        """
+        config = self.workspace.config
+        if config.latency_seconds > 0:
+            time.sleep(config.latency_seconds)
+
+        with self.server.rng_lock:
+            roll = self.server.rng.random()
+
+        if roll < config.rate_limit_probability:
+            self.server.count("429")
+            self._send_json(429, {"detail": "Request was throttled."},
+                            {"Retry-After": str(config.retry_after_seconds)})
+            return True
+        roll -= config.rate_limit_probability
+
+        if method in config.error_methods and allow_server_errors:
+            if roll < config.error_500_probability:
+                self.server.count("500")
+                self._send_json(500, {"detail": "Injected server error"})
+                return True
+            roll -= config.error_500_probability
+            if roll < config.error_504_probability:
+                self.server.count("504")
+                self._send_json(504, {"detail": "Injected gateway timeout"})
+                return True
+
+        return False
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length)) if length > 0 else dict()
+
+    def _paginate(self, url, query, results):
+        offset = int(query.get("cursor", ["0"])[0])
+        page_size = self.workspace.config.page_size
+        page = results[offset:offset + page_size]
+
+        next_url = None
+        if offset + page_size < len(results):
+            next_query = {k: v[0] for k, v in query.items()}
+            next_query["cursor"] = str(offset + page_size)
+            next_url = f"http://{self.headers['Host']}{url.path}?{urlencode(next_query)}"
+
+        self._send_json(200, {"next": next_url, "previous": None, "results": page})
+
+    @staticmethod
+    def _filter_dates(records, query, date_key):
+        # Records' dates are all formatted by `synthetic_data.format_iso8601`, so once the query's dates are
+        # normalised to the same format they can be compared as strings, which is much faster than parsing every date.
+        after = query.get("after", [None])[0]
+        before = query.get("before", [None])[0]
+        if after is not None:
+            after = synthetic_data.format_iso8601(_parse_iso8601(after))
+            records = [r for r in records if r[date_key] >= after]
+        if before is not None:
+            before = synthetic_data.format_iso8601(_parse_iso8601(before))
+            records = [r for r in records if r[date_key] <= before]
+        return records
+
+    def _send_archive(self, url, query):
+        body = self.workspace.archives.get(url.path[len(ARCHIVES_PREFIX):])
+        if body is None:
+            self._send_json(404, {"detail": "Not found."})
+            return
+
+        if "expires" in query and float(query["expires"][0]) < time.time():
+            self.server.count("archive_expired")
+            self._send_json(403, {"detail": "Request has expired"})
+            return
+
+        start = 0
+        range_match = RANGE_PATTERN.match(self.headers.get("Range", ""))
+        if range_match is not None:
+            start = int(range_match.group(1))
+            if start >= len(body):
+                self._send_json(416, {"detail": "Requested range not satisfiable"})
+                return
+        content = body[start:]
+
+        self.send_response(200 if range_match is None else 206)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(content)))
+        if range_match is not None:
+            self.send_header("Content-Range", f"bytes {start}-{len(body) - 1}/{len(body)}")
+        self.end_headers()
+
+        with self.server.rng_lock:
+            drop = self.server.rng.random() < self.workspace.config.archive_drop_probability
+        if drop:
+            # Send some of the archive, then close the connection without sending the rest.
+            content = content[:len(content) // 2]
+            self.server.count("archive_dropped")
+            self.close_connection = True
+        self.server.count("archive_bytes", len(content))
+        self.wfile.write(content)
+
+    def do_GET(self):
+        self.server.count("GET")
+        if self._inject_failure("GET"):
+            return
+
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        workspace = self.workspace
+
+        if url.path.startswith(ARCHIVES_PREFIX):
+            self._send_archive(url, query)
+            return
+
+        endpoint = url.path[len(API_PREFIX):-len(".json")] if url.path.startswith(API_PREFIX) else None
+        if endpoint == "org":
+            self._send_json(200, workspace.org)
+        elif endpoint == "definitions":
+            flow_uuids = set(query.get("flow", []))
+            self._send_json(200, {"version": "13", "site": "http://localhost", "campaigns": [], "triggers": [],
+                                  "fields": [], "groups": [],
+                                  "flows": [{"uuid": f["uuid"], "name": f["name"]}
+                                            for f in workspace.flows if f["uuid"] in flow_uuids]})
+        elif endpoint == "archives":
+            archive_type = query.get("archive_type", [None])[0]
+            host = f"http://{self.headers['Host']}"
+            link_query = ""
+            if workspace.config.archive_link_ttl_seconds is not None:
+                link_query = "?" + urlencode({"expires": time.time() + workspace.config.archive_link_ttl_seconds})
+            archives = [dict(a, download_url=host + a["download_url"] + link_query) for a in workspace.archive_metadata
+                        if archive_type is None or a["archive_type"] == archive_type]
+            self._paginate(url, query, archives)
+        elif endpoint == "runs":
+            runs = workspace.runs
+            if "flow" in query:
+                runs = [r for r in runs if r["flow"]["uuid"] == query["flow"][0]]
+            self._paginate(url, query, self._filter_dates(runs, query, "modified_on"))
+        elif endpoint == "messages":
+            self._paginate(url, query, self._filter_dates(workspace.messages, query, "created_on"))
+        elif endpoint == "contacts":
+            contacts = workspace.contacts
+            if "uuid" in query:
+                contacts = [c for c in contacts if c["uuid"] == query["uuid"][0]]
+            if "urn" in query:
+                contacts = [c for c in contacts if query["urn"][0] in c["urns"]]
+            if query.get("deleted", ["0"])[0] in {"1", "true"}:
+                # The fake workspace never deletes contacts.
+                contacts = []
+            self._paginate(url, query, self._filter_dates(contacts, query, "modified_on"))
+        elif endpoint == "flows":
+            flows = workspace.flows
+            if "uuid" in query:
+                flows = [f for f in flows if f["uuid"] == query["uuid"][0]]
+            self._paginate(url, query, flows)
+        elif endpoint == "fields":
+            fields = workspace.fields
+            if "key" in query:
+                fields = [f for f in fields if f["key"] == query["key"][0]]
+            self._paginate(url, query, fields)
+        elif endpoint == "groups":
+            self._paginate(url, query, workspace.groups)
+        elif endpoint == "broadcasts":
+            now = time.time()
+            # (Newest first, as Rapid Pro returns them)
+            broadcasts = [dict(b, status="sent") if now >= sent_time else b
+                          for b, sent_time in zip(reversed(workspace.broadcasts),
+                                                  reversed(workspace.broadcast_sent_times))]
+            if "id" in query:
+                broadcasts = [b for b in broadcasts if str(b["id"]) == query["id"][0]]
+            broadcasts = self._filter_dates(broadcasts, query, "created_on")
+            self._paginate(url, query, broadcasts)
+        elif endpoint in EMPTY_ENDPOINTS:
+            self._paginate(url, query, [])
+        else:
+            self._send_json(404, {"detail": "Not found."})
+
+    def do_POST(self):
+        self.server.count("POST")
+        # (Read the body even if failing the request, otherwise it would be parsed as the next request on this
+        # keep-alive connection)
+        body = self._read_body()
+        url = urlparse(self.path)
+        endpoint = url.path[len(API_PREFIX):-len(".json")] if url.path.startswith(API_PREFIX) else None
+        # (Don't fail broadcasts with 500/504 errors, because RapidProClient deliberately doesn't retry those, as a
+        # real server may have sent the broadcast anyway)
+        if self._inject_failure("POST", allow_server_errors=endpoint != "broadcasts"):
+            return
+
+        query = parse_qs(url.query)
+        workspace = self.workspace
+        now = synthetic_data.format_iso8601(datetime.datetime.now(datetime.timezone.utc))
+
+        with workspace.lock:
+            if endpoint == "broadcasts":
+                broadcast = {"id": len(workspace.broadcasts) + 1, "status": "queued", "urns": body.get("urns", []),
+                             "contacts": [], "groups": [], "text": body.get("text"), "created_on": now}
+                workspace.broadcasts.append(broadcast)
+                workspace.broadcast_sent_times.append(time.time() + workspace.config.broadcast_send_seconds)
+                self._send_json(201, broadcast)
+            elif endpoint == "contact_actions":
+                self._send_json(204)
+            elif endpoint == "fields":
+                if "key" in query:
+                    field = next(f for f in workspace.fields if f["key"] == query["key"][0])
+                    field.update(label=body["label"], value_type=body["value_type"])
+                else:
+                    field = {"key": body["label"].lower().replace(" ", "_"), "label": body["label"],
+                             "value_type": body["value_type"]}
+                    workspace.fields.append(field)
+                self._send_json(201, field)
+            elif endpoint == "groups":
+                group = {"uuid": f"00000000-0000-0005-0000-{len(workspace.groups):012d}", "name": body["name"],
+                         "query": None, "count": 0}
+                workspace.groups.append(group)
+                self._send_json(201, group)
+            elif endpoint == "contacts":
+                contact = {"uuid": f"00000000-0000-0006-0000-{len(workspace.contacts):012d}",
+                           "name": body.get("name"), "language": body.get("language"),
+                           "urns": body.get("urns", []), "groups": [], "fields": body.get("fields", dict()),
+                           "blocked": False, "stopped": False, "created_on": now, "modified_on": now}
+                self._send_json(201, contact)
+            else:
+                self._send_json(404, {"detail": "Not found."})
+
+
+class FakeRapidProServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, workspace, host="127.0.0.1", port=0):
+        """
+        Serves a fake workspace over HTTP. Pass port 0 to listen on any free port.
+
+        :param workspace: Workspace to serve.
+        :type workspace: FakeWorkspace
+        """
+        super().__init__((host, port), _FakeRapidProRequestHandler)
+        self.workspace = workspace
+        self.rng = random.Random(workspace.config.seed)
+        self.rng_lock = threading.Lock()
+        self.counters = dict()
+        self._counters_lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+    def count(self, counter, amount=1):
+        with self._counters_lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def start_in_background(self):
+        """
+        Starts serving requests on a daemon thread.
+        """
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serves a fake Rapid Pro workspace of synthetic data locally")
+
+    parser.add_argument("--port", type=int, default=8000, help="Port to listen on")
+    parser.add_argument("--runs", type=int, default=10000, help="Number of runs in the workspace")
+    parser.add_argument("--messages", type=int, default=10000, help="Number of messages in the workspace")
+    parser.add_argument("--contacts", type=int, default=1000, help="Number of contacts in the workspace")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds to wait before responding to a request")
+    parser.add_argument("--rate-limit-probability", type=float, default=0.0,
+                        help="Probability of responding to a request with 429 Too Many Requests")
+    parser.add_argument("--error-500-probability", type=float, default=0.0,
+                        help="Probability of responding to a POST request with 500 Internal Server Error")
+    parser.add_argument("--error-504-probability", type=float, default=0.0,
+                        help="Probability of responding to a POST request with 504 Gateway Timeout")
+    parser.add_argument("--archive-drop-probability", type=float, default=0.0,
+                        help="Probability of closing the connection part way through sending an archive")
+    parser.add_argument("--archive-link-ttl", type=float,
+                        help="Seconds each archive download link is valid for after the archive is listed")
+
+    args = parser.parse_args()
+
+    server = FakeRapidProServer(FakeWorkspace(FakeWorkspaceConfig(
+        run_count=args.runs, message_count=args.messages, contact_count=args.contacts,
+        latency_seconds=args.latency, rate_limit_probability=args.rate_limit_probability,
+        error_500_probability=args.error_500_probability, error_504_probability=args.error_504_probability,
+        archive_drop_probability=args.archive_drop_probability, archive_link_ttl_seconds=args.archive_link_ttl
+    )), port=args.port)
+    print(f"Serving a fake Rapid Pro workspace at {server.url} (use any token)")
+    server.serve_forever()
@@ -0,0 +1,174 @@
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCHMARKS_DIR)
+
+# Load-test the code in this working tree rather than any installed copy of rapid_pro_tools.
+sys.path.insert(0, REPO_ROOT)
+
+import synthetic_data  # noqa: E402
+from fake_rapid_pro_server import FakeRapidProServer, FakeWorkspace, FakeWorkspaceConfig  # noqa: E402
+
+
+# Each scenario is a function of (client, workspace) which makes requests to the fake workspace using the given
+# RapidProClient, and returns the number of records it fetched or sent.
+
+def _scenario_get_raw_runs(client, workspace):
+    return len(client.get_raw_runs())
+
+
+def _scenario_get_raw_messages(client, workspace):
+    return len(client.get_raw_messages())
+
+
+def _scenario_export_all_data(client, workspace):
+    export_dir_path = tempfile.mkdtemp(prefix="rapid_pro_tools_load_test_")
+    try:
+        client.export_all_data(export_dir_path)
+        records = 0
+        for file_name in os.listdir(export_dir_path):
+            if file_name.endswith(".jsonl"):
+                with open(os.path.join(export_dir_path, file_name)) as f:
+                    records += sum(1 for _ in f)
+        return records
+    finally:
+        shutil.rmtree(export_dir_path)
+
+
+def _scenario_send_message_to_urns(client, workspace):
+    urns = [synthetic_data.contact_urn(i, workspace.config.seed) for i in range(workspace.config.contact_count)]
+    client.send_message_to_urns("load test message", urns, interrupt=True)
+    return len(urns)
+
+
+SCENARIOS = {
+    "get_raw_runs": _scenario_get_raw_runs,
+    "get_raw_messages": _scenario_get_raw_messages,
+    "export_all_data": _scenario_export_all_data,
+    "send_message_to_urns": _scenario_send_message_to_urns
+}
+
+
+def run_scenario(scenario_name, config):
+    """
+    Runs a load-test scenario against a fresh fake workspace.
+
+    :param scenario_name: Name of the scenario to run. One of the keys of `SCENARIOS`.
+    :type scenario_name: str
+    :param config: Configuration of the fake workspace to run the scenario against.
+    :type config: fake_rapid_pro_server.FakeWorkspaceConfig
+    :return: Dictionary of results: the number of records, the time taken, the throughput, the number of requests
+             the server received and failed by kind, the client's metrics, and the error that stopped the scenario,
+             if any.
+    :rtype: dict
+    """
+    from rapid_pro_tools.http_session_pool import HttpSessionPool
+    from rapid_pro_tools.metrics import RapidProMetrics
+    from rapid_pro_tools.rapid_pro_client import RapidProClient
+
+    server = FakeRapidProServer(FakeWorkspace(config))
+    server.start_in_background()
+    http_session_pool = HttpSessionPool()
+    metrics = RapidProMetrics()
+    try:
+        client = RapidProClient(server.url, "load-test-token", http_session_pool=http_session_pool, metrics=metrics)
+
+        error = None
+        records = 0
+        start = time.perf_counter()
+        try:
+            records = SCENARIOS[scenario_name](client, server.workspace)
+        except Exception as ex:
+            error = f"{type(ex).__name__}: {ex!r}"
+        seconds = time.perf_counter() - start
+    finally:
+        http_session_pool.close()
+        server.shutdown()
+        server.server_close()
+
+    return {
+        "scenario": scenario_name,
+        "records": records,
+        "seconds": seconds,
+        "records_per_second": records / seconds if seconds > 0 else 0,
+        "requests": server.counters.get("GET", 0) + server.counters.get("POST", 0),
+        "rate_limited": server.counters.get("429", 0),
+        "errors_500": server.counters.get("500", 0),
+        "errors_504": server.counters.get("504", 0),
+        "archive_bytes": server.counters.get("archive_bytes", 0),
+        "archives_dropped": server.counters.get("archive_dropped", 0),
+        "archive_links_expired": server.counters.get("archive_expired", 0),
+        "client_metrics": metrics.snapshot(),
+        "error": error
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measures RapidProClient's end-to-end throughput against a local fake "
+                                                 "Rapid Pro workspace, optionally with injected latency and failures")
+
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS.keys()),
+                        help=f"Comma-separated list of the scenarios to run. "
+                             f"Available scenarios: {', '.join(SCENARIOS.keys())}")
+    parser.add_argument("--runs", type=int, default=10000, help="Number of runs in the fake workspace")
+    parser.add_argument("--messages", type=int, default=10000, help="Number of messages in the fake workspace")
+    parser.add_argument("--contacts", type=int, default=1000, help="Number of contacts in the fake workspace")
+    parser.add_argument("--archived-fraction", type=float, default=0.5,
+                        help="Fraction of the oldest runs and messages to serve from archives")
+    parser.add_argument("--page-size", type=int, default=250,
+                        help="Maximum number of results in each page of a paginated response")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Seconds the server waits before responding to each request")
+    parser.add_argument("--rate-limit-probability", type=float, default=0.0,
+                        help="Probability of the server responding to a request with 429 Too Many Requests")
+    parser.add_argument("--retry-after", type=int, default=1,
+                        help="Seconds the server asks the client to wait after a 429 response")
+    parser.add_argument("--error-500-probability", type=float, default=0.0,
+                        help="Probability of the server responding to a POST request with 500 Internal Server Error")
+    parser.add_argument("--error-504-probability", type=float, default=0.0,
+                        help="Probability of the server responding to a POST request with 504 Gateway Timeout")
+    parser.add_argument("--archive-drop-probability", type=float, default=0.0,
+                        help="Probability of the server closing the connection part way through sending an archive")
+    parser.add_argument("--archive-link-ttl", type=float,
+                        help="Seconds each archive download link is valid for after the archive is listed")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed for generating the workspace's data and for deciding which requests to fail")
+    parser.add_argument("--output", metavar="output-file-path", help="File to write the results to as json")
+
+    args = parser.parse_args()
+
+    config = FakeWorkspaceConfig(
+        run_count=args.runs, message_count=args.messages, contact_count=args.contacts,
+        archived_fraction=args.archived_fraction, page_size=args.page_size, latency_seconds=args.latency,
+        rate_limit_probability=args.rate_limit_probability, retry_after_seconds=args.retry_after,
+        error_500_probability=args.error_500_probability, error_504_probability=args.error_504_probability,
+        archive_drop_probability=args.archive_drop_probability, archive_link_ttl_seconds=args.archive_link_ttl,
+        seed=args.seed
+    )
+
+    results = []
+    for scenario_name in args.scenarios.split(","):
+        assert scenario_name in SCENARIOS, f"Unknown scenario '{scenario_name}'"
+        result = run_scenario(scenario_name, config)
+        print(f"{scenario_name}: {result['records']} records in {result['seconds']:.3f}s "
+              f"({result['records_per_second']:.0f} records/s), {result['requests']} requests "
+              f"({result['rate_limited']} rate-limited, {result['errors_500']} 500s, {result['errors_504']} 504s), "
+              f"{sum(result['client_metrics']['retries'].values())} retries, "
+              f"{result['client_metrics']['rate_limit_sleep_seconds']:.1f}s sleeping on rate limits"
+              + ("" if result["error"] is None else f", FAILED with {result['error']}"))
+        results.append(result)
+
+    if args.output is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump({"config": vars(args), "results": results}, f, indent=2)
+            f.write("\n")
+
+    if any(result["error"] is not None for result in results):
+        sys.exit(1)
@@ -0,0 +1,336 @@
+import argparse
+import datetime
+import gzip
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCHMARKS_DIR)
+MNO_ANALYSIS_TOOLS_DIR = os.path.join(REPO_ROOT, "mno_analysis_tools")
+
+# Benchmark the code in this working tree rather than any installed copy of rapid_pro_tools.
+sys.path.insert(0, REPO_ROOT)
+
+import synthetic_data  # noqa: E402
+
+DEFAULT_WORK_DIR = os.path.join(tempfile.gettempdir(), "rapid_pro_tools_benchmarks")
+
+
+def _contact_count(scale):
+    return max(scale // 10, 1)
+
+
+def _ensure_data_file(work_dir, file_name, write_fn):
+    """
+    Returns the path to a generated data file in the work directory, generating it first if it doesn't exist yet.
+    Generated files are kept between benchmark runs because generating the larger scales takes a long time.
+    """
+    file_path = os.path.join(work_dir, file_name)
+    if not os.path.exists(file_path):
+        os.makedirs(work_dir, exist_ok=True)
+        write_fn(file_path + ".tmp")
+        os.rename(file_path + ".tmp", file_path)
+    return file_path
+
+
+def _run_archive_path(scale, work_dir):
+    return _ensure_data_file(
+        work_dir, f"runs_{scale}.jsonl.gz",
+        lambda path: synthetic_data.write_gzipped_jsonl(path, synthetic_data.generate_runs(scale, _contact_count(scale)))
+    )
+
+
+def _message_archive_path(scale, work_dir):
+    return _ensure_data_file(
+        work_dir, f"messages_{scale}.jsonl.gz",
+        lambda path: synthetic_data.write_gzipped_jsonl(
+            path, synthetic_data.generate_messages(scale, _contact_count(scale)))
+    )
+
+
+def _load_runs(scale, work_dir):
+    from rapid_pro_tools.rapid_pro_client import RapidProClient
+    with open(_run_archive_path(scale, work_dir), "rb") as f:
+        return RapidProClient._deserialize_archive("run", f)
+
+
+# Each benchmark case has a setup function, which is given the scale and work directory, prepares the case's inputs,
+# and returns a function of () that runs the code being measured. Only the returned function is measured.
+
+def _setup_archive_deserialize(archive_type):
+    def setup(scale, work_dir):
+        from rapid_pro_tools.rapid_pro_client import RapidProClient
+        path = _run_archive_path(scale, work_dir) if archive_type == "run" else _message_archive_path(scale, work_dir)
+        return lambda: _deserialize_file(RapidProClient, archive_type, path)
+    return setup
+
+
+def _deserialize_file(client_class, archive_type, path):
+    with open(path, "rb") as f:
+        client_class._deserialize_archive(archive_type, f)
+
+
+def _setup_filter_latest(scale, work_dir):
+    from rapid_pro_tools.rapid_pro_client import RapidProClient
+    runs = _load_runs(scale, work_dir)
+    return lambda: RapidProClient.filter_latest(runs, lambda run: run.id)
+
+
+def _setup_update_raw_data_with_latest_modified(scale, work_dir):
+    from rapid_pro_tools.rapid_pro_client import RapidProClient
+    runs = _load_runs(scale, work_dir)
+    runs.sort(key=lambda run: run.modified_on)
+    prev_runs = runs[:int(len(runs) * 0.8)]
+    new_runs = runs[int(len(runs) * 0.8):]
+
+    # Constructing a client doesn't make any requests, and the get function below serves the 'new' runs locally.
+    client = RapidProClient("localhost", "synthetic-token")
+    return lambda: client.update_raw_data_with_latest_modified(
+        lambda last_modified_after_inclusive, raw_export_log_file: list(new_runs), lambda run: run.id,
+        prev_raw_data=prev_runs
+    )
+
+
+def _setup_convert_runs_to_traced_data(scale, work_dir):
+    from rapid_pro_tools.rapid_pro_client import RapidProClient
+    from temba_client.v2 import Contact
+    runs = _load_runs(scale, work_dir)
+    contacts = [Contact.deserialize(c) for c in synthetic_data.generate_contacts(_contact_count(scale))]
+    return lambda: RapidProClient.convert_runs_to_traced_data(
+        "benchmark", runs, contacts, synthetic_data.SyntheticUuidTable())
+
+
+def _iter_run_chunks(path, chunk_size=10000):
+    from temba_client.v2 import Run
+    with gzip.open(path, "rt") as f:
+        chunk = []
+        for line in f:
+            chunk.append(Run.deserialize(json.loads(line)))
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        yield chunk
+
+
+def _setup_sort_runs(external):
+    # Runs are read from the archive in chunks, as they would be fetched from archives and production, so that the
+    # measured memory reflects the sort rather than the inputs.
+    def setup(scale, work_dir):
+        path = _run_archive_path(scale, work_dir)
+        return lambda: _sort_runs(path, external, work_dir)
+    return setup
+
+
+def _sort_runs(path, external, work_dir):
+    from rapid_pro_tools.external_sort import ExternalSorter
+    from temba_client.v2 import Run
+
+    if not external:
+        runs = []
+        for chunk in _iter_run_chunks(path):
+            runs.extend(chunk)
+        runs.sort(key=lambda run: run.modified_on)
+        for _ in runs:
+            pass
+        return
+
+    with ExternalSorter(Run, lambda run: run.modified_on, lambda run: run.id, temp_dir=work_dir) as sorter:
+        for chunk in _iter_run_chunks(path):
+            sorter.add(chunk)
+        for _ in sorter.sorted_records():
+            pass
+
+
+def _setup_mno_script(script_name, extra_args):
+    def setup(scale, work_dir):
+        raw_messages_path = _ensure_data_file(
+            work_dir, f"raw_messages_{scale}.json",
+            lambda path: synthetic_data.write_json_list(
+                path, synthetic_data.generate_messages(scale, _contact_count(scale)))
+        )
+        start_date = synthetic_data.EPOCH
+        end_date = synthetic_data.EPOCH + \
+            datetime.timedelta(seconds=scale * synthetic_data.MEAN_SECONDS_BETWEEN_RECORDS * 1.2)
+        command = [
+            sys.executable, os.path.join(MNO_ANALYSIS_TOOLS_DIR, script_name), *extra_args,
+            raw_messages_path, os.path.join(work_dir, f"{script_name}_output.json"),
+            "telegram", "in", start_date.isoformat(), end_date.isoformat()
+        ]
+        env = dict(os.environ, PYTHONPATH=REPO_ROOT)
+        return lambda: subprocess.run(command, check=True, cwd=MNO_ANALYSIS_TOOLS_DIR, env=env,
+                                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return setup
+
+
+def _setup_import(module_name, lazy_module_names, max_import_seconds):
+    def setup(scale, work_dir):
+        # The import is run in a fresh interpreter, so nothing it imports has been cached by an earlier import. The
+        # interpreter fails if any of the modules which should only be imported lazily was imported, or if the import
+        # itself (excluding the interpreter's own startup) took longer than `max_import_seconds`.
+        code = f"import sys, time\n" \
+               f"start = time.perf_counter()\n" \
+               f"import {module_name}\n" \
+               f"seconds = time.perf_counter() - start\n" \
+               f"eager = [name for name in {lazy_module_names!r} if name in sys.modules]\n" \
+               f"assert len(eager) == 0, f'{module_name} imported {{eager}} eagerly'\n" \
+               f"assert seconds <= {max_import_seconds}, " \
+               f"f'Importing {module_name} took {{seconds:.3f}}s (at most {max_import_seconds}s allowed)'"
+        env = dict(os.environ, PYTHONPATH=REPO_ROOT)
+        return lambda: subprocess.run([sys.executable, "-c", code], check=True, cwd=REPO_ROOT, env=env,
+                                      stdout=subprocess.DEVNULL)
+    return setup
+
+
+# Time allowed for importing `rapid_pro_tools.rapid_pro_client`, which every CLI tool that uses `RapidProClient` does on
+# startup. With TracedData, the phone cleaners, relativedelta and zstandard imported lazily, the import is dominated by
+# temba_client and requests, and takes ~0.2s on a development laptop. The limit leaves headroom for slower machines.
+MAX_CLIENT_IMPORT_SECONDS = 0.5
+
+# Dictionary of case name -> (setup function, whether the measured code runs in a subprocess)
+CASES = {
+    "archive_deserialize_runs": (_setup_archive_deserialize("run"), False),
+    "archive_deserialize_messages": (_setup_archive_deserialize("message"), False),
+    "filter_latest": (_setup_filter_latest, False),
+    "update_raw_data_with_latest_modified": (_setup_update_raw_data_with_latest_modified, False),
+    "convert_runs_to_traced_data": (_setup_convert_runs_to_traced_data, False),
+    "sort_runs_in_memory": (_setup_sort_runs(external=False), False),
+    "sort_runs_external": (_setup_sort_runs(external=True), False),
+    "mno_compute_window_of_downtime": (_setup_mno_script("compute_window_of_downtime.py", []), True),
+    "mno_compute_msg_difference": (
+        _setup_mno_script("compute_msg_difference_btwn_two_firebase_time_periods.py", ["-t", "01:00:00"]), True),
+    "import_rapid_pro_client": (
+        _setup_import("rapid_pro_tools.rapid_pro_client",
+                      ["core_data_modules.traced_data", "core_data_modules.cleaners", "dateutil.relativedelta",
+                       "zstandard"], MAX_CLIENT_IMPORT_SECONDS), True)
+}
+
+
+def _max_rss_mb(who):
+    max_rss = resource.getrusage(who).ru_maxrss
+    # ru_maxrss is in bytes on macOS, but in kilobytes on Linux.
+    return max_rss / (1024 * 1024) if sys.platform == "darwin" else max_rss / 1024
+
+
+def run_case(case_name, scale, work_dir):
+    """
+    Runs a single benchmark case in this process, and returns its measurements.
+
+    :return: Dictionary of measurements: the wall-clock time taken, and the peak resident memory of the process
+             running the measured code, both overall and beyond what was needed to set up the inputs.
+    :rtype: dict
+    """
+    setup, runs_in_subprocess = CASES[case_name]
+    measured_fn = setup(scale, work_dir)
+
+    rusage_who = resource.RUSAGE_CHILDREN if runs_in_subprocess else resource.RUSAGE_SELF
+    rss_before_mb = 0 if runs_in_subprocess else _max_rss_mb(rusage_who)
+    start = time.perf_counter()
+    measured_fn()
+    seconds = time.perf_counter() - start
+    peak_rss_mb = _max_rss_mb(rusage_who)
+
+    return {
+        "case": case_name,
+        "scale": scale,
+        "seconds": seconds,
+        "peak_rss_mb": peak_rss_mb,
+        "peak_rss_increase_mb": max(peak_rss_mb - rss_before_mb, 0)
+    }
+
+
+def run_case_in_subprocess(case_name, scale, work_dir):
+    """
+    Runs a single benchmark case in a fresh Python process, so that its peak memory isn't affected by other cases.
+    """
+    output = subprocess.run(
+        [sys.executable, __file__, "--run-case", case_name, "--scales", str(scale), "--work-dir", work_dir],
+        check=True, stdout=subprocess.PIPE
+    ).stdout
+    return json.loads(output.decode("utf-8").strip().splitlines()[-1])
+
+
+def compare_to_baseline(results, baseline, max_regression):
+    """
+    Compares benchmark results to a baseline, printing the ratio of each measurement to its baseline.
+
+    :return: Whether any measurement regressed by more than `max_regression` (a fraction of the baseline).
+    :rtype: bool
+    """
+    baseline_lut = {(r["case"], r["scale"]): r for r in baseline["results"]}
+    regressed = False
+    for result in results:
+        baseline_result = baseline_lut.get((result["case"], result["scale"]))
+        if baseline_result is None:
+            print(f"{result['case']} @ {result['scale']}: no baseline")
+            continue
+
+        for measurement in ["seconds", "peak_rss_mb"]:
+            ratio = result[measurement] / baseline_result[measurement] if baseline_result[measurement] > 0 else 1
+            flag = ""
+            if ratio > 1 + max_regression:
+                regressed = True
+                flag = "  <-- REGRESSION"
+            print(f"{result['case']} @ {result['scale']}: {measurement} {result[measurement]:.3f} vs baseline "
+                  f"{baseline_result[measurement]:.3f} ({ratio:.2f}x){flag}")
+    return regressed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs CPU and memory micro-benchmarks of RapidProTools' hot paths "
+                                                 "against deterministic synthetic Rapid Pro data")
+
+    parser.add_argument("--cases", default=",".join(CASES.keys()),
+                        help=f"Comma-separated list of the cases to run. Available cases: {', '.join(CASES.keys())}")
+    parser.add_argument("--scales", default="10000",
+                        help="Comma-separated list of the number of records to benchmark each case with, "
+                             "e.g. 10000,100000,1000000,10000000")
+    parser.add_argument("--repeats", type=int, default=1,
+                        help="Number of times to run each case at each scale. The fastest repeat is reported")
+    parser.add_argument("--work-dir", default=DEFAULT_WORK_DIR,
+                        help="Directory to write generated synthetic data to. Data is reused between runs")
+    parser.add_argument("--output", metavar="output-file-path",
+                        help="File to write the results to as json, e.g. to record a baseline to compare later "
+                             "runs on this machine against")
+    parser.add_argument("--baseline", metavar="baseline-file-path",
+                        help="File containing previously recorded results to compare these results against")
+    parser.add_argument("--max-regression", type=float, default=0.2,
+                        help="Fraction by which a measurement may exceed its baseline before it is reported as a "
+                             "regression. If any measurement regresses, exits with status 1")
+    parser.add_argument("--run-case", help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+    scales = [int(scale) for scale in args.scales.split(",")]
+
+    if args.run_case is not None:
+        # Running as a child of the process below: run one case and report the measurements on stdout.
+        print(json.dumps(run_case(args.run_case, scales[0], args.work_dir)))
+        sys.exit(0)
+
+    results = []
+    for case_name in args.cases.split(","):
+        assert case_name in CASES, f"Unknown case '{case_name}'"
+        for scale in scales:
+            repeats = [run_case_in_subprocess(case_name, scale, args.work_dir) for _ in range(args.repeats)]
+            result = min(repeats, key=lambda r: r["seconds"])
+            print(f"{case_name} @ {scale}: {result['seconds']:.3f}s, peak RSS {result['peak_rss_mb']:.1f} MB "
+                  f"(+{result['peak_rss_increase_mb']:.1f} MB during the measured code)")
+            results.append(result)
+
+    if args.output is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump({"python_version": platform.python_version(), "platform": platform.platform(),
+                       "results": results}, f, indent=2)
+            f.write("\n")
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare_to_baseline(results, baseline, args.max_regression):
+            sys.exit(1)
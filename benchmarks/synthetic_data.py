@@ -0,0 +1,236 @@
+"""
+Deterministic generators of synthetic Rapid Pro data, in the serialized formats returned by Rapid Pro's API and
+archives.
+
+Every generator takes a `seed`, and produces exactly the same records for the same arguments, so that benchmark
+results are comparable between runs and between machines. Records are generated lazily, so that large datasets can be
+streamed to disk without being held in memory.
+"""
+import datetime
+import gzip
+import json
+import random
+import uuid
+
+EPOCH = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+
+# Average number of seconds between consecutive generated runs or messages.
+MEAN_SECONDS_BETWEEN_RECORDS = 10
+
+# (URN prefix, number of digits to append) for each kind of URN given to generated contacts.
+URN_FORMATS = [
+    ("tel:+25261", 7),
+    ("tel:+25263", 7),
+    ("tel:+25290", 7),
+    ("tel:+2547", 8),
+    ("telegram:", 9)
+]
+
+
+def format_iso8601(dt):
+    return dt.astimezone(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def contact_uuid(index, seed=0):
+    """
+    :return: The uuid of the contact generated at `index` by `generate_contacts` with the given seed.
+    :rtype: str
+    """
+    return str(uuid.UUID(int=(seed << 96) | (1 << 64) | index))
+
+
+def contact_urn(index, seed=0):
+    """
+    :return: The URN of the contact generated at `index` by `generate_contacts` with the given seed.
+    :rtype: str
+    """
+    prefix, digits = URN_FORMATS[(index + seed) % len(URN_FORMATS)]
+    return f"{prefix}{index % (10 ** digits):0{digits}d}"
+
+
+def generate_contacts(count, seed=0):
+    """
+    Generates serialized contacts.
+
+    :param count: Number of contacts to generate.
+    :type count: int
+    :param seed: Seed for the generator.
+    :type seed: int
+    :return: Generator of `count` serialized contacts.
+    :rtype: generator of dict
+    """
+    rng = random.Random(seed)
+    for i in range(count):
+        created_on = EPOCH + datetime.timedelta(seconds=i * MEAN_SECONDS_BETWEEN_RECORDS)
+        yield {
+            "uuid": contact_uuid(i, seed),
+            "name": None,
+            "language": None,
+            "urns": [contact_urn(i, seed)],
+            "groups": [],
+            "fields": {"age": str(rng.randint(14, 80)), "gender": rng.choice(["male", "female", None])},
+            "blocked": False,
+            "stopped": False,
+            "created_on": format_iso8601(created_on),
+            "modified_on": format_iso8601(created_on + datetime.timedelta(seconds=rng.randint(0, 86400)))
+        }
+
+
+def generate_runs(count, contact_count, flow_count=5, results_per_flow=3, duplicate_fraction=0.1, seed=0):
+    """
+    Generates serialized runs, in approximately (but not exactly) ascending order of modification date.
+
+    :param count: Number of runs to generate.
+    :type count: int
+    :param contact_count: Number of contacts to attribute the runs to. The contacts are those generated by
+                          `generate_contacts` with the same `seed`.
+    :type contact_count: int
+    :param flow_count: Number of flows to attribute the runs to.
+    :type flow_count: int
+    :param results_per_flow: Number of results set by each run.
+    :type results_per_flow: int
+    :param duplicate_fraction: Fraction of runs which are later versions of a previously generated run (i.e. have the
+                               same id but a later modification date), to exercise de-duplication.
+    :type duplicate_fraction: float
+    :param seed: Seed for the generator.
+    :type seed: int
+    :return: Generator of `count` serialized runs.
+    :rtype: generator of dict
+    """
+    rng = random.Random(seed)
+    flows = [{"uuid": str(uuid.UUID(int=(seed << 96) | (2 << 64) | i)), "name": f"synthetic_flow_{i}"}
+             for i in range(flow_count)]
+
+    next_id = 1
+    for i in range(count):
+        if next_id > 1 and rng.random() < duplicate_fraction:
+            run_id = rng.randint(1, next_id - 1)
+        else:
+            run_id = next_id
+            next_id += 1
+
+        # Jitter the modification dates so that the runs are not already sorted.
+        modified_on = EPOCH + datetime.timedelta(seconds=i * MEAN_SECONDS_BETWEEN_RECORDS + rng.randint(-60, 60))
+        created_on = modified_on - datetime.timedelta(seconds=rng.randint(0, 3600))
+        flow = flows[run_id % flow_count]
+        contact_index = rng.randrange(contact_count)
+
+        values = dict()
+        for r in range(results_per_flow):
+            category = rng.choice(["Yes", "No", "Other"])
+            values[f"result_{r}"] = {
+                "value": category.lower(),
+                "category": category,
+                "node": str(uuid.UUID(int=(seed << 96) | (3 << 64) | r)),
+                "time": format_iso8601(created_on + datetime.timedelta(seconds=r)),
+                "name": f"Result {r}",
+                "input": f"synthetic message {rng.randint(0, 1 << 16)}"
+            }
+
+        yield {
+            "id": run_id,
+            "flow": flow,
+            "contact": {"uuid": contact_uuid(contact_index, seed), "name": None},
+            "start": None,
+            "responded": True,
+            "path": [],
+            "values": values,
+            "created_on": format_iso8601(created_on),
+            "modified_on": format_iso8601(modified_on),
+            "exited_on": format_iso8601(modified_on),
+            "exit_type": "completed"
+        }
+
+
+def generate_messages(count, contact_count, seed=0):
+    """
+    Generates serialized messages, in ascending order of creation date.
+
+    :param count: Number of messages to generate.
+    :type count: int
+    :param contact_count: Number of contacts to attribute the messages to. The contacts are those generated by
+                          `generate_contacts` with the same `seed`.
+    :type contact_count: int
+    :param seed: Seed for the generator.
+    :type seed: int
+    :return: Generator of `count` serialized messages.
+    :rtype: generator of dict
+    """
+    rng = random.Random(seed)
+    channel = {"uuid": str(uuid.UUID(int=(seed << 96) | (4 << 64))), "name": "Synthetic Channel"}
+
+    sent_on = EPOCH
+    for i in range(count):
+        # Exponentially distributed gaps between messages, so that windows of downtime vary in length.
+        sent_on += datetime.timedelta(seconds=rng.expovariate(1 / MEAN_SECONDS_BETWEEN_RECORDS))
+        contact_index = rng.randrange(contact_count)
+        direction = rng.choice(["in", "out"])
+
+        yield {
+            "id": i + 1,
+            "broadcast": None,
+            "contact": {"uuid": contact_uuid(contact_index, seed), "name": None},
+            "urn": contact_urn(contact_index, seed),
+            "channel": channel,
+            "direction": direction,
+            "type": "inbox" if direction == "in" else "flow",
+            "status": "handled" if direction == "in" else "delivered",
+            "visibility": "visible",
+            "text": f"synthetic message {rng.randint(0, 1 << 16)}",
+            "labels": [],
+            "created_on": format_iso8601(sent_on),
+            "sent_on": format_iso8601(sent_on),
+            "modified_on": format_iso8601(sent_on)
+        }
+
+
+def write_gzipped_jsonl(file_path, records):
+    """
+    Writes records to a file in the gzipped JSONL format that Rapid Pro serves archives in.
+
+    :param file_path: Path to write to.
+    :type file_path: str
+    :param records: Serialized records to write.
+    :type records: iterable of dict
+    :return: Number of records written.
+    :rtype: int
+    """
+    count = 0
+    with gzip.open(file_path, "wt") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+            count += 1
+    return count
+
+
+def write_json_list(file_path, records):
+    """
+    Writes records to a file as a single JSON list, in the format written by mno_analysis_tools/fetch_raw_messages.py.
+
+    The list is written incrementally, so the records are never all held in memory.
+
+    :param file_path: Path to write to.
+    :type file_path: str
+    :param records: Serialized records to write.
+    :type records: iterable of dict
+    :return: Number of records written.
+    :rtype: int
+    """
+    count = 0
+    with open(file_path, "w") as f:
+        f.write("[")
+        for record in records:
+            if count > 0:
+                f.write(", ")
+            f.write(json.dumps(record))
+            count += 1
+        f.write("]\n")
+    return count
+
+
+class SyntheticUuidTable(object):
+    """
+    In-memory stand-in for a phone number <-> UUID table, which deterministically derives each UUID from its data.
+    """
+    def data_to_uuid_batch(self, data):
+        return {d: f"avf-phone-uuid-{uuid.uuid5(uuid.NAMESPACE_URL, d)}" for d in data}
@@ -1,9 +1,12 @@
 import argparse
+import hashlib
 import json
 
 from core_data_modules.logging import Logger
 from core_data_modules.util import TimeUtils
+from google.cloud.exceptions import NotFound
 from src import FirestoreWrapper
+from src.data_models import FlowDefinitionsManifest
 from storage.google_cloud import google_cloud_utils
 
 from rapid_pro_tools.rapid_pro_client import RapidProClient
@@ -11,6 +14,38 @@ from rapid_pro_tools.rapid_pro_client import RapidProClient
 log = Logger(__name__)
 
 
+def compute_flow_definitions_hash(flow_definitions):
+    """
+    Computes a hash of the given flow definitions that is stable across runs, by hashing a canonical JSON serialization
+    (sorted keys, no insignificant whitespace) of the definitions.
+
+    :param flow_definitions: Flow definitions to hash.
+    :type flow_definitions: temba_client.v2.types.Export
+    :return: Hex-encoded SHA-256 of the canonical serialization.
+    :rtype: str
+    """
+    canonical_json = json.dumps(flow_definitions.serialize(), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical_json.encode("utf-8")).hexdigest()
+
+
+def load_manifest(google_cloud_credentials_file_path, manifest_url):
+    """
+    Downloads the flow definitions manifest at the given url.
+
+    :param google_cloud_credentials_file_path: Path to the Google Cloud service account credentials file.
+    :type google_cloud_credentials_file_path: str
+    :param manifest_url: GS URL of the manifest.
+    :type manifest_url: str
+    :return: The manifest, or None if no manifest has been uploaded to this url yet.
+    :rtype: FlowDefinitionsManifest | None
+    """
+    try:
+        manifest_json = google_cloud_utils.download_blob_to_string(google_cloud_credentials_file_path, manifest_url)
+    except NotFound:
+        return None
+    return FlowDefinitionsManifest.from_dict(json.loads(manifest_json))
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Downloads the definitions for all the flows being used by this "
                                                  "project, and uploads them to a bucket.")
@@ -21,11 +56,15 @@ if __name__ == "__main__":
     parser.add_argument("firestore_credentials_url", metavar="firestore-credentials-url",
                         help="GS URL to the credentials file to use to access the Firestore instance containing "
                              "the operations statistics")
+    parser.add_argument("--write-unchanged-pointers", action="store_true",
+                        help="When a project's flow definitions are unchanged since the last upload, write a small "
+                             "pointer record to the previous upload instead of uploading nothing")
 
     args = parser.parse_args()
 
     google_cloud_credentials_file_path = args.google_cloud_credentials_file_path
     firestore_credentials_url = args.firestore_credentials_url
+    write_unchanged_pointers = args.write_unchanged_pointers
 
     log.info("Initialising the Firestore client...")
     firestore_credentials = json.loads(google_cloud_utils.download_blob_to_string(
@@ -54,7 +93,31 @@ if __name__ == "__main__":
         flow_definitions_request_timestamp = TimeUtils.utc_now_as_iso_string()
         flow_definitions = rapid_pro.get_flow_definitions_for_flow_ids(flow_ids)
 
-        log.info("Uploading the flow definitions to a cloud bucket...")
-        upload_url = f"{project.flow_definitions_upload_url_prefix}{flow_definitions_request_timestamp}.json"
-        flow_definitions_json = json.dumps(flow_definitions.serialize())
-        google_cloud_utils.upload_string_to_blob(google_cloud_credentials_file_path, upload_url, flow_definitions_json)
+        # Only upload the definitions if they differ from the last upload, as recorded by the project's manifest.
+        # (The manifest and pointers don't end in '.json', so that anything listing the '*.json' blobs under the
+        # prefix to find the latest definitions only sees the definitions themselves)
+        definitions_sha256 = compute_flow_definitions_hash(flow_definitions)
+        manifest_url = f"{project.flow_definitions_upload_url_prefix}definitions.manifest"
+        manifest = load_manifest(google_cloud_credentials_file_path, manifest_url)
+
+        if manifest is not None and manifest.definitions_sha256 == definitions_sha256:
+            log.info(f"Flow definitions unchanged since the upload at {manifest.uploaded_at} "
+                     f"(sha256 {definitions_sha256}), not uploading them again")
+            if write_unchanged_pointers:
+                pointer_url = f"{project.flow_definitions_upload_url_prefix}{flow_definitions_request_timestamp}" \
+                              f".pointer"
+                log.info(f"Writing a pointer to the unchanged flow definitions to '{pointer_url}'...")
+                pointer_json = json.dumps({"definitions_sha256": definitions_sha256,
+                                           "definitions_url": manifest.definitions_url})
+                google_cloud_utils.upload_string_to_blob(google_cloud_credentials_file_path, pointer_url, pointer_json)
+        else:
+            log.info("Uploading the flow definitions to a cloud bucket...")
+            upload_url = f"{project.flow_definitions_upload_url_prefix}{flow_definitions_request_timestamp}.json"
+            flow_definitions_json = json.dumps(flow_definitions.serialize())
+            google_cloud_utils.upload_string_to_blob(google_cloud_credentials_file_path, upload_url,
+                                                     flow_definitions_json)
+
+            log.info(f"Updating the flow definitions manifest at '{manifest_url}'...")
+            manifest = FlowDefinitionsManifest(definitions_sha256, upload_url, flow_definitions_request_timestamp)
+            google_cloud_utils.upload_string_to_blob(google_cloud_credentials_file_path, manifest_url,
+                                                     json.dumps(manifest.to_dict()))
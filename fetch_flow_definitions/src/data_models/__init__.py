@@ -1 +1,2 @@
 from .active_project import ActiveProject
+from .flow_definitions_manifest import FlowDefinitionsManifest
@@ -0,0 +1,28 @@
+class FlowDefinitionsManifest(object):
+    def __init__(self, definitions_sha256, definitions_url, uploaded_at):
+        """
+        :param definitions_sha256: SHA-256 of the canonical JSON serialization of the last uploaded flow definitions.
+        :type definitions_sha256: str
+        :param definitions_url: GS URL the last uploaded flow definitions were written to.
+        :type definitions_url: str
+        :param uploaded_at: ISO 8601 timestamp of the request for the last uploaded flow definitions.
+        :type uploaded_at: str
+        """
+        self.definitions_sha256 = definitions_sha256
+        self.definitions_url = definitions_url
+        self.uploaded_at = uploaded_at
+
+    def to_dict(self):
+        return {
+            "definitions_sha256": self.definitions_sha256,
+            "definitions_url": self.definitions_url,
+            "uploaded_at": self.uploaded_at
+        }
+
+    @classmethod
+    def from_dict(cls, source):
+        definitions_sha256 = source["definitions_sha256"]
+        definitions_url = source["definitions_url"]
+        uploaded_at = source["uploaded_at"]
+
+        return cls(definitions_sha256, definitions_url, uploaded_at)
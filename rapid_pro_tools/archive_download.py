@@ -0,0 +1,168 @@
+import random
+import re
+import time
+
+import requests
+from core_data_modules.logging import Logger
+from urllib3.exceptions import HTTPError as Urllib3HTTPError
+
+log = Logger(__name__)
+
+_CONTENT_RANGE_PATTERN = re.compile(r"bytes (\d+)-(\d+)/(\d+|\*)")
+
+
+def expected_archive_size(headers, offset, archive_metadata):
+    """
+    Returns the total size of an archive being downloaded, according to the response's headers if possible, otherwise
+    according to the archive's metadata.
+
+    :param headers: Headers of the response the archive is being downloaded from.
+    :type headers: dict-like of str -> str
+    :param offset: Byte offset of the archive that the response starts from.
+    :type offset: int
+    :param archive_metadata: Metadata of the archive being downloaded.
+    :type archive_metadata: temba_client.v2.types.Archive
+    :return: Total size of the archive, in bytes.
+    :rtype: int
+    """
+    content_range = _CONTENT_RANGE_PATTERN.match(headers.get("Content-Range", ""))
+    if content_range is not None and content_range.group(3) != "*":
+        return int(content_range.group(3))
+
+    content_length = headers.get("Content-Length")
+    if content_length is not None and headers.get("Content-Encoding") is None:
+        return offset + int(content_length)
+
+    return archive_metadata.size
+
+
+def resume_offset(status, headers):
+    """
+    Returns the byte offset of an archive that a response to a Range request resumes the download from.
+
+    :param status: HTTP status code of the response.
+    :type status: int
+    :param headers: Headers of the response.
+    :type headers: dict-like of str -> str
+    :return: Byte offset the response starts from, or 0 if the server ignored the Range header and is sending the
+             whole archive.
+    :rtype: int
+    """
+    content_range = _CONTENT_RANGE_PATTERN.match(headers.get("Content-Range", ""))
+    if status != 206 or content_range is None:
+        return 0
+    return int(content_range.group(1))
+
+
+class ResumableArchiveDownloader(object):
+    MAX_ATTEMPTS = 10
+    MAX_BACKOFF_POWER = 6
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, http_session_pool, refresh_download_url_fn, metrics=None, max_attempts=MAX_ATTEMPTS):
+        """
+        Downloads Rapid Pro archives to disk, resuming interrupted downloads from where they stopped rather than from
+        the start.
+
+        Archives are streamed to the given file in chunks. If the connection fails part way through, the download is
+        retried with an HTTP Range request for the bytes still missing. Archive download links expire, so if the
+        archive server rejects a link (with 403 Forbidden, as S3 does for expired links), a fresh link is obtained
+        from `refresh_download_url_fn` and the download resumes from the new link.
+
+        :param http_session_pool: Pool to make the download requests with.
+        :type http_session_pool: rapid_pro_tools.http_session_pool.HttpSessionPool
+        :param refresh_download_url_fn: Function which returns a new download link for an archive.
+        :type refresh_download_url_fn: function of temba_client.v2.types.Archive -> str
+        :param metrics: Metrics to record each download request and retry in, or None.
+        :type metrics: rapid_pro_tools.metrics.RapidProMetrics | None
+        :param max_attempts: Maximum number of requests to make for a single archive before giving up.
+        :type max_attempts: int
+        """
+        self.http_session_pool = http_session_pool
+        self.refresh_download_url_fn = refresh_download_url_fn
+        self.metrics = metrics
+        self.max_attempts = max_attempts
+
+    def _request(self, url, offset):
+        headers = {"Range": f"bytes={offset}-"} if offset > 0 else dict()
+        start = time.perf_counter()
+        try:
+            response = self.http_session_pool.request("get", url, stream=True, headers=headers)
+        except requests.exceptions.ConnectionError:
+            if self.metrics is not None:
+                self.metrics.record_request("get", "archive", "connection_error", time.perf_counter() - start)
+            raise
+        if self.metrics is not None:
+            self.metrics.record_request("get", "archive", response.status_code, time.perf_counter() - start)
+        return response
+
+    def download(self, archive_metadata, f):
+        """
+        Downloads an archive to a file.
+
+        :param archive_metadata: Metadata of the archive to download.
+        :type archive_metadata: temba_client.v2.types.Archive
+        :param f: Binary file to write the archive to. Must be empty, and readable, writable and seekable.
+        :type f: file-like
+        :return: Number of bytes downloaded.
+        :rtype: int
+        """
+        url = archive_metadata.download_url
+        downloaded_bytes = 0
+        attempts = 0
+        while True:
+            attempts += 1
+            try:
+                response = self._request(url, downloaded_bytes)
+
+                if response.status_code == 403:
+                    response.close()
+                    if attempts >= self.max_attempts:
+                        response.raise_for_status()
+                    log.info(f"Archive download link was rejected, probably because it has expired. "
+                             f"Refreshing the link and resuming from byte {downloaded_bytes}...")
+                    if self.metrics is not None:
+                        self.metrics.record_retry(403)
+                    url = self.refresh_download_url_fn(archive_metadata)
+                    continue
+
+                response.raise_for_status()
+
+                if downloaded_bytes > 0:
+                    resume_from = resume_offset(response.status_code, response.headers)
+                    if resume_from == 0:
+                        # The server ignored the Range header and is sending the whole archive, so start again.
+                        log.info("Archive server does not support resuming downloads, restarting the download")
+                    assert resume_from <= downloaded_bytes, "Archive server skipped part of the archive"
+                    f.seek(resume_from)
+                    f.truncate()
+                    downloaded_bytes = resume_from
+
+                expected_total_bytes = expected_archive_size(response.headers, downloaded_bytes, archive_metadata)
+
+                # Read the raw bytes without letting urllib3 undo any Content-Encoding, because the archive itself is
+                # gzipped and is decompressed after downloading.
+                for chunk in response.raw.stream(self.CHUNK_SIZE, decode_content=False):
+                    f.write(chunk)
+                    downloaded_bytes += len(chunk)
+
+                if downloaded_bytes >= expected_total_bytes:
+                    f.flush()
+                    return downloaded_bytes
+
+                log.info(f"Archive download ended early, after {downloaded_bytes} of {expected_total_bytes} bytes")
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                    requests.exceptions.ChunkedEncodingError, Urllib3HTTPError) as ex:
+                # (Don't log the details of the error, because they include the download url, which contains a
+                # temporary access credential)
+                log.info(f"Archive download failed with {type(ex).__name__} after {downloaded_bytes} bytes")
+
+            if attempts >= self.max_attempts:
+                raise IOError(f"Failed to download archive {archive_metadata.start_date} after {attempts} attempts "
+                              f"({downloaded_bytes} bytes downloaded)")
+
+            if self.metrics is not None:
+                self.metrics.record_retry("archive_interrupted")
+            backoff_seconds = random.uniform(0, 2 ** min(attempts, self.MAX_BACKOFF_POWER))
+            log.info(f"Resuming archive download from byte {downloaded_bytes} in {backoff_seconds:.1f} seconds...")
+            time.sleep(backoff_seconds)
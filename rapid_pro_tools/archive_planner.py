@@ -0,0 +1,154 @@
+import bisect
+import datetime
+
+from core_data_modules.logging import Logger
+
+log = Logger(__name__)
+
+
+def archive_end_date(archive_metadata):
+    """
+    :param archive_metadata: Metadata of a Rapid Pro archive.
+    :type archive_metadata: temba_client.v2.types.Archive
+    :return: The last instant covered by the archive.
+    :rtype: datetime.datetime
+    """
+    if archive_metadata.period == "daily":
+        return archive_metadata.start_date + datetime.timedelta(days=1, microseconds=-1)
+    else:
+        assert archive_metadata.period == "monthly"
+        return _next_month_start(archive_metadata.start_date) - datetime.timedelta(microseconds=1)
+
+
+def _month_start(date):
+    return date.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def _next_month_start(date):
+    # (Computed by hand rather than with dateutil's relativedelta, which is slow to import)
+    month_start = _month_start(date)
+    if month_start.month == 12:
+        return month_start.replace(year=month_start.year + 1, month=1)
+    return month_start.replace(month=month_start.month + 1)
+
+
+class ArchivePlanner(object):
+    def __init__(self, archives):
+        """
+        Chooses which of a workspace's archives to download to cover a date range.
+
+        Rapid Pro archives each day's records in a daily archive, and rolls up the daily archives of each completed
+        month into a monthly archive, so a month's records may be available from both. The planner indexes the
+        archives by the period they cover, and for each month in a requested range downloads either the month's
+        monthly archive or its daily archives, whichever is smaller, but never both. Daily archives are only chosen
+        when they cover every requested day of the month.
+
+        :param archives: Metadata of all of a workspace's archives of a single type, as returned by
+                         `RapidProClient.list_archives`.
+        :type archives: list of temba_client.v2.types.Archive
+        """
+        self.archives = list(archives)
+
+        # Archives are indexed by start date, so the archives overlapping a range can be found by bisection.
+        self._monthly = sorted([a for a in self.archives if a.period == "monthly"], key=lambda a: a.start_date)
+        self._daily = sorted([a for a in self.archives if a.period == "daily"], key=lambda a: a.start_date)
+        assert len(self._monthly) + len(self._daily) == len(self.archives), "Unknown archive period"
+        self._monthly_start_dates = [a.start_date for a in self._monthly]
+        self._daily_start_dates = [a.start_date for a in self._daily]
+
+    @staticmethod
+    def _overlapping(archives, start_dates, max_duration, range_start_inclusive, range_end_exclusive):
+        """
+        Returns the archives in a list sorted by start date which overlap a date range, given that no archive in the
+        list covers a longer duration than `max_duration`.
+        """
+        lo = 0
+        if range_start_inclusive is not None:
+            lo = bisect.bisect_left(start_dates, range_start_inclusive - max_duration)
+        hi = len(archives)
+        if range_end_exclusive is not None:
+            hi = bisect.bisect_left(start_dates, range_end_exclusive)
+
+        return [a for a in archives[lo:hi]
+                if range_start_inclusive is None or archive_end_date(a) >= range_start_inclusive]
+
+    def archives_overlapping(self, range_start_inclusive=None, range_end_exclusive=None):
+        """
+        :param range_start_inclusive: Start of the date range, or None for the beginning of time.
+        :type range_start_inclusive: datetime.datetime | None
+        :param range_end_exclusive: End of the date range, or None for the end of time.
+        :type range_end_exclusive: datetime.datetime | None
+        :return: Every archive, daily or monthly, which covers part of the date range, in order of start date.
+        :rtype: list of temba_client.v2.types.Archive
+        """
+        return sorted(
+            self._overlapping(self._monthly, self._monthly_start_dates, datetime.timedelta(days=31),
+                              range_start_inclusive, range_end_exclusive) +
+            self._overlapping(self._daily, self._daily_start_dates, datetime.timedelta(days=1),
+                              range_start_inclusive, range_end_exclusive),
+            key=lambda a: (a.start_date, a.period)
+        )
+
+    def plan(self, range_start_inclusive=None, range_end_exclusive=None):
+        """
+        Chooses the smallest set of archives which covers a date range, without downloading any month's records
+        twice.
+
+        :param range_start_inclusive: Start of the date range, or None for the beginning of time.
+        :type range_start_inclusive: datetime.datetime | None
+        :param range_end_exclusive: End of the date range, or None for the end of time.
+        :type range_end_exclusive: datetime.datetime | None
+        :return: The archives to download, in order of start date.
+        :rtype: list of temba_client.v2.types.Archive
+        """
+        monthly_archives = dict()  # of month start -> monthly archive
+        daily_archives = dict()  # of month start -> list of daily archives in that month
+        for archive in self.archives_overlapping(range_start_inclusive, range_end_exclusive):
+            month_start = _month_start(archive.start_date)
+            if archive.period == "monthly":
+                assert month_start not in monthly_archives, f"Multiple monthly archives for {month_start}"
+                monthly_archives[month_start] = archive
+            else:
+                daily_archives.setdefault(month_start, []).append(archive)
+
+        planned = []
+        for month_start in sorted(set(monthly_archives.keys()) | set(daily_archives.keys())):
+            monthly = monthly_archives.get(month_start)
+            dailies = daily_archives.get(month_start, [])
+
+            if monthly is None:
+                planned.extend(dailies)
+                continue
+
+            if self._dailies_cover(dailies, month_start, range_start_inclusive, range_end_exclusive) and \
+                    sum(a.size for a in dailies) < monthly.size:
+                log.debug(f"Using {len(dailies)} daily archives instead of the monthly archive for {month_start}")
+                planned.extend(dailies)
+            else:
+                if len(dailies) > 0:
+                    log.debug(f"Skipping {len(dailies)} daily archives covered by the monthly archive for "
+                              f"{month_start}")
+                planned.append(monthly)
+
+        return planned
+
+    @staticmethod
+    def _dailies_cover(dailies, month_start, range_start_inclusive, range_end_exclusive):
+        """
+        Returns whether the given daily archives cover every day of a month which overlaps a date range.
+        """
+        first_day = month_start
+        if range_start_inclusive is not None and range_start_inclusive > first_day:
+            first_day = range_start_inclusive.astimezone(month_start.tzinfo)\
+                .replace(hour=0, minute=0, second=0, microsecond=0)
+        end = _next_month_start(month_start)
+        if range_end_exclusive is not None and range_end_exclusive < end:
+            end = range_end_exclusive
+
+        daily_start_dates = {a.start_date for a in dailies}
+        day = first_day
+        while day < end:
+            if day not in daily_start_dates:
+                return False
+            day += datetime.timedelta(days=1)
+        return True
@@ -0,0 +1,978 @@
+import asyncio
+import datetime
+import json
+import random
+import tempfile
+import time
+from urllib.parse import urlparse
+
+import aiohttp
+from core_data_modules.logging import Logger
+from temba_client.exceptions import TembaBadRequestError, TembaTokenError, TembaNoSuchObjectError, \
+    TembaRateExceededError, TembaHttpError, TembaConnectionError
+from temba_client.v2 import TembaClient, Archive, Broadcast, Contact, Export, Field, Flow, Group, Message, Org, Run
+
+from rapid_pro_tools.archive_download import ResumableArchiveDownloader, expected_archive_size, resume_offset
+from rapid_pro_tools.archive_planner import ArchivePlanner
+from rapid_pro_tools.flow_index import FlowIndex
+from rapid_pro_tools.raw_export_log import raw_export_log_writer_for
+from rapid_pro_tools.rapid_pro_client import RapidProClient
+
+log = Logger(__name__)
+
+
+class AsyncRapidProClient(object):
+    MAX_RETRIES = 5
+    MAX_BACKOFF_POWER = 6
+    DEFAULT_MAX_CONCURRENT_REQUESTS = 4
+    DEFAULT_MAX_CONCURRENT_ARCHIVE_DOWNLOADS = 2
+    DEFAULT_CONNECT_TIMEOUT = 30
+    DEFAULT_READ_TIMEOUT = 300
+
+    def __init__(self, server, token, max_concurrent_requests=DEFAULT_MAX_CONCURRENT_REQUESTS,
+                 max_concurrent_archive_downloads=DEFAULT_MAX_CONCURRENT_ARCHIVE_DOWNLOADS,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT, read_timeout=DEFAULT_READ_TIMEOUT, metrics=None,
+                 archive_download_dir=None):
+        """
+        An asyncio-native counterpart to `RapidProClient`, for driving many workspaces from one event loop without a
+        thread per request.
+
+        Provides the same read and write methods as `RapidProClient`, as coroutines, plus async iterators over pages
+        of runs, messages and contacts. Requests are made with aiohttp (install with `pip install
+        RapidProTools[async]`), and rate-limit and server-error retries wait with `asyncio.sleep`.
+
+        Create the client inside a running event loop, and close it when finished, either by calling `close` or by
+        using it as an async context manager.
+
+        :param server: Server hostname, e.g. 'rapidpro.io'
+        :type server: str
+        :param token: Organization API token
+        :type token: str
+        :param max_concurrent_requests: Maximum number of requests this client will have in flight at once.
+        :type max_concurrent_requests: int
+        :param max_concurrent_archive_downloads: Maximum number of archives this client will download and deserialize
+                                                 at once. Archive downloads don't count towards
+                                                 `max_concurrent_requests`.
+        :type max_concurrent_archive_downloads: int
+        :param connect_timeout: Seconds to wait when establishing a connection before giving up.
+        :type connect_timeout: float
+        :param read_timeout: Seconds to wait between bytes received from the server before giving up.
+        :type read_timeout: float
+        :param metrics: Metrics to record this client's requests, retries and archive downloads in, or None.
+        :type metrics: rapid_pro_tools.metrics.RapidProMetrics | None
+        :param archive_download_dir: Directory to download archives to before decompressing them. If None, uses the
+                                     system's temporary directory.
+        :type archive_download_dir: str | None
+        """
+        # Reuse TembaClient's url and header construction, so that this client addresses servers identically.
+        temba_client = TembaClient(server, token)
+        self.root_url = temba_client.root_url
+        self.headers = temba_client.headers
+
+        self._timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        self._request_semaphore = asyncio.Semaphore(max_concurrent_requests)
+        self._archive_semaphore = asyncio.Semaphore(max_concurrent_archive_downloads)
+        self.archive_download_dir = archive_download_dir
+        self._session = None
+        self._archive_session = None
+        self._flow_index = None
+        self.metrics = metrics
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def close(self):
+        """
+        Closes this client's HTTP connections.
+        """
+        if self._session is not None:
+            await self._session.close()
+        if self._archive_session is not None:
+            await self._archive_session.close()
+
+    def _get_session(self):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(headers=self.headers, timeout=self._timeout)
+        return self._session
+
+    def _get_archive_session(self):
+        # Archives are downloaded with a separate session that doesn't undo any Content-Encoding, because the archives
+        # themselves are gzipped and are decompressed when they're deserialized.
+        if self._archive_session is None:
+            self._archive_session = aiohttp.ClientSession(timeout=self._timeout, auto_decompress=False)
+        return self._archive_session
+
+    async def _request_once(self, method, url, params=None, body=None):
+        """
+        Makes a request to the given url and returns the parsed JSON, raising the same exceptions as
+        temba_client's request implementation.
+        """
+        status = "connection_error"
+        start = time.perf_counter()
+        try:
+            async with self._request_semaphore, \
+                    self._get_session().request(method, url, params=params, json=body) as response:
+                status = response.status
+                if response.status == 400:
+                    try:
+                        errors = await response.json(content_type=None)
+                    except ValueError:
+                        errors = {"details": [await response.text()]}
+                    raise TembaBadRequestError(errors)
+                elif response.status == 403:
+                    raise TembaTokenError()
+                elif response.status == 404:
+                    raise TembaNoSuchObjectError()
+                elif response.status == 429:
+                    retry_after = response.headers.get("retry-after")
+                    raise TembaRateExceededError(int(retry_after) if retry_after else 0)
+
+                response.raise_for_status()
+
+                content = await response.read()
+                return json.loads(content) if content else None
+        except aiohttp.ClientResponseError as ex:
+            raise TembaHttpError(ex)
+        except aiohttp.ClientConnectionError:
+            raise TembaConnectionError()
+        finally:
+            if self.metrics is not None:
+                endpoint = urlparse(url).path.rstrip("/").split("/")[-1]
+                if endpoint.endswith(".json"):
+                    endpoint = endpoint[:-len(".json")]
+                self.metrics.record_request(method, endpoint, status, time.perf_counter() - start)
+
+    async def _request(self, method, url, params=None, body=None, idempotent=True):
+        """
+        Makes a request to the given url and returns the parsed JSON.
+
+        If the Rapid Pro server fails with a rate exceeded error, or with a 500 or 504 error if the request is
+        idempotent, retries up to self.MAX_RETRIES times using binary exponential backoff, waiting with
+        `asyncio.sleep` between attempts. Requests which create something aren't idempotent, because Rapid Pro may have
+        completed them despite failing with a 500 or 504, so retrying could e.g. send the same broadcast twice.
+        """
+        retries = 0
+        while True:
+            try:
+                return await self._request_once(method, url, params=params, body=body)
+            except TembaRateExceededError as ex:
+                retries += 1
+
+                if retries >= self.MAX_RETRIES or not ex.retry_after:
+                    raise ex
+
+                server_wait_time = ex.retry_after
+                backoff_wait_time = random.uniform(0, 2 ** (min(retries, self.MAX_BACKOFF_POWER)))
+
+                log.debug(f"Rate exceeded. Sleeping for {server_wait_time + backoff_wait_time} seconds")
+                if self.metrics is not None:
+                    self.metrics.record_retry(429)
+                    self.metrics.record_rate_limit_sleep(server_wait_time + backoff_wait_time)
+                await asyncio.sleep(server_wait_time + backoff_wait_time)
+            except TembaHttpError as ex:
+                retries += 1
+
+                if retries >= self.MAX_RETRIES or not idempotent or ex.caused_by.status not in {500, 504}:
+                    raise ex
+
+                # (Don't log the details in the error message, because the detail string contains a URL which may
+                # include a phone number)
+                log.debug(f"TembaHttpError {ex.caused_by.status}, retrying...")
+                if self.metrics is not None:
+                    self.metrics.record_retry(ex.caused_by.status)
+                await asyncio.sleep(random.uniform(0, 2 ** (min(retries, self.MAX_BACKOFF_POWER))))
+
+    def _url(self, endpoint):
+        return f"{self.root_url}/{endpoint}.json"
+
+    async def _get(self, endpoint, **params):
+        return await self._request("get", self._url(endpoint), params=self._build_query_params(**params))
+
+    async def _post(self, endpoint, params=None, payload=None, idempotent=False):
+        return await self._request("post", self._url(endpoint), params=params, body=payload, idempotent=idempotent)
+
+    @staticmethod
+    def _build_query_params(**kwargs):
+        # aiohttp requires query string values to be strings, and takes lists as repeated (key, value) pairs.
+        query_params = []
+        for key, value in TembaClient._build_params(**kwargs).items():
+            for v in (value if isinstance(value, list) else [value]):
+                query_params.append((key, str(v)))
+        return query_params
+
+    async def _iter_pages(self, endpoint, clazz, **params):
+        """
+        Iterates over the pages of results of a cursor-paginated endpoint.
+
+        :return: Async iterator of each page of results.
+        :rtype: async iterator of list of temba_client.serialization.TembaObject
+        """
+        url = self._url(endpoint)
+        query_params = self._build_query_params(**params)
+        while url is not None:
+            response = await self._request("get", url, params=query_params)
+            # The 'next' url includes all the query parameters needed to fetch the next page.
+            url = response["next"]
+            query_params = None
+            if len(response["results"]) == 0:
+                return
+            yield clazz.deserialize_list(response["results"])
+
+    async def _get_all(self, endpoint, clazz, **params):
+        results = []
+        async for page in self._iter_pages(endpoint, clazz, **params):
+            results.extend(page)
+        return results
+
+    async def get_workspace_name(self):
+        """
+        :return: The name of this workspace.
+        :rtype: str
+        """
+        return Org.deserialize(await self._get("org")).name
+
+    async def get_workspace_uuid(self):
+        """
+        :return: The uuid of this workspace.
+        :rtype: str
+        """
+        return Org.deserialize(await self._get("org")).uuid
+
+    async def list_archives(self, archive_type=None):
+        """
+        Lists all of the available archives on this workspace. See `RapidProClient.list_archives`.
+
+        :param archive_type: The type of archives to list (either 'message' or 'run') or None.
+        :type archive_type: str | None
+        :return: List of available archives on this workspace.
+        :rtype: list of temba_client.v2.types.Archive
+        """
+        assert archive_type in {"message", "run"}
+
+        return await self._get_all("archives", Archive, archive_type=archive_type)
+
+    async def get_archive(self, archive_metadata):
+        """
+        Downloads the archive specified by an archive metadata object, and converts it into a valid list of Message
+        or Run objects.
+
+        The archive is downloaded to a temporary file on disk, resuming interrupted downloads and refreshing expired
+        download links as `RapidProClient.get_archive` does. Decompression and deserialization run in the event loop's
+        default executor, so that they don't block other tasks. At most `max_concurrent_archive_downloads` archives
+        are downloaded and deserialized at once.
+
+        :param archive_metadata: Metadata for the archive. To obtain these, see `AsyncRapidProClient.list_archives`.
+        :type archive_metadata: temba_client.v2.types.Archive
+        :return: Data downloaded from the archive.
+        :rtype: list of temba_client.v2.Message | list of temba_client.v2.Run
+        """
+        if archive_metadata.record_count == 0:
+            log.info(f"Skipping empty archive {archive_metadata.start_date} ({archive_metadata.download_url})...")
+            return []
+
+        async with self._archive_semaphore:
+            log.info(f"Downloading {archive_metadata.record_count} records from {archive_metadata.period} archive "
+                     f"{archive_metadata.start_date}...")
+            with tempfile.TemporaryFile(dir=self.archive_download_dir) as archive_file:
+                downloaded_bytes = await self._download_archive(archive_metadata, archive_file)
+
+                archive_file.seek(0)
+                results, decompressed_bytes = await asyncio.get_event_loop().run_in_executor(
+                    None, RapidProClient._deserialize_archive_and_measure, archive_metadata.archive_type, archive_file)
+                assert len(results) == archive_metadata.record_count
+
+                if self.metrics is not None:
+                    self.metrics.record_archive_download(downloaded_bytes, decompressed_bytes)
+
+        return results
+
+    async def _download_archive(self, archive_metadata, f):
+        """
+        Downloads an archive to a file, resuming from where it stopped if the connection fails part way through, and
+        refreshing the download link if it has expired. See `ResumableArchiveDownloader.download`.
+
+        :return: Number of bytes downloaded.
+        :rtype: int
+        """
+        url = archive_metadata.download_url
+        downloaded_bytes = 0
+        attempts = 0
+        while True:
+            attempts += 1
+            headers = {"Range": f"bytes={downloaded_bytes}-"} if downloaded_bytes > 0 else None
+            try:
+                start = time.perf_counter()
+                try:
+                    response = await self._get_archive_session().get(url, headers=headers)
+                except aiohttp.ClientConnectionError:
+                    if self.metrics is not None:
+                        self.metrics.record_request("get", "archive", "connection_error",
+                                                    time.perf_counter() - start)
+                    raise
+                if self.metrics is not None:
+                    self.metrics.record_request("get", "archive", response.status, time.perf_counter() - start)
+
+                async with response:
+                    if response.status == 403:
+                        if attempts >= ResumableArchiveDownloader.MAX_ATTEMPTS:
+                            response.raise_for_status()
+                        log.info(f"Archive download link was rejected, probably because it has expired. "
+                                 f"Refreshing the link and resuming from byte {downloaded_bytes}...")
+                        if self.metrics is not None:
+                            self.metrics.record_retry(403)
+                        url = await self._refresh_archive_download_url(archive_metadata)
+                        continue
+
+                    response.raise_for_status()
+
+                    if downloaded_bytes > 0:
+                        resume_from = resume_offset(response.status, response.headers)
+                        if resume_from == 0:
+                            # The server ignored the Range header and is sending the whole archive, so start again.
+                            log.info("Archive server does not support resuming downloads, restarting the download")
+                        assert resume_from <= downloaded_bytes, "Archive server skipped part of the archive"
+                        f.seek(resume_from)
+                        f.truncate()
+                        downloaded_bytes = resume_from
+
+                    expected_total_bytes = expected_archive_size(response.headers, downloaded_bytes, archive_metadata)
+
+                    async for chunk in response.content.iter_chunked(ResumableArchiveDownloader.CHUNK_SIZE):
+                        f.write(chunk)
+                        downloaded_bytes += len(chunk)
+
+                if downloaded_bytes >= expected_total_bytes:
+                    f.flush()
+                    return downloaded_bytes
+
+                log.info(f"Archive download ended early, after {downloaded_bytes} of {expected_total_bytes} bytes")
+            except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError) as ex:
+                # (Don't log the details of the error, because they include the download url, which contains a
+                # temporary access credential)
+                log.info(f"Archive download failed with {type(ex).__name__} after {downloaded_bytes} bytes")
+
+            if attempts >= ResumableArchiveDownloader.MAX_ATTEMPTS:
+                raise IOError(f"Failed to download archive {archive_metadata.start_date} after {attempts} attempts "
+                              f"({downloaded_bytes} bytes downloaded)")
+
+            if self.metrics is not None:
+                self.metrics.record_retry("archive_interrupted")
+            backoff_seconds = random.uniform(0, 2 ** min(attempts, ResumableArchiveDownloader.MAX_BACKOFF_POWER))
+            log.info(f"Resuming archive download from byte {downloaded_bytes} in {backoff_seconds:.1f} seconds...")
+            await asyncio.sleep(backoff_seconds)
+
+    async def _refresh_archive_download_url(self, archive_metadata):
+        """
+        Lists the archives again, to get a new download link for an archive whose link has expired.
+
+        :param archive_metadata: Metadata of the archive to get a new download link for.
+        :type archive_metadata: temba_client.v2.types.Archive
+        :return: New download link for the archive.
+        :rtype: str
+        """
+        for archive in await self.list_archives(archive_metadata.archive_type):
+            if archive.start_date == archive_metadata.start_date and archive.period == archive_metadata.period:
+                return archive.download_url
+
+        raise KeyError(f"{archive_metadata.period} {archive_metadata.archive_type} archive "
+                       f"{archive_metadata.start_date} is no longer available from Rapid Pro")
+
+    async def _get_archived(self, archive_type, range_start_inclusive, range_end_exclusive, date_key, record_filter):
+        """
+        Downloads, concurrently, the archives of the given type chosen by an `ArchivePlanner` to cover the given date
+        range, and returns the archived records within that range which pass `record_filter`.
+
+        Each archive is filtered as soon as it has been downloaded, so only the records being returned are kept.
+        """
+        archives_to_download = ArchivePlanner(await self.list_archives(archive_type))\
+            .plan(range_start_inclusive, range_end_exclusive)
+
+        async def get_filtered_archive(archive_metadata):
+            return [
+                record for record in await self.get_archive(archive_metadata)
+                if (range_start_inclusive is None or date_key(record) >= range_start_inclusive) and
+                   (range_end_exclusive is None or date_key(record) < range_end_exclusive) and record_filter(record)
+            ]
+
+        records = []
+        for archive in await asyncio.gather(*[get_filtered_archive(a) for a in archives_to_download]):
+            records.extend(archive)
+        return records
+
+    async def _get_flow_index(self, refresh=False):
+        if self._flow_index is None or refresh:
+            log.info("Fetching all flows...")
+            flows = await self._get_all("flows", Flow)
+            log.info(f"Downloaded {len(flows)} flows")
+            self._flow_index = FlowIndex(flows)
+        return self._flow_index
+
+    def invalidate_flow_cache(self):
+        """
+        Discards this client's cached flow list, so that the next flow look-up fetches the latest flows.
+        """
+        self._flow_index = None
+
+    async def get_flow_id(self, flow_name):
+        """
+        Gets the id for the flow with the requested name.
+
+        :param flow_name: Name of flow to retrieve the id of.
+        :type flow_name: str
+        :return: The Rapid Pro id for the given flow name.
+        :rtype: str
+        """
+        was_cached = self._flow_index is not None
+        matching_flows = (await self._get_flow_index()).get_flows_with_name(flow_name)
+        if len(matching_flows) == 0 and was_cached:
+            matching_flows = (await self._get_flow_index(refresh=True)).get_flows_with_name(flow_name)
+
+        if len(matching_flows) == 0:
+            available_flow_names = [f.name for f in self._flow_index.flows]
+            raise KeyError(f"Requested flow not found on RapidPro (Available flows: {', '.join(available_flow_names)})")
+        if len(matching_flows) > 1:
+            raise KeyError("Non-unique flow name")
+
+        return matching_flows[0].uuid
+
+    async def get_flow_ids(self, flow_names):
+        """
+        Gets the ids for a list of flow names.
+
+        :param flow_names: Names of the flows to retrieve the ids of.
+        :type flow_names: list of str
+        :return: The Rapid Pro ids for the given flow names.
+        :rtype: list of str
+        """
+        return [await self.get_flow_id(name) for name in flow_names]
+
+    async def get_all_flow_ids(self):
+        """
+        Gets all the flow ids currently available on this Rapid Pro workspace. See `RapidProClient.get_all_flow_ids`.
+
+        :return: Ids of all flows on this Rapid Pro workspace.
+        :rtype: list of str
+        """
+        return (await self._get_flow_index(refresh=True)).get_all_flow_uuids()
+
+    async def get_flow(self, flow_id):
+        """
+        Gets the flow with the given `flow_id`.
+
+        :param flow_id: Id of the flow to get.
+        :type flow_id: str
+        :return: Flow with id `flow_id`.
+        :rtype: temba_client.v2.types.Flow
+        """
+        flow = (await self._get_flow_index()).get_flow_with_uuid(flow_id)
+        if flow is None:
+            flow = (await self._get_flow_index(refresh=True)).get_flow_with_uuid(flow_id)
+        assert flow is not None, f"Flow '{flow_id}' not found on Rapid Pro"
+        return flow
+
+    async def get_flow_definitions_for_flow_ids(self, flow_ids):
+        """
+        Gets the definitions for the flows with the requested ids from Rapid Pro.
+
+        :param flow_ids: Ids of the flows to export the definitions of.
+        :type flow_ids: list of str
+        :return: An export object containing all of the requested flows, their dependencies, and triggers.
+        :rtype: temba_client.v2.types.Export
+        """
+        return Export.deserialize(await self._get("definitions", flow=list(flow_ids), dependencies="all"))
+
+    def iter_runs(self, flow_id=None, after=None, before=None):
+        """
+        Iterates over the pages of runs in Rapid Pro's production database, newest first.
+
+        :param flow_id: Id of the flow to fetch the runs of. If None, fetches runs from all flows.
+        :type flow_id: str | None
+        :param after: If set, only fetches runs last modified on or after this date.
+        :type after: datetime.datetime | None
+        :param before: If set, only fetches runs last modified on or before this date.
+        :type before: datetime.datetime | None
+        :return: Async iterator of each page of runs.
+        :rtype: async iterator of list of temba_client.v2.types.Run
+        """
+        return self._iter_pages("runs", Run, flow=flow_id, after=after, before=before)
+
+    def iter_messages(self, after=None, before=None):
+        """
+        Iterates over the pages of messages in Rapid Pro's production database, newest first.
+
+        :param after: If set, only fetches messages created on or after this date.
+        :type after: datetime.datetime | None
+        :param before: If set, only fetches messages created on or before this date.
+        :type before: datetime.datetime | None
+        :return: Async iterator of each page of messages.
+        :rtype: async iterator of list of temba_client.v2.types.Message
+        """
+        return self._iter_pages("messages", Message, after=after, before=before)
+
+    def iter_contacts(self, after=None, before=None):
+        """
+        Iterates over the pages of contacts, most recently modified first.
+
+        :param after: If set, only fetches contacts last modified on or after this date.
+        :type after: datetime.datetime | None
+        :param before: If set, only fetches contacts last modified on or before this date.
+        :type before: datetime.datetime | None
+        :return: Async iterator of each page of contacts.
+        :rtype: async iterator of list of temba_client.v2.types.Contact
+        """
+        return self._iter_pages("contacts", Contact, after=after, before=before)
+
+    @staticmethod
+    async def _log_raw_export(raw_data, raw_export_log_file, data_name):
+        if raw_export_log_file is None:
+            log.debug("Not logging the raw export (argument 'raw_export_log_file' was None)")
+            return
+
+        # Writing blocks while the writer's queue is full or while it finishes, so is done in the loop's executor.
+        log.info(f"Logging {len(raw_data)} fetched {data_name}...")
+        writer, owns_writer = raw_export_log_writer_for(raw_export_log_file)
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, writer.write, raw_data)
+        if owns_writer:
+            await loop.run_in_executor(None, writer.close)
+        log.info(f"Logged fetched {data_name}")
+
+    async def get_raw_runs(self, flow_id=None, last_modified_after_inclusive=None, last_modified_before_exclusive=None,
+                           raw_export_log_file=None, ignore_archives=False):
+        """
+        Gets the raw runs for the given flow_id from Rapid Pro's production database and, if needed, from its archives.
+        Archives are downloaded concurrently. See `RapidProClient.get_raw_runs`.
+
+        :param flow_id: Id of the flow to download the runs of. If None, returns runs from all flows.
+        :type flow_id: str | None
+        :param last_modified_after_inclusive: Start of the date-range to download runs from.
+                                              If set, only downloads runs last modified since that date,
+                                              otherwise downloads from the beginning of time.
+        :type last_modified_after_inclusive: datetime.datetime | None
+        :param last_modified_before_exclusive: End of the date-range to download runs from.
+                                               If set, only downloads runs last modified before that date,
+                                               otherwise downloads until the end of time.
+        :type last_modified_before_exclusive: datetime.datetime | None
+        :param raw_export_log_file: File or RawExportLogWriter to log the raw data downloaded during this function
+                                    call to, as JSONL.
+        :type raw_export_log_file: rapid_pro_tools.raw_export_log.RawExportLogWriter | file-like | None
+        :param ignore_archives: If True, skips downloading runs from Rapid Pro's archives.
+        :type ignore_archives: bool
+        :return: Raw runs downloaded from Rapid Pro, in ascending order of modification date.
+        :rtype: list of temba_client.v2.types.Run
+        """
+        log.info(f"Fetching raw runs {'from all flows' if flow_id is None else f'from flow with id {flow_id}'}...")
+
+        last_modified_before_inclusive = None
+        if last_modified_before_exclusive is not None:
+            last_modified_before_inclusive = last_modified_before_exclusive - datetime.timedelta(microseconds=1)
+
+        if ignore_archives:
+            archived_runs = []
+        else:
+            archived_runs = await self._get_archived(
+                "run", last_modified_after_inclusive, last_modified_before_exclusive, lambda run: run.modified_on,
+                lambda run: flow_id is None or run.flow.uuid == flow_id
+            )
+
+        production_runs = []
+        async for page in self.iter_runs(flow_id, last_modified_after_inclusive, last_modified_before_inclusive):
+            production_runs.extend(page)
+
+        raw_runs = archived_runs + production_runs
+        log.info(f"Fetched {len(raw_runs)} runs ({len(archived_runs)} from archives, "
+                 f"{len(production_runs)} from production)")
+
+        seen_run_ids = set()
+        for run in raw_runs:
+            assert run.id not in seen_run_ids, f"Duplicate run {run.id} found in the downloaded data. This could be " \
+                                               f"because a run with this id exists in both the archives and the " \
+                                               f"production database."
+            seen_run_ids.add(run.id)
+
+        await self._log_raw_export(raw_runs, raw_export_log_file, "runs")
+
+        # Sort in ascending order of modification date
+        raw_runs.sort(key=lambda run: run.modified_on)
+        return raw_runs
+
+    async def get_raw_messages(self, created_after_inclusive=None, created_before_exclusive=None,
+                               raw_export_log_file=None, ignore_archives=False):
+        """
+        Gets the raw messages from Rapid Pro's production database and, if needed, from its archives.
+        Archives are downloaded concurrently. See `RapidProClient.get_raw_messages`.
+
+        :param created_after_inclusive: Start of the date-range to download messages from.
+                                        If set, only downloads messages created on Rapid Pro since that date,
+                                        otherwise downloads from the beginning of time.
+        :type created_after_inclusive: datetime.datetime | None
+        :param created_before_exclusive: End of the date-range to download messages from.
+                                         If set, only downloads messages created on Rapid Pro before that date,
+                                         otherwise downloads until the end of time.
+        :type created_before_exclusive: datetime.datetime | None
+        :param raw_export_log_file: File or RawExportLogWriter to log the raw data downloaded during this function
+                                    call to, as JSONL.
+        :type raw_export_log_file: rapid_pro_tools.raw_export_log.RawExportLogWriter | file-like | None
+        :param ignore_archives: If True, skips downloading messages from Rapid Pro's archives.
+        :type ignore_archives: bool
+        :return: Raw messages downloaded from Rapid Pro, in ascending order of creation date.
+        :rtype: list of temba_client.v2.types.Message
+        """
+        log.info(f"Fetching raw messages...")
+
+        created_before_inclusive = None
+        if created_before_exclusive is not None:
+            created_before_inclusive = created_before_exclusive - datetime.timedelta(microseconds=1)
+
+        if ignore_archives:
+            archived_messages = []
+        else:
+            archived_messages = await self._get_archived(
+                "message", created_after_inclusive, created_before_exclusive, lambda message: message.modified_on,
+                lambda message: True
+            )
+
+        production_messages = []
+        async for page in self.iter_messages(created_after_inclusive, created_before_inclusive):
+            production_messages.extend(page)
+
+        raw_messages = archived_messages + production_messages
+        log.info(f"Fetched {len(raw_messages)} messages ({len(archived_messages)} from archives, "
+                 f"{len(production_messages)} from production)")
+
+        seen_message_ids = set()
+        for message in raw_messages:
+            assert message.id not in seen_message_ids, f"Duplicate message {message.id} found in the downloaded " \
+                                                       f"data. This could be because a message with this id " \
+                                                       f"exists in both the archives and the production database."
+            seen_message_ids.add(message.id)
+
+        await self._log_raw_export(raw_messages, raw_export_log_file, "messages")
+
+        # Sort in ascending order of creation date
+        raw_messages.reverse()
+        return raw_messages
+
+    async def get_raw_contacts(self, last_modified_after_inclusive=None, last_modified_before_exclusive=None,
+                               raw_export_log_file=None):
+        """
+        Gets the raw contacts from Rapid Pro. See `RapidProClient.get_raw_contacts`.
+
+        :param last_modified_after_inclusive: Start of the date-range to download contacts from.
+                                              If set, only downloads contacts last modified since that date,
+                                              otherwise downloads from the beginning of time.
+        :type last_modified_after_inclusive: datetime.datetime | None
+        :param last_modified_before_exclusive: End of the date-range to download contacts from.
+                                               If set, only downloads contacts last modified before that date,
+                                               otherwise downloads until the end of time.
+        :type last_modified_before_exclusive: datetime.datetime | None
+        :param raw_export_log_file: File or RawExportLogWriter to log the raw data downloaded during this function
+                                    call to, as JSONL.
+        :type raw_export_log_file: rapid_pro_tools.raw_export_log.RawExportLogWriter | file-like | None
+        :return: Raw contacts downloaded from Rapid Pro, in ascending order of modification date.
+        :rtype: list of temba_client.v2.types.Contact
+        """
+        log.info(f"Fetching raw contacts...")
+
+        last_modified_before_inclusive = None
+        if last_modified_before_exclusive is not None:
+            last_modified_before_inclusive = last_modified_before_exclusive - datetime.timedelta(microseconds=1)
+
+        raw_contacts = []
+        async for page in self.iter_contacts(last_modified_after_inclusive, last_modified_before_inclusive):
+            raw_contacts.extend(page)
+        assert len(set(c.uuid for c in raw_contacts)) == len(raw_contacts), "Non-unique contact UUID in RapidPro"
+
+        log.info(f"Fetched {len(raw_contacts)} contacts")
+        await self._log_raw_export(raw_contacts, raw_export_log_file, "contacts")
+
+        # Sort in ascending order of modification date
+        raw_contacts.reverse()
+        return raw_contacts
+
+    async def update_raw_data_with_latest_modified(self, get_fn, id_key, prev_raw_data=None,
+                                                   raw_export_log_file=None):
+        """
+        Updates a list of raw objects downloaded from Rapid Pro, by only downloading objects which have been
+        updated since that previous export was performed. See `RapidProClient.update_raw_data_with_latest_modified`.
+
+        :param get_fn: Coroutine function to call to retrieve the newer objects.
+        :type get_fn: coroutine function of (last_modified_after_inclusive, raw_export_log_file) ->
+                          list of temba_client.serialization.TembaObject
+        :param id_key: A function that returns an id for each object.
+        :type id_key: function of temba_client.serialization.TembaObject -> hashable
+        :param prev_raw_data: List of Rapid Pro objects from a previous export, or None.
+                              If None, all objects will be downloaded.
+        :type prev_raw_data: list of temba_client.serialization.TembaObject | None
+        :param raw_export_log_file: File or RawExportLogWriter to log raw data fetched during the export to.
+        :type raw_export_log_file: rapid_pro_tools.raw_export_log.RawExportLogWriter | file-like | None
+        :return: Updated list of Rapid Pro objects.
+        :rtype: list of temba_client.serialization.TembaObject
+        """
+        prev_raw_data = [] if prev_raw_data is None else list(prev_raw_data)
+
+        last_modified_after_inclusive = None
+        if len(prev_raw_data) > 0:
+            prev_raw_data.sort(key=lambda obj: obj.modified_on)
+            last_modified_after_inclusive = prev_raw_data[-1].modified_on + datetime.timedelta(microseconds=1)
+
+        new_data = await get_fn(last_modified_after_inclusive=last_modified_after_inclusive,
+                                raw_export_log_file=raw_export_log_file)
+
+        return RapidProClient.filter_latest(prev_raw_data + new_data, id_key)
+
+    async def update_raw_contacts_with_latest_modified(self, prev_raw_contacts=None, raw_export_log_file=None):
+        """
+        Updates a list of contacts previously downloaded from Rapid Pro, by only fetching contacts which have been
+        updated since that previous export was performed.
+
+        :param prev_raw_contacts: A list of Rapid Pro contact objects from a previous export, or None.
+                                  If None, all contacts will be downloaded.
+        :type prev_raw_contacts: list of temba_client.v2.types.Contact | None
+        :param raw_export_log_file: File or RawExportLogWriter to log the newly retrieved contacts to.
+        :type raw_export_log_file: rapid_pro_tools.raw_export_log.RawExportLogWriter | file-like | None
+        :return: Updated list of Rapid Pro Contact objects.
+        :rtype: list of temba_client.v2.types.Contact
+        """
+        return await self.update_raw_data_with_latest_modified(
+            self.get_raw_contacts, lambda contact: contact.uuid,
+            prev_raw_data=prev_raw_contacts, raw_export_log_file=raw_export_log_file
+        )
+
+    async def update_raw_runs_with_latest_modified(self, flow_id, prev_raw_runs=None, raw_export_log_file=None,
+                                                   ignore_archives=False):
+        """
+        Updates a list of runs previously downloaded from Rapid Pro, by only fetching runs which have been
+        updated since that previous export was performed.
+
+        :param flow_id: Id of flow to update.
+        :type flow_id: str
+        :param prev_raw_runs: A list of Rapid Pro run objects from a previous export, or None.
+                              If None, all runs for the specified flow will be downloaded.
+        :type prev_raw_runs: list of temba_client.v2.types.Run | None
+        :param raw_export_log_file: File or RawExportLogWriter to log the newly retrieved runs to.
+        :type raw_export_log_file: rapid_pro_tools.raw_export_log.RawExportLogWriter | file-like | None
+        :param ignore_archives: If True, skips downloading runs from Rapid Pro's archives.
+        :type ignore_archives: bool
+        :return: Updated list of Rapid Pro Run objects.
+        :rtype: list of temba_client.v2.types.Run
+        """
+        async def get_fn(**kwargs):
+            return await self.get_raw_runs(flow_id, ignore_archives=ignore_archives, **kwargs)
+
+        return await self.update_raw_data_with_latest_modified(
+            get_fn, lambda run: run.id, prev_raw_data=prev_raw_runs, raw_export_log_file=raw_export_log_file
+        )
+
+    async def interrupt_urns(self, urns):
+        """
+        Interrupts the given URNs from the flows they are currently in, if any.
+
+        If the list of URNs contains more than 100 items, requests will be made in batches of 100 URNs at a time.
+
+        :param urns: URNs to interrupt
+        :type urns: list of str
+        """
+        log.info(f"Interrupting {len(urns)} URNs...")
+        for i in range(0, len(urns), 100):  # limit of 100 imposed by Rapid Pro's API
+            batch = urns[i:i + 100]
+            await self._post("contact_actions", payload=TembaClient._build_params(contacts=batch, action="interrupt"),
+                             idempotent=True)
+            log.info(f"Interrupted {i + len(batch)} / {len(urns)} URNs")
+
+    async def send_message_to_urn(self, message, target_urn, interrupt=False):
+        """
+        Sends a message to the given URN.
+
+        :param message: Text of the message to send.
+        :type message: str
+        :param target_urn: URN to send the message to.
+        :type target_urn: str
+        :param interrupt: Whether to interrupt the target_urn from flows before sending the message.
+        :type interrupt: bool
+        :return: Id of the Rapid Pro broadcast created for this send request.
+        :rtype: int
+        """
+        return (await self.send_message_to_urns(message, [target_urn], interrupt=interrupt))[0]
+
+    async def send_message_to_urns(self, message, target_urns, interrupt=False):
+        """
+        Sends a message to URNs, in batches of 100 URNs per broadcast.
+
+        :param message: Text of the message to send.
+        :type message: str
+        :param target_urns: URNs to send the message to.
+        :type target_urns: list of str
+        :param interrupt: Whether to interrupt the target_urns from flows before sending the message.
+        :type interrupt: bool
+        :return: Ids of the Rapid Pro broadcasts created for this send request.
+        :rtype: list of int
+        """
+        log.info(f"Sending a message to {len(target_urns)} URNs...")
+        broadcast_ids = []
+        for i in range(0, len(target_urns), 100):  # limit of 100 imposed by Rapid Pro's API
+            batch = target_urns[i:i + 100]
+            if interrupt:
+                await self.interrupt_urns(batch)
+            response = await self._post("broadcasts", payload=TembaClient._build_params(text=message, urns=batch))
+            broadcast_ids.append(Broadcast.deserialize(response).id)
+            log.info(f"Sent {i + len(batch)} / {len(target_urns)} URNs")
+
+        log.info(f"Message send request created with broadcast ids {broadcast_ids}")
+        return broadcast_ids
+
+    async def get_broadcast_for_broadcast_id(self, broadcast_id):
+        """
+        Gets the broadcast with the requested id from Rapid Pro.
+
+        :param broadcast_id: Id of broadcast to download from Rapid Pro
+        :type broadcast_id: int
+        :return: Broadcast with id 'broadcast_id'
+        :rtype: temba_client.v2.Broadcast
+        """
+        matching_broadcasts = await self._get_all("broadcasts", Broadcast, id=broadcast_id)
+        assert len(matching_broadcasts) == 1, f"{len(matching_broadcasts)} broadcasts have id {broadcast_id} " \
+            f"(expected exactly 1)"
+        return matching_broadcasts[0]
+
+    async def get_fields(self):
+        """
+        Fetches all the contact fields.
+
+        :return: All contact fields.
+        :rtype: list of temba_client.v2.types.Field
+        """
+        return await self._get_all("fields", Field)
+
+    async def create_field(self, label, field_id=None):
+        """
+        Creates a contact field with the given label. See `RapidProClient.create_field`.
+
+        :param label: The name of the contact field to create.
+        :type label: str
+        :param field_id: The id to request Rapid Pro to use for the new contact field. This must be in a format
+                         which Rapid Pro will accept, otherwise the created id may differ and this function will
+                         fail.
+        :type field_id: str
+        :return: The contact field that was just created.
+        :rtype: temba_client.v2.types.Field
+        """
+        if field_id is None:
+            log.info(f"Creating field with label '{label}'...")
+            field = Field.deserialize(
+                await self._post("fields", payload=TembaClient._build_params(label=label, value_type="text")))
+            log.info(f"Created field with id '{field.key}'")
+            return field
+
+        # Rapid Pro allows fields to be overwritten if they already exist.
+        # Check if the requested field id exists, and fail if it does.
+        fields = [f for f in await self.get_fields() if f.key == field_id]
+        assert len(fields) == 0, f"Field with id '{field_id}' already exists in workspace"
+
+        # Create a field with the requested id by setting the label to the field id, then relabel it. See
+        # `RapidProClient._create_field_with_id`.
+        initial_label = field_id.replace("_", " ").lower()
+        log.info(f"Creating field with label '{initial_label}', to ensure the field id is '{field_id}'...")
+        field = Field.deserialize(
+            await self._post("fields", payload=TembaClient._build_params(label=initial_label, value_type="text")))
+        log.info(f"Created field with id '{field.key}'")
+        assert field.key == field_id, \
+            f"The field id created by Rapid Pro, '{field.key}', differs from the requested id " \
+            f"'{field_id}'. Please clean up the problematic field in Rapid Pro, and try again making sure " \
+            f"you request a valid id."
+
+        if field.label != label:
+            field = await self.update_field(field.key, label, field.value_type)
+        log.info(f"Done. Created field with label '{field.label}' and id '{field.key}'")
+
+        return field
+
+    async def update_field(self, field_id, label, value_type=None):
+        """
+        Updates the label of an existing contact field.
+
+        :param field_id: Id of the contact field to update.
+        :type field_id: str
+        :param label: New label for the contact field.
+        :type label: str
+        :param value_type: Value type for the contact field, e.g. 'text' or 'numeric'. If None, keeps the field's
+                           current value type, which is fetched from Rapid Pro.
+        :type value_type: str | None
+        :return: The updated contact field.
+        :rtype: temba_client.v2.types.Field
+        """
+        if value_type is None:
+            fields = await self._get_all("fields", Field, key=field_id)
+            assert len(fields) == 1, f"Field with id '{field_id}' does not exist in workspace"
+            value_type = fields[0].value_type
+
+        return Field.deserialize(await self._post(
+            "fields", params={"key": field_id}, payload=TembaClient._build_params(label=label, value_type=value_type),
+            idempotent=True))
+
+    async def get_groups(self, uuid=None, name=None):
+        """
+        Gets all matching contact groups from a rapid_pro workspace
+
+        :param uuid: group UUID to filter on. If None, returns all groups in the workspace.
+        :type uuid: str | None
+        :param name: group name to filter on. If None, returns all groups in the workspace.
+        :type name: str | None
+        :return: List of groups matching the group query
+        :rtype: list of temba_client.v2.types.Group
+        """
+        return await self._get_all("groups", Group, uuid=uuid, name=name)
+
+    async def create_group(self, name):
+        """
+        Creates a contact group with the given name.
+
+        :param name: Name of the group to create.
+        :type name: str
+        :return: The group that was just created.
+        :rtype: temba_client.v2.types.Group
+        """
+        return Group.deserialize(await self._post("groups", payload=TembaClient._build_params(name=name)))
+
+    async def update_contact(self, urn, name=None, contact_fields=None, groups=None):
+        """
+        Updates a contact on the server.
+
+        :param urn: URN of the contact to update.
+        :type urn: str
+        :param name: Name to update to or None. If None, the contact's name is not updated.
+        :type name: str | None
+        :param contact_fields: Dictionary of field key to new field value | None. If None, no keys are updated.
+                               Keys present on the server contact but not in this dictionary are left unchanged.
+        :type contact_fields: (dict of str -> str) | None
+        :param groups: list of group objects or UUIDs. This will overwrite the groups in rapid_pro.
+        :type groups: list | None
+        :return: The updated contact.
+        :rtype: temba_client.v2.types.Contact
+        """
+        payload = TembaClient._build_params(name=name, fields=contact_fields, groups=groups)
+        return Contact.deserialize(await self._post("contacts", params={"urn": urn}, payload=payload, idempotent=True))
+
+    async def create_contact(self, name=None, language=None, urns=None, contact_fields=None, groups=None):
+        """
+        Creates a new contact.
+
+        :param name: full name of the contact
+        :type name: str | None
+        :param language: contact language code, e.g. 'eng'
+        :type language: str | None
+        :param urns: list of URN strings
+        :type urns: list of str | None
+        :param contact_fields: dictionary of contact field key -> value
+        :type contact_fields: (dict of str -> str) | None
+        :param groups: list of group objects, UUIDs or names
+        :type groups: list | None
+        :return: the new contact
+        :rtype: temba_client.v2.types.Contact
+        """
+        payload = TembaClient._build_params(name=name, language=language, urns=urns, fields=contact_fields,
+                                            groups=groups)
+        return Contact.deserialize(await self._post("contacts", payload=payload))
@@ -0,0 +1,142 @@
+import time
+
+from core_data_modules.logging import Logger
+
+log = Logger(__name__)
+
+
+class BroadcastStatusTracker(object):
+    # Broadcast statuses after which a broadcast's status won't change again. Older versions of Rapid Pro finish
+    # broadcasts with 'sent', newer versions with 'completed'.
+    TERMINAL_STATUSES = {"sent", "completed", "failed", "interrupted"}
+
+    DEFAULT_MIN_POLL_INTERVAL_SECONDS = 2
+    DEFAULT_MAX_POLL_INTERVAL_SECONDS = 60
+
+    def __init__(self, rapid_pro, broadcast_ids, min_poll_interval_seconds=DEFAULT_MIN_POLL_INTERVAL_SECONDS,
+                 max_poll_interval_seconds=DEFAULT_MAX_POLL_INTERVAL_SECONDS):
+        """
+        Tracks the statuses of many broadcasts, e.g. those created by `RapidProClient.send_message_to_urns`, until
+        they have all finished.
+
+        Each poll fetches the workspace's broadcasts with a single paginated query, newest first, and picks out the
+        tracked broadcasts which haven't finished yet, stopping as soon as all of them have been seen. After the first
+        poll, the query only fetches broadcasts created since the oldest unfinished tracked broadcast, so the number
+        of requests per poll depends on how many broadcasts were sent around the same time, not on how many are
+        being tracked. Broadcasts which reach a terminal status are not polled again. Between polls,
+        `wait_until_finished` waits `min_poll_interval_seconds`, doubling the wait after each poll in which no
+        broadcast's status changed, up to `max_poll_interval_seconds`, so that slow sends aren't polled more than
+        necessary.
+
+        :param rapid_pro: Client of the workspace the broadcasts were sent from.
+        :type rapid_pro: rapid_pro_tools.rapid_pro_client.RapidProClient
+        :param broadcast_ids: Ids of the broadcasts to track.
+        :type broadcast_ids: iterable of int
+        :param min_poll_interval_seconds: Number of seconds to wait between polls while broadcasts' statuses are
+                                          changing.
+        :type min_poll_interval_seconds: float
+        :param max_poll_interval_seconds: Maximum number of seconds to wait between polls.
+        :type max_poll_interval_seconds: float
+        """
+        self.rapid_pro = rapid_pro
+        self.min_poll_interval_seconds = min_poll_interval_seconds
+        self.max_poll_interval_seconds = max_poll_interval_seconds
+
+        self.statuses = {broadcast_id: None for broadcast_id in broadcast_ids}  # of broadcast id -> latest status
+        self._created_on = dict()  # of broadcast id -> creation date, for the broadcasts polled so far
+
+    @property
+    def pending_broadcast_ids(self):
+        """
+        :return: Ids of the broadcasts which haven't reached a terminal status yet.
+        :rtype: list of int
+        """
+        return [broadcast_id for broadcast_id, status in self.statuses.items()
+                if status not in self.TERMINAL_STATUSES]
+
+    @property
+    def status_counts(self):
+        """
+        :return: Dictionary of status -> number of tracked broadcasts with that status. Broadcasts which haven't been
+                 polled yet have status None.
+        :rtype: dict of (str | None) -> int
+        """
+        counts = dict()
+        for status in self.statuses.values():
+            counts[status] = counts.get(status, 0) + 1
+        return counts
+
+    def is_finished(self):
+        """
+        :return: Whether all the tracked broadcasts have reached a terminal status.
+        :rtype: bool
+        """
+        return len(self.pending_broadcast_ids) == 0
+
+    def poll(self):
+        """
+        Fetches the latest status of each broadcast which hasn't finished yet.
+
+        :return: Number of broadcasts whose status changed.
+        :rtype: int
+        """
+        pending_broadcast_ids = set(self.pending_broadcast_ids)
+        if len(pending_broadcast_ids) == 0:
+            return 0
+
+        created_after_inclusive = None
+        if all(broadcast_id in self._created_on for broadcast_id in pending_broadcast_ids):
+            created_after_inclusive = min(self._created_on[broadcast_id] for broadcast_id in pending_broadcast_ids)
+
+        changed = 0
+        polled_broadcast_ids = set()
+        for page in self.rapid_pro.iter_broadcasts(created_after_inclusive):
+            for broadcast in page:
+                if broadcast.id not in pending_broadcast_ids:
+                    continue
+                polled_broadcast_ids.add(broadcast.id)
+                self._created_on[broadcast.id] = broadcast.created_on
+                if broadcast.status != self.statuses[broadcast.id]:
+                    self.statuses[broadcast.id] = broadcast.status
+                    changed += 1
+            log.debug(f"Polled {len(polled_broadcast_ids)}/{len(pending_broadcast_ids)} pending broadcasts")
+            if len(polled_broadcast_ids) == len(pending_broadcast_ids):
+                break
+
+        missing_broadcast_ids = pending_broadcast_ids - polled_broadcast_ids
+        assert len(missing_broadcast_ids) == 0, f"{len(missing_broadcast_ids)} broadcasts not found on Rapid Pro, " \
+                                                f"including {min(missing_broadcast_ids)}"
+
+        return changed
+
+    def wait_until_finished(self, timeout_seconds=None):
+        """
+        Polls the broadcasts until they have all reached a terminal status.
+
+        :param timeout_seconds: Maximum number of seconds to wait, or None to wait for as long as it takes.
+        :type timeout_seconds: float | None
+        :return: Dictionary of status -> number of tracked broadcasts with that status, when all the broadcasts
+                 finished or the timeout expired.
+        :rtype: dict of (str | None) -> int
+        """
+        log.info(f"Waiting for {len(self.statuses)} broadcasts to finish...")
+        start = time.monotonic()
+        poll_interval_seconds = self.min_poll_interval_seconds
+        while True:
+            changed = self.poll()
+            log.info(f"Broadcast statuses: {self.status_counts} ({len(self.pending_broadcast_ids)} pending)")
+            if self.is_finished():
+                break
+
+            if changed > 0:
+                poll_interval_seconds = self.min_poll_interval_seconds
+            else:
+                poll_interval_seconds = min(poll_interval_seconds * 2, self.max_poll_interval_seconds)
+
+            if timeout_seconds is not None and time.monotonic() - start + poll_interval_seconds > timeout_seconds:
+                log.warning(f"Timed out waiting for broadcasts to finish, with "
+                            f"{len(self.pending_broadcast_ids)} still pending")
+                break
+            time.sleep(poll_interval_seconds)
+
+        return self.status_counts
@@ -0,0 +1,72 @@
+import threading
+import time
+
+
+class CachedValue(object):
+    def __init__(self, fetch_fn, ttl=None):
+        """
+        Lazily fetches a value on first access, and caches it for subsequent accesses.
+
+        :param fetch_fn: Function which fetches the latest version of the value when called.
+        :type fetch_fn: function of () -> any
+        :param ttl: Number of seconds to cache the value for before re-fetching it on the next access.
+                    If None, the value is cached until explicitly invalidated.
+        :type ttl: float | None
+        """
+        self.fetch_fn = fetch_fn
+        self.ttl = ttl
+
+        self._lock = threading.RLock()
+        self._value = None
+        self._fetched_at = None
+
+    def is_fresh(self):
+        """
+        :return: Whether a value is cached and has not yet expired.
+        :rtype: bool
+        """
+        with self._lock:
+            if self._fetched_at is None:
+                return False
+            return self.ttl is None or time.monotonic() - self._fetched_at < self.ttl
+
+    def get(self):
+        """
+        :return: The cached value, fetching it first if there is no cached value or the cached value has expired.
+        :rtype: any
+        """
+        with self._lock:
+            if not self.is_fresh():
+                self.set(self.fetch_fn())
+            return self._value
+
+    def set(self, value):
+        """
+        Replaces the cached value, for example with a value that is known to be newer following a write.
+
+        :param value: Value to cache.
+        :type value: any
+        """
+        with self._lock:
+            self._value = value
+            self._fetched_at = time.monotonic()
+
+    def update_if_cached(self, update_fn):
+        """
+        Applies an update to the cached value, if there is a fresh cached value. If there isn't, does nothing, because
+        the update will be reflected when the value is next fetched.
+
+        :param update_fn: Function which, given the current cached value, returns the updated value.
+        :type update_fn: function of any -> any
+        """
+        with self._lock:
+            if self.is_fresh():
+                self._value = update_fn(self._value)
+
+    def invalidate(self):
+        """
+        Discards the cached value, so that it is fetched again on the next access.
+        """
+        with self._lock:
+            self._value = None
+            self._fetched_at = None
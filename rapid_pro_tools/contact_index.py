@@ -0,0 +1,123 @@
+import json
+import os
+
+from core_data_modules.logging import Logger
+from temba_client.v2 import Contact
+
+log = Logger(__name__)
+
+
+class ContactIndex(object):
+    def __init__(self, file_path=None):
+        """
+        A local copy of a workspace's contacts, indexed by contact UUID and by every URN, for resolving many URNs or
+        UUIDs to contacts without making any requests to Rapid Pro.
+
+        The index is brought up to date with `update`, which only fetches the contacts modified since the most
+        recently modified contact already in the index, and removes contacts deleted since then. If the index has a
+        file, the contacts are loaded from it on construction and saved to it after each update, as JSONL, so that
+        the index stays warm between runs.
+
+        :param file_path: Path to the JSONL file to persist the index in, or None to keep the index in memory only.
+        :type file_path: str | None
+        """
+        self.file_path = file_path
+        self.contacts_lut = dict()  # of contact UUID -> contact
+        self._urn_to_uuid = dict()  # of URN -> contact UUID
+
+        contacts = []
+        if file_path is not None and os.path.exists(file_path):
+            with open(file_path) as f:
+                contacts = [Contact.deserialize(json.loads(line)) for line in f]
+            log.info(f"Loaded {len(contacts)} contacts from the contact index at '{file_path}'")
+        self._rebuild(contacts)
+
+    def _rebuild(self, contacts):
+        # Index in ascending order of modification date, so that if a URN has moved between contacts, it resolves
+        # to the contact which most recently had it.
+        contacts = sorted(contacts, key=lambda contact: contact.modified_on)
+        self.contacts_lut = {contact.uuid: contact for contact in contacts}
+        self._urn_to_uuid = dict()
+        for contact in contacts:
+            for urn in contact.urns:
+                self._urn_to_uuid[urn] = contact.uuid
+
+    def __len__(self):
+        return len(self.contacts_lut)
+
+    @property
+    def latest_modified_on(self):
+        """
+        :return: Modification date of the most recently modified contact in the index, or None if the index is empty.
+        :rtype: datetime.datetime | None
+        """
+        if len(self.contacts_lut) == 0:
+            return None
+        return max(contact.modified_on for contact in self.contacts_lut.values())
+
+    def update(self, rapid_pro, raw_export_log_file=None):
+        """
+        Fetches the contacts which have been modified or deleted since this index was last updated, and saves the
+        updated index to its file, if it has one.
+
+        :param rapid_pro: Client of the workspace to update from.
+        :type rapid_pro: rapid_pro_tools.rapid_pro_client.RapidProClient
+        :param raw_export_log_file: File or RawExportLogWriter to log the newly fetched contacts to.
+        :type raw_export_log_file: rapid_pro_tools.raw_export_log.RawExportLogWriter | file-like | None
+        """
+        prev_latest_modified_on = self.latest_modified_on
+        contacts = rapid_pro.update_raw_contacts_with_latest_modified(
+            prev_raw_contacts=list(self.contacts_lut.values()), raw_export_log_file=raw_export_log_file
+        )
+
+        if prev_latest_modified_on is not None:
+            deleted_uuids = {contact.uuid for contact in rapid_pro.get_contacts(deleted=True,
+                                                                                  after=prev_latest_modified_on)}
+            if len(deleted_uuids) > 0:
+                log.info(f"Removing {len(deleted_uuids)} deleted contacts from the contact index")
+                contacts = [contact for contact in contacts if contact.uuid not in deleted_uuids]
+
+        self._rebuild(contacts)
+        log.info(f"Updated the contact index, which now has {len(self.contacts_lut)} contacts and "
+                 f"{len(self._urn_to_uuid)} URNs")
+
+        if self.file_path is not None:
+            self.save()
+
+    def save(self):
+        """
+        Writes the index to its file, replacing the file atomically.
+        """
+        assert self.file_path is not None, "Can't save a contact index which has no file"
+        temp_file_path = f"{self.file_path}.{os.getpid()}.tmp"
+        with open(temp_file_path, "w") as f:
+            for contact in sorted(self.contacts_lut.values(), key=lambda contact: contact.modified_on):
+                f.write(json.dumps(contact.serialize()) + "\n")
+        os.replace(temp_file_path, self.file_path)
+
+    def resolve_urns(self, urns):
+        """
+        Looks up the contacts which have each of the given URNs.
+
+        :param urns: URNs to resolve, e.g. 'tel:+254700000000'.
+        :type urns: iterable of str
+        :return: Dictionary of URN -> contact, for each of the given URNs which belongs to a contact in the index.
+        :rtype: dict of str -> temba_client.v2.types.Contact
+        """
+        results = dict()
+        for urn in urns:
+            contact_uuid = self._urn_to_uuid.get(urn)
+            if contact_uuid is not None:
+                results[urn] = self.contacts_lut[contact_uuid]
+        return results
+
+    def contacts_by_uuid(self, uuids):
+        """
+        Looks up contacts by UUID.
+
+        :param uuids: UUIDs of the contacts to look up.
+        :type uuids: iterable of str
+        :return: Dictionary of contact UUID -> contact, for each of the given UUIDs which is in the index.
+        :rtype: dict of str -> temba_client.v2.types.Contact
+        """
+        return {uuid: self.contacts_lut[uuid] for uuid in uuids if uuid in self.contacts_lut}
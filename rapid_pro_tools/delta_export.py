@@ -0,0 +1,198 @@
+"""
+Support for incremental exports of a Rapid Pro workspace, as made by `RapidProClient.export_all_data` with
+`delta=True`.
+
+A full export writes a snapshot of every endpoint to the export directory, and records a watermark for each
+incremental endpoint: the latest modification (or creation) date of the records exported from it. A delta export
+then fetches only the records of the incremental endpoints dated after their watermarks, and writes them, with full
+copies of the other (small) endpoints, as a new segment in `<export-dir>/deltas/<segment>/`. `compact` merges the
+segments back into the snapshot.
+
+To compact an export directory from the command line:
+
+    $ python -m rapid_pro_tools.delta_export <export-dir-path>
+"""
+import argparse
+import datetime
+import json
+import os
+import shutil
+
+from core_data_modules.logging import Logger
+from temba_client.utils import format_iso8601, parse_iso8601
+
+log = Logger(__name__)
+
+WATERMARKS_FILE_NAME = "watermarks.json"
+DELTAS_DIR_NAME = "deltas"
+
+# Endpoints which can be fetched incrementally, with the field they can be filtered on with `after`, the field which
+# identifies each record, and whether the exported records are in ascending order of the date field (otherwise they
+# are in the descending order Rapid Pro's API returns them in).
+INCREMENTAL_ENDPOINTS = {
+    "broadcasts": {"date_key": "created_on", "id_key": "id", "ascending": False},
+    "channel_events": {"date_key": "created_on", "id_key": "id", "ascending": False},
+    "contacts": {"date_key": "modified_on", "id_key": "uuid", "ascending": False},
+    "messages": {"date_key": "created_on", "id_key": "id", "ascending": True},
+    "runs": {"date_key": "modified_on", "id_key": "id", "ascending": True}
+}
+
+
+def _write_json_atomically(data, file_path):
+    temp_file_path = f"{file_path}.{os.getpid()}.tmp"
+    with open(temp_file_path, "w") as f:
+        json.dump(data, f, indent=2)
+        f.write("\n")
+    os.replace(temp_file_path, file_path)
+
+
+def read_watermarks(export_dir_path):
+    """
+    :param export_dir_path: Export directory.
+    :type export_dir_path: str
+    :return: Dictionary of incremental endpoint -> the date of the latest record exported from it, or None if no
+             export has been made to this directory. Endpoints which had no records are omitted.
+    :rtype: (dict of str -> datetime.datetime) | None
+    """
+    file_path = os.path.join(export_dir_path, WATERMARKS_FILE_NAME)
+    if not os.path.exists(file_path):
+        return None
+    with open(file_path) as f:
+        watermarks = json.load(f)
+    return {endpoint: parse_iso8601(date) for endpoint, date in watermarks.items()}
+
+
+def write_watermarks(export_dir_path, watermarks):
+    """
+    :param export_dir_path: Export directory.
+    :type export_dir_path: str
+    :param watermarks: Dictionary of incremental endpoint -> the date of the latest record exported from it.
+    :type watermarks: dict of str -> datetime.datetime
+    """
+    _write_json_atomically({endpoint: format_iso8601(date) for endpoint, date in sorted(watermarks.items())},
+                           os.path.join(export_dir_path, WATERMARKS_FILE_NAME))
+
+
+def new_segment_dir_path(export_dir_path):
+    """
+    :param export_dir_path: Export directory.
+    :type export_dir_path: str
+    :return: Path to write a new delta segment to. Segment names sort in the order the segments were made.
+    :rtype: str
+    """
+    segment_name = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%dT%H%M%S%fZ")
+    return os.path.join(export_dir_path, DELTAS_DIR_NAME, segment_name)
+
+
+def list_segments(export_dir_path):
+    """
+    :param export_dir_path: Export directory.
+    :type export_dir_path: str
+    :return: Paths to the export's complete delta segments, oldest first.
+    :rtype: list of str
+    """
+    deltas_dir_path = os.path.join(export_dir_path, DELTAS_DIR_NAME)
+    if not os.path.isdir(deltas_dir_path):
+        return []
+    # (Segments are written to a '.tmp' directory and renamed once complete)
+    return [os.path.join(deltas_dir_path, segment_name) for segment_name in sorted(os.listdir(deltas_dir_path))
+            if not segment_name.endswith(".tmp")]
+
+
+def remove_segments(export_dir_path):
+    """
+    Deletes all the export's delta segments, including incomplete ones.
+
+    :param export_dir_path: Export directory.
+    :type export_dir_path: str
+    """
+    shutil.rmtree(os.path.join(export_dir_path, DELTAS_DIR_NAME), ignore_errors=True)
+
+
+def _compact_incremental_endpoint(file_name, snapshot_file_path, segment_dir_paths, spec):
+    """
+    Merges an incremental endpoint's segments into its snapshot file.
+
+    Only the segments' records are held in memory, so this needs memory proportional to the size of the deltas rather
+    than to the size of the snapshot.
+    """
+    # Later segments' versions of a record replace earlier segments'.
+    delta_lut = dict()  # of record id -> (record date, serialized record line)
+    for segment_dir_path in segment_dir_paths:
+        segment_file_path = os.path.join(segment_dir_path, file_name)
+        if not os.path.exists(segment_file_path):
+            continue
+        with open(segment_file_path) as f:
+            for line in f:
+                record = json.loads(line)
+                delta_lut[record[spec["id_key"]]] = (record[spec["date_key"]], line)
+    # (Rapid Pro serializes all dates in the same format, so they sort correctly as strings)
+    delta_lines = [line for _, line in sorted(delta_lut.values(), reverse=not spec["ascending"])]
+
+    temp_file_path = f"{snapshot_file_path}.{os.getpid()}.tmp"
+    with open(temp_file_path, "w") as f:
+        if not spec["ascending"]:
+            f.writelines(delta_lines)
+        if os.path.exists(snapshot_file_path):
+            with open(snapshot_file_path) as snapshot_file:
+                for line in snapshot_file:
+                    if json.loads(line)[spec["id_key"]] not in delta_lut:
+                        f.write(line)
+        if spec["ascending"]:
+            f.writelines(delta_lines)
+    os.replace(temp_file_path, snapshot_file_path)
+
+    return len(delta_lines)
+
+
+def compact(export_dir_path):
+    """
+    Merges an export's delta segments into its snapshot, then deletes the segments.
+
+    For the incremental endpoints, each record in a segment replaces the version of that record in the snapshot,
+    if any. The other endpoints are replaced by their copy in the latest segment. Records deleted from Rapid Pro are
+    not removed from the snapshot; run a full export to remove them.
+
+    Compaction can be safely re-run if it is interrupted.
+
+    :param export_dir_path: Export directory.
+    :type export_dir_path: str
+    :return: Number of segments compacted.
+    :rtype: int
+    """
+    segment_dir_paths = list_segments(export_dir_path)
+    log.info(f"Compacting {len(segment_dir_paths)} delta segments into the snapshot at '{export_dir_path}'...")
+
+    file_names = set()
+    for segment_dir_path in segment_dir_paths:
+        file_names.update(os.listdir(segment_dir_path))
+
+    for file_name in sorted(file_names):
+        snapshot_file_path = os.path.join(export_dir_path, file_name)
+        endpoint = file_name[:-len(".jsonl")] if file_name.endswith(".jsonl") else None
+        if endpoint in INCREMENTAL_ENDPOINTS:
+            records_merged = _compact_incremental_endpoint(
+                file_name, snapshot_file_path, segment_dir_paths, INCREMENTAL_ENDPOINTS[endpoint])
+            log.info(f"Merged {records_merged} changed {endpoint} into the snapshot")
+        else:
+            latest_file_path = [os.path.join(segment_dir_path, file_name) for segment_dir_path in segment_dir_paths
+                                if os.path.exists(os.path.join(segment_dir_path, file_name))][-1]
+            temp_file_path = f"{snapshot_file_path}.{os.getpid()}.tmp"
+            shutil.copyfile(latest_file_path, temp_file_path)
+            os.replace(temp_file_path, snapshot_file_path)
+
+    remove_segments(export_dir_path)
+    log.info(f"Compacted {len(segment_dir_paths)} delta segments")
+    return len(segment_dir_paths)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merges the delta segments of an incremental Rapid Pro export into "
+                                                 "its snapshot")
+
+    parser.add_argument("export_dir_path", metavar="export-dir-path",
+                        help="Directory of the export to compact, as passed to `RapidProClient.export_all_data`")
+
+    args = parser.parse_args()
+
+    compact(args.export_dir_path)
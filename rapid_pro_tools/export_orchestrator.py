@@ -0,0 +1,235 @@
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from core_data_modules.logging import Logger
+from core_data_modules.util import TimeUtils
+
+from rapid_pro_tools.http_session_pool import HttpSessionPool
+from rapid_pro_tools.rapid_pro_client import RapidProClient
+
+log = Logger(__name__)
+
+
+class WorkspaceExportJob(object):
+    def __init__(self, name, rapid_pro_domain, rapid_pro_token, export_dir_path):
+        """
+        A Rapid Pro workspace to export, and where to export it to.
+
+        :param name: Name identifying the workspace in logs and the manifest, e.g. the project name.
+        :type name: str
+        :param rapid_pro_domain: Server hostname of the workspace, e.g. 'rapidpro.io'.
+        :type rapid_pro_domain: str
+        :param rapid_pro_token: API token of the workspace.
+        :type rapid_pro_token: str
+        :param export_dir_path: Directory to export the workspace's data to.
+        :type export_dir_path: str
+        """
+        self.name = name
+        self.rapid_pro_domain = rapid_pro_domain
+        self.rapid_pro_token = rapid_pro_token
+        self.export_dir_path = export_dir_path
+
+    @classmethod
+    def from_dict(cls, source):
+        """
+        :param source: Dictionary with keys 'name', 'rapid_pro_domain', 'export_dir_path', and either
+                       'rapid_pro_token' or 'rapid_pro_token_file_path' (a path to a file containing the token).
+        :type source: dict
+        :rtype: WorkspaceExportJob
+        """
+        name = source["name"]
+        rapid_pro_domain = source["rapid_pro_domain"]
+        export_dir_path = source["export_dir_path"]
+
+        rapid_pro_token = source.get("rapid_pro_token")
+        if rapid_pro_token is None:
+            with open(source["rapid_pro_token_file_path"]) as f:
+                rapid_pro_token = f.read().strip()
+
+        return cls(name, rapid_pro_domain, rapid_pro_token, export_dir_path)
+
+
+class ExportOrchestrator(object):
+    DEFAULT_MAX_WORKERS = 8
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS, max_requests_per_second_per_workspace=None,
+                 http_session_pool=None, metrics=None, tracer=None, delta=False):
+        """
+        Exports many Rapid Pro workspaces concurrently, with `RapidProClient.export_all_data`, and records the outcome
+        of each export in a manifest.
+
+        Each workspace is exported by its own worker thread, up to `max_workers` at once. Workspaces which took the
+        longest to export last time, according to the previous manifest, are started first, so that with enough
+        workers the total export time approaches that of the slowest workspace. A failed export is recorded in the
+        manifest and doesn't stop the others.
+
+        :param max_workers: Maximum number of workspaces to export at once.
+        :type max_workers: int
+        :param max_requests_per_second_per_workspace: Maximum rate at which to make API requests to each workspace.
+                                                      If None, the request rate is not limited.
+        :type max_requests_per_second_per_workspace: float | None
+        :param http_session_pool: Pool of HTTP connections to share between the workspaces' clients. If None, a pool
+                                  with a connection per worker is created.
+        :type http_session_pool: rapid_pro_tools.http_session_pool.HttpSessionPool | None
+        :param metrics: Metrics to record every workspace's requests in, or None.
+        :type metrics: rapid_pro_tools.metrics.RapidProMetrics | None
+        :param tracer: Tracer to record every workspace's export phases in, or None.
+        :type tracer: rapid_pro_tools.tracing.Tracer | None
+        :param delta: Whether to export only the data which has changed since each workspace's previous export.
+                      See `RapidProClient.export_all_data`.
+        :type delta: bool
+        """
+        if http_session_pool is None:
+            http_session_pool = HttpSessionPool(pool_size=max(HttpSessionPool.DEFAULT_POOL_SIZE, max_workers))
+
+        self.max_workers = max_workers
+        self.max_requests_per_second_per_workspace = max_requests_per_second_per_workspace
+        self.http_session_pool = http_session_pool
+        self.metrics = metrics
+        self.tracer = tracer
+        self.delta = delta
+
+    def _export_workspace(self, job):
+        """
+        Exports a single workspace, and returns its entry in the manifest.
+        """
+        log.info(f"Exporting workspace '{job.name}' to '{job.export_dir_path}'...")
+        result = {
+            "name": job.name,
+            "rapid_pro_domain": job.rapid_pro_domain,
+            "export_dir_path": job.export_dir_path,
+            "started_at": TimeUtils.utc_now_as_iso_string()
+        }
+
+        start = time.perf_counter()
+        try:
+            rapid_pro = RapidProClient(
+                job.rapid_pro_domain, job.rapid_pro_token, http_session_pool=self.http_session_pool,
+                metrics=self.metrics, tracer=self.tracer,
+                max_requests_per_second=self.max_requests_per_second_per_workspace
+            )
+            rapid_pro.export_all_data(job.export_dir_path, delta=self.delta)
+            result["status"] = "succeeded"
+            result["error"] = None
+        except Exception as ex:
+            log.warning(f"Failed to export workspace '{job.name}': {type(ex).__name__}: {ex}")
+            result["status"] = "failed"
+            result["error"] = f"{type(ex).__name__}: {ex}"
+        result["finished_at"] = TimeUtils.utc_now_as_iso_string()
+        result["seconds"] = time.perf_counter() - start
+
+        result["files"] = dict()  # of file name -> size in bytes
+        if os.path.isdir(job.export_dir_path):
+            for file_name in sorted(os.listdir(job.export_dir_path)):
+                file_path = os.path.join(job.export_dir_path, file_name)
+                if os.path.isfile(file_path):
+                    result["files"][file_name] = os.path.getsize(file_path)
+
+        log.info(f"Export of workspace '{job.name}' {result['status']} after {result['seconds']:.1f}s")
+        return result
+
+    def export_all(self, jobs, previous_manifest=None):
+        """
+        Exports all the given workspaces.
+
+        :param jobs: Workspaces to export.
+        :type jobs: list of WorkspaceExportJob
+        :param previous_manifest: Manifest returned by a previous call, used to start the slowest workspaces first.
+                                  If None, workspaces are started in the order given.
+        :type previous_manifest: dict | None
+        :return: Manifest recording the outcome, timings, and exported files of each workspace's export.
+        :rtype: dict
+        """
+        assert len(set(job.name for job in jobs)) == len(jobs), "Workspace export jobs must have unique names"
+
+        previous_seconds = dict()  # of workspace name -> seconds taken by its previous export
+        if previous_manifest is not None:
+            for workspace in previous_manifest["workspaces"]:
+                previous_seconds[workspace["name"]] = workspace["seconds"]
+        # Stable sort, so workspaces without a previous export keep their given order, after those with one.
+        jobs = sorted(jobs, key=lambda job: -previous_seconds.get(job.name, -1))
+
+        log.info(f"Exporting {len(jobs)} workspaces, {self.max_workers} at a time...")
+        started_at = TimeUtils.utc_now_as_iso_string()
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = list(executor.map(self._export_workspace, jobs))
+        seconds = time.perf_counter() - start
+
+        failed = [result["name"] for result in results if result["status"] == "failed"]
+        log.info(f"Exported {len(jobs) - len(failed)}/{len(jobs)} workspaces in {seconds:.1f}s" +
+                 ("" if len(failed) == 0 else f" (failed: {', '.join(failed)})"))
+
+        return {
+            "started_at": started_at,
+            "finished_at": TimeUtils.utc_now_as_iso_string(),
+            "seconds": seconds,
+            "succeeded": len(jobs) - len(failed),
+            "failed": len(failed),
+            "workspaces": sorted(results, key=lambda result: result["name"])
+        }
+
+    @staticmethod
+    def read_manifest(manifest_path):
+        """
+        :param manifest_path: Path to a manifest written by `write_manifest`.
+        :type manifest_path: str
+        :return: The manifest, or None if there is no file at `manifest_path`.
+        :rtype: dict | None
+        """
+        if not os.path.exists(manifest_path):
+            return None
+        with open(manifest_path) as f:
+            return json.load(f)
+
+    @staticmethod
+    def write_manifest(manifest, manifest_path):
+        """
+        Writes a manifest to a file as json, replacing the file atomically.
+
+        :param manifest: Manifest returned by `export_all`.
+        :type manifest: dict
+        :param manifest_path: Path to write to.
+        :type manifest_path: str
+        """
+        temp_file_path = f"{manifest_path}.{os.getpid()}.tmp"
+        with open(temp_file_path, "w") as f:
+            json.dump(manifest, f, indent=2)
+            f.write("\n")
+        os.replace(temp_file_path, manifest_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Exports all the data from many Rapid Pro workspaces concurrently, "
+                                                 "and writes a manifest summarising each export")
+
+    parser.add_argument("--max-workers", type=int, default=ExportOrchestrator.DEFAULT_MAX_WORKERS,
+                        help="Maximum number of workspaces to export at once")
+    parser.add_argument("--max-requests-per-second", type=float,
+                        help="Maximum rate at which to make API requests to each workspace")
+    parser.add_argument("--delta", action="store_true",
+                        help="Export only the data which has changed since each workspace's previous export, as a "
+                             "delta segment")
+    parser.add_argument("workspaces_file_path", metavar="workspaces-file-path",
+                        help="Path to a json file containing a list of the workspaces to export, each with keys "
+                             "'name', 'rapid_pro_domain', 'export_dir_path', and either 'rapid_pro_token' or "
+                             "'rapid_pro_token_file_path'")
+    parser.add_argument("manifest_path", metavar="manifest-path",
+                        help="Path to write the manifest to. If a manifest from a previous export exists here, it is "
+                             "used to start the slowest workspaces first")
+
+    args = parser.parse_args()
+
+    with open(args.workspaces_file_path) as f:
+        jobs = [WorkspaceExportJob.from_dict(d) for d in json.load(f)]
+
+    orchestrator = ExportOrchestrator(args.max_workers, args.max_requests_per_second, delta=args.delta)
+    manifest = orchestrator.export_all(jobs, ExportOrchestrator.read_manifest(args.manifest_path))
+    ExportOrchestrator.write_manifest(manifest, args.manifest_path)
+
+    if manifest["failed"] > 0:
+        sys.exit(1)
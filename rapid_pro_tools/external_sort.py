@@ -0,0 +1,137 @@
+import heapq
+import json
+import os
+import shutil
+import tempfile
+
+from core_data_modules.logging import Logger
+
+log = Logger(__name__)
+
+
+class ExternalSorter(object):
+    DEFAULT_MAX_RECORDS_IN_MEMORY = 50000
+
+    def __init__(self, clazz, date_key, id_key, max_records_in_memory=DEFAULT_MAX_RECORDS_IN_MEMORY, temp_dir=None):
+        """
+        Sorts Rapid Pro records in order of date using bounded memory, by spilling sorted chunks of records to
+        temporary files and merging them.
+
+        Records are added in chunks with `add`. Whenever more than `max_records_in_memory` records are buffered, the
+        buffer is sorted and written to a temporary file. `sorted_records` then k-way merges the sorted files and the
+        remaining buffer into a single ordered iterator.
+
+        Records are checked for duplicate ids before any are returned, as `RapidProClient.get_raw_runs` and
+        `RapidProClient.get_raw_messages` do. A record added twice may have a different date each time (e.g. a run in
+        both the archives and production), so each spilled chunk's ids are also written, sorted, to their own
+        temporary file, and the id files are merged so that any repeated id ends up in adjacent positions, where it is
+        detected without having to remember every id seen.
+
+        Use as a context manager, or call `close`, to delete the temporary files.
+
+        :param clazz: Type of the records, used to deserialize them from the temporary files.
+        :type clazz: type of temba_client.serialization.TembaObject
+        :param date_key: Function which returns the date to sort each record by.
+        :type date_key: function of temba_client.serialization.TembaObject -> datetime.datetime
+        :param id_key: Function which returns a unique id for each record.
+        :type id_key: function of temba_client.serialization.TembaObject -> int | str
+        :param max_records_in_memory: Maximum number of records to buffer before spilling them to disk.
+        :type max_records_in_memory: int
+        :param temp_dir: Directory to create the temporary files in. If None, uses the system's temporary directory.
+        :type temp_dir: str | None
+        """
+        self.clazz = clazz
+        self.date_key = date_key
+        self.id_key = id_key
+        self.max_records_in_memory = max_records_in_memory
+
+        self._sort_key = lambda record: (self.date_key(record), self.id_key(record))
+        self._buffer = []
+        self._spill_dir = tempfile.mkdtemp(prefix="rapid_pro_tools_sort_", dir=temp_dir)
+        self._spill_file_paths = []
+        self._id_file_paths = []
+        self.records_added = 0
+
+    def add(self, records):
+        """
+        :param records: Records to sort, in any order.
+        :type records: iterable of temba_client.serialization.TembaObject
+        """
+        for record in records:
+            self._buffer.append(record)
+            self.records_added += 1
+            if len(self._buffer) >= self.max_records_in_memory:
+                self._spill()
+
+    def _spill(self):
+        self._buffer.sort(key=self._sort_key)
+
+        spill_file_path = os.path.join(self._spill_dir, f"{len(self._spill_file_paths)}.jsonl")
+        with open(spill_file_path, "w") as f:
+            for record in self._buffer:
+                f.write(json.dumps(record.serialize()) + "\n")
+        log.debug(f"Spilled {len(self._buffer)} sorted records to {spill_file_path}")
+
+        id_file_path = os.path.join(self._spill_dir, f"{len(self._spill_file_paths)}.ids.jsonl")
+        with open(id_file_path, "w") as f:
+            for record_id in sorted(self.id_key(record) for record in self._buffer):
+                f.write(json.dumps(record_id) + "\n")
+
+        self._spill_file_paths.append(spill_file_path)
+        self._id_file_paths.append(id_file_path)
+        self._buffer = []
+
+    def _read_spill_file(self, spill_file_path):
+        with open(spill_file_path) as f:
+            for line in f:
+                yield self.clazz.deserialize(json.loads(line))
+
+    @staticmethod
+    def _read_id_file(id_file_path):
+        with open(id_file_path) as f:
+            for line in f:
+                yield json.loads(line)
+
+    def _check_for_duplicate_ids(self):
+        sorted_id_chunks = [self._read_id_file(path) for path in self._id_file_paths]
+        sorted_id_chunks.append(iter(sorted(self.id_key(record) for record in self._buffer)))
+
+        prev_id = None
+        for record_id in heapq.merge(*sorted_id_chunks):
+            assert record_id != prev_id, f"Duplicate record {record_id} found in the downloaded data. This could be " \
+                                         f"because a record with this id exists in both the archives and the " \
+                                         f"production database."
+            prev_id = record_id
+
+    def sorted_records(self):
+        """
+        Merges all the records added so far into ascending order of date.
+
+        Raises an AssertionError, before returning any records, if more than one record was added with the same id.
+
+        :return: Iterator of the records, in ascending order of date.
+        :rtype: iterator of temba_client.serialization.TembaObject
+        """
+        self._buffer.sort(key=self._sort_key)
+        log.info(f"Merging {self.records_added} records from {len(self._spill_file_paths)} sorted files on disk and "
+                 f"{len(self._buffer)} in memory...")
+
+        self._check_for_duplicate_ids()
+
+        sorted_chunks = [self._read_spill_file(path) for path in self._spill_file_paths]
+        sorted_chunks.append(iter(self._buffer))
+        yield from heapq.merge(*sorted_chunks, key=self._sort_key)
+
+    def close(self):
+        """
+        Deletes the temporary files.
+        """
+        shutil.rmtree(self._spill_dir, ignore_errors=True)
+        self._buffer = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
@@ -0,0 +1,39 @@
+class FlowIndex(object):
+    def __init__(self, flows):
+        """
+        Index over a list of flows, for looking up flows by uuid or by name without re-fetching the flow list.
+
+        :param flows: Flows to index.
+        :type flows: list of temba_client.v2.types.Flow
+        """
+        self.flows = list(flows)
+        self.flows_by_uuid = dict()
+        self.flows_by_name = dict()
+        for flow in self.flows:
+            self.flows_by_uuid[flow.uuid] = flow
+            self.flows_by_name.setdefault(flow.name, []).append(flow)
+
+    def get_flows_with_name(self, flow_name):
+        """
+        :param flow_name: Name of the flows to get.
+        :type flow_name: str
+        :return: All the flows with the given name.
+        :rtype: list of temba_client.v2.types.Flow
+        """
+        return self.flows_by_name.get(flow_name, [])
+
+    def get_flow_with_uuid(self, flow_uuid):
+        """
+        :param flow_uuid: Uuid of the flow to get.
+        :type flow_uuid: str
+        :return: The flow with the given uuid, or None if there is no such flow in this index.
+        :rtype: temba_client.v2.types.Flow | None
+        """
+        return self.flows_by_uuid.get(flow_uuid)
+
+    def get_all_flow_uuids(self):
+        """
+        :return: The uuids of all the flows in this index, in the order the flows were given.
+        :rtype: list of str
+        """
+        return [f.uuid for f in self.flows]
@@ -0,0 +1,175 @@
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from temba_client.exceptions import TembaBadRequestError, TembaTokenError, TembaNoSuchObjectError, \
+    TembaRateExceededError, TembaHttpError, TembaConnectionError
+from temba_client.v2 import TembaClient
+
+
+class HttpSessionPool(object):
+    DEFAULT_POOL_SIZE = 10
+    DEFAULT_CONNECT_TIMEOUT = 30
+    DEFAULT_READ_TIMEOUT = 300
+
+    _shared_pool = None
+    _shared_pool_lock = threading.Lock()
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT):
+        """
+        A pool of keep-alive HTTP connections, which may be shared between many RapidProClient instances so that
+        connections (and their TLS handshakes) are reused across API requests and archive downloads.
+
+        Authentication headers are supplied per-request, so one pool may safely be shared between clients for
+        different workspaces.
+
+        :param pool_size: Maximum number of connections to keep open to each host.
+        :type pool_size: int
+        :param connect_timeout: Seconds to wait when establishing a connection before giving up.
+        :type connect_timeout: float
+        :param read_timeout: Seconds to wait between bytes received from the server before giving up.
+        :type read_timeout: float
+        """
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    @classmethod
+    def shared(cls):
+        """
+        :return: A process-wide pool with the default configuration, created on first use.
+        :rtype: HttpSessionPool
+        """
+        with cls._shared_pool_lock:
+            if cls._shared_pool is None:
+                cls._shared_pool = cls()
+            return cls._shared_pool
+
+    def request(self, method, url, **kwargs):
+        """
+        Makes an HTTP request using a connection from this pool.
+
+        Accepts the same keyword arguments as `requests.Session.request`. If `timeout` is not given, this pool's
+        configured timeouts are used.
+
+        :return: The server's response.
+        :rtype: requests.Response
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def close(self):
+        """
+        Closes all the connections held by this pool.
+        """
+        self.session.close()
+
+
+class PooledTembaClient(TembaClient):
+    MAX_RATE_LIMIT_RETRIES = 5
+
+    def __init__(self, host, token, http_session_pool, user_agent=None, verify_ssl=None, metrics=None,
+                 rate_limiter=None):
+        """
+        A TembaClient which makes its requests through an `HttpSessionPool` rather than opening a new connection for
+        every request.
+
+        :param host: Server hostname, e.g. 'rapidpro.io'
+        :type host: str
+        :param token: Organization API token
+        :type token: str
+        :param http_session_pool: Pool to make requests with.
+        :type http_session_pool: HttpSessionPool
+        :param metrics: Metrics to record each request, retry and rate-limit sleep in, or None to not record metrics.
+        :type metrics: rapid_pro_tools.metrics.RapidProMetrics | None
+        :param rate_limiter: Limiter to acquire before each request, or None to not limit the request rate.
+        :type rate_limiter: rapid_pro_tools.rate_limiter.RateLimiter | None
+        """
+        super().__init__(host, token, user_agent=user_agent, verify_ssl=verify_ssl)
+        self.http_session_pool = http_session_pool
+        self.metrics = metrics
+        self.rate_limiter = rate_limiter
+
+    def _request(self, method, url, params=None, body=None, retry_on_rate_exceed=False):
+        # temba_client's own rate-limit retry loop calls the base, un-pooled request implementation directly, so
+        # reimplement that retry behaviour here around the pooled request.
+        retries = 0
+        while True:
+            try:
+                return self._pooled_request(method, url, params=params, body=body)
+            except TembaRateExceededError as ex:
+                retries += 1
+
+                if retry_on_rate_exceed and retries < self.MAX_RATE_LIMIT_RETRIES and ex.retry_after:
+                    if self.metrics is not None:
+                        self.metrics.record_retry(429)
+                        self.metrics.record_rate_limit_sleep(ex.retry_after)
+                    time.sleep(ex.retry_after)
+                else:
+                    raise ex
+
+    def _pooled_request(self, method, url, params=None, body=None):
+        """
+        Makes a request to the given url and returns the parsed JSON, raising the same exceptions as
+        temba_client's own request implementation.
+        """
+        try:
+            kwargs = {"headers": self.headers, "verify": self.verify_ssl}
+            if body:
+                kwargs["json"] = body
+            if params:
+                kwargs["params"] = params
+
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+
+            if self.metrics is None:
+                response = self.http_session_pool.request(method, url, **kwargs)
+            else:
+                response = self._timed_request(method, url, **kwargs)
+
+            if response.status_code == 400:
+                try:
+                    errors = response.json()
+                except ValueError:
+                    errors = {"details": [response.content]}
+                raise TembaBadRequestError(errors)
+            elif response.status_code == 403:
+                raise TembaTokenError()
+            elif response.status_code == 404:
+                raise TembaNoSuchObjectError()
+            elif response.status_code == 429:
+                retry_after = response.headers.get("retry-after")
+                raise TembaRateExceededError(int(retry_after) if retry_after else 0)
+
+            response.raise_for_status()
+
+            return response.json() if response.content else None
+        except requests.HTTPError as ex:
+            raise TembaHttpError(ex)
+        except requests.exceptions.ConnectionError:
+            raise TembaConnectionError()
+
+    def _timed_request(self, method, url, **kwargs):
+        """
+        Makes a request through the session pool, recording its endpoint, status and latency in this client's metrics.
+        """
+        endpoint = urlparse(url).path.rsplit("/", 1)[-1]
+        if endpoint.endswith(".json"):
+            endpoint = endpoint[:-len(".json")]
+
+        start = time.perf_counter()
+        try:
+            response = self.http_session_pool.request(method, url, **kwargs)
+        except requests.exceptions.ConnectionError:
+            self.metrics.record_request(method, endpoint, "connection_error", time.perf_counter() - start)
+            raise
+        self.metrics.record_request(method, endpoint, response.status_code, time.perf_counter() - start)
+        return response
@@ -0,0 +1,250 @@
+import bisect
+import gzip
+import json
+import mmap
+import os
+import struct
+from array import array
+
+from core_data_modules.logging import Logger
+from temba_client.v2 import Message, Run
+
+log = Logger(__name__)
+
+# Each index entry is a record's id, and the byte offset and length of its line in the archive's body.
+_INDEX_MAGIC = b"RPTIDX1\n"
+_INDEX_ENTRY = struct.Struct("<qQI")
+
+
+class _IndexIds(object):
+    """
+    Read-only sequence view of the ids in a memory-mapped index, so that the index can be binary searched with
+    `bisect` without loading it into memory.
+    """
+    def __init__(self, index_map):
+        self._index_map = index_map
+        self._len = (len(index_map) - len(_INDEX_MAGIC)) // _INDEX_ENTRY.size
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, i):
+        return _INDEX_ENTRY.unpack_from(self._index_map, len(_INDEX_MAGIC) + i * _INDEX_ENTRY.size)[0]
+
+    def entry(self, i):
+        return _INDEX_ENTRY.unpack_from(self._index_map, len(_INDEX_MAGIC) + i * _INDEX_ENTRY.size)
+
+
+class IndexedArchive(object):
+    def __init__(self, body_path, index_path):
+        """
+        A single archive in the indexed format written by `IndexedArchiveStore.add_archive`, opened for random
+        access.
+
+        The archive's decompressed JSONL body and its id index are memory-mapped, so looking up a record reads only
+        the pages of the index visited by a binary search, and the record's own line.
+
+        :param body_path: Path to the archive's decompressed JSONL body.
+        :type body_path: str
+        :param index_path: Path to the archive's index.
+        :type index_path: str
+        """
+        self._files = []
+        self._body = self._map(body_path)
+        self._index = self._map(index_path)
+        assert self._index[:len(_INDEX_MAGIC)] == _INDEX_MAGIC, f"'{index_path}' is not an archive index"
+        self._ids = _IndexIds(self._index)
+
+    def _map(self, path):
+        f = open(path, "rb")
+        self._files.append(f)
+        if os.fstat(f.fileno()).st_size == 0:
+            # Empty files can't be memory-mapped.
+            return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def lookup_serialized(self, record_id):
+        """
+        :param record_id: Id of the record to look up.
+        :type record_id: int
+        :return: The serialized record with the given id, or None if it isn't in this archive.
+        :rtype: dict | None
+        """
+        i = bisect.bisect_left(self._ids, record_id)
+        if i == len(self._ids):
+            return None
+        entry_id, offset, length = self._ids.entry(i)
+        if entry_id != record_id:
+            return None
+        return json.loads(self._body[offset:offset + length].decode("utf-8"))
+
+    def close(self):
+        for m in [self._body, self._index]:
+            if isinstance(m, mmap.mmap):
+                m.close()
+        for f in self._files:
+            f.close()
+
+
+class IndexedArchiveStore(object):
+    def __init__(self, dir_path):
+        """
+        A local directory of Rapid Pro archives, stored decompressed and indexed by record id so that individual
+        runs and messages can be looked up without downloading or deserializing whole archives.
+
+        Each archive is stored as `<name>.jsonl`, its decompressed JSONL body, and `<name>.idx`, its records' ids
+        sorted, each with the byte offset and length of the record's line in the body. An archive's index is written
+        last, so archives which were only partly written are ignored and replaced when next added.
+
+        To download archives into a store, see `RapidProClient.download_indexed_archives`.
+
+        Use as a context manager, or call `close`, to unmap the archives opened by look-ups.
+
+        :param dir_path: Directory to store the archives in. Created if it doesn't exist.
+        :type dir_path: str
+        """
+        os.makedirs(dir_path, exist_ok=True)
+        self.dir_path = dir_path
+        self._open_archives = dict()  # of archive name -> IndexedArchive
+
+    @staticmethod
+    def archive_name(archive_metadata):
+        """
+        :param archive_metadata: Metadata of an archive.
+        :type archive_metadata: temba_client.v2.types.Archive
+        :return: Name the archive is stored under in a store.
+        :rtype: str
+        """
+        return f"{archive_metadata.archive_type}_{archive_metadata.period}_" \
+               f"{archive_metadata.start_date.strftime('%Y-%m-%d')}"
+
+    def _body_path(self, name):
+        return os.path.join(self.dir_path, f"{name}.jsonl")
+
+    def _index_path(self, name):
+        return os.path.join(self.dir_path, f"{name}.idx")
+
+    def contains(self, archive_metadata):
+        """
+        :param archive_metadata: Metadata of an archive.
+        :type archive_metadata: temba_client.v2.types.Archive
+        :return: Whether the archive has been added to this store.
+        :rtype: bool
+        """
+        return os.path.exists(self._index_path(self.archive_name(archive_metadata)))
+
+    def decompressed_size(self, archive_metadata):
+        """
+        :param archive_metadata: Metadata of an archive which has been added to this store.
+        :type archive_metadata: temba_client.v2.types.Archive
+        :return: Size in bytes of the archive's decompressed body.
+        :rtype: int
+        """
+        return os.path.getsize(self._body_path(self.archive_name(archive_metadata)))
+
+    def add_archive(self, archive_metadata, raw_file):
+        """
+        Decompresses an archive into this store and indexes it.
+
+        :param archive_metadata: Metadata of the archive.
+        :type archive_metadata: temba_client.v2.types.Archive
+        :param raw_file: The archive, in the gzipped JSONL format Rapid Pro serves archives in.
+        :type raw_file: file-like
+        :return: Number of records added.
+        :rtype: int
+        """
+        name = self.archive_name(archive_metadata)
+        body_path = self._body_path(name)
+        index_path = self._index_path(name)
+        assert name not in self._open_archives, f"Archive {name} is open, so can't be replaced"
+        if os.path.exists(index_path):
+            # Remove the old index first, so the archive isn't used while its body is being replaced.
+            os.remove(index_path)
+
+        ids = array("q")
+        offsets = array("Q")
+        lengths = array("I")
+        offset = 0
+        with gzip.GzipFile(fileobj=raw_file) as decompressed_file, open(body_path, "wb") as body_file:
+            for line in decompressed_file:
+                ids.append(json.loads(line)["id"])
+                offsets.append(offset)
+                lengths.append(len(line))
+                body_file.write(line)
+                offset += len(line)
+
+        temp_index_path = f"{index_path}.{os.getpid()}.tmp"
+        with open(temp_index_path, "wb") as index_file:
+            index_file.write(_INDEX_MAGIC)
+            for i in sorted(range(len(ids)), key=ids.__getitem__):
+                index_file.write(_INDEX_ENTRY.pack(ids[i], offsets[i], lengths[i]))
+        os.replace(temp_index_path, index_path)
+
+        log.info(f"Indexed {len(ids)} records from archive {name}")
+        return len(ids)
+
+    def _archives_of_type(self, archive_type):
+        names = sorted(file_name[:-len(".idx")] for file_name in os.listdir(self.dir_path)
+                       if file_name.startswith(f"{archive_type}_") and file_name.endswith(".idx"))
+        for name in names:
+            if name not in self._open_archives:
+                self._open_archives[name] = IndexedArchive(self._body_path(name), self._index_path(name))
+            yield self._open_archives[name]
+
+    def _lookup(self, archive_type, ids):
+        results = dict()  # of id -> serialized record
+        for archive in self._archives_of_type(archive_type):
+            for record_id in ids:
+                if record_id in results:
+                    continue
+                serialized_record = archive.lookup_serialized(record_id)
+                if serialized_record is not None:
+                    results[record_id] = serialized_record
+        return results
+
+    def lookup_runs(self, ids):
+        """
+        Looks up runs by id in this store's run archives.
+
+        :param ids: Ids of the runs to look up.
+        :type ids: iterable of int
+        :return: Dictionary of run id -> run, for each of the given ids found in the archives.
+        :rtype: dict of int -> temba_client.v2.Run
+        """
+        results = dict()
+        for run_id, serialized_run in self._lookup("run", set(ids)).items():
+            # Archived runs are often missing the 'start' field, which is needed to deserialize them. See
+            # `RapidProClient._deserialize_archive`.
+            serialized_run.setdefault("start", None)
+            results[run_id] = Run.deserialize(serialized_run)
+        return results
+
+    def lookup_messages(self, ids):
+        """
+        Looks up messages by id in this store's message archives.
+
+        :param ids: Ids of the messages to look up.
+        :type ids: iterable of int
+        :return: Dictionary of message id -> message, for each of the given ids found in the archives.
+        :rtype: dict of int -> temba_client.v2.Message
+        """
+        return {message_id: Message.deserialize(serialized_message)
+                for message_id, serialized_message in self._lookup("message", set(ids)).items()}
+
+    def close(self):
+        """
+        Unmaps the archives opened by look-ups.
+        """
+        for archive in self._open_archives.values():
+            archive.close()
+        self._open_archives = dict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
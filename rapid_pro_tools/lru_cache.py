@@ -0,0 +1,48 @@
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    def __init__(self, max_size):
+        """
+        A dictionary-like cache which holds at most `max_size` items, evicting the least recently used item when full.
+
+        :param max_size: Maximum number of items to hold.
+        :type max_size: int
+        """
+        assert max_size > 0, "max_size must be positive"
+        self.max_size = max_size
+        self._items = OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        """
+        :param key: Key to look up.
+        :type key: hashable
+        :param default: Value to return if `key` is not in this cache.
+        :type default: any
+        :return: The value cached for `key`, or `default` if there is no such value.
+        :rtype: any
+        """
+        if key not in self._items:
+            return default
+        self._items.move_to_end(key)
+        return self._items[key]
+
+    def put(self, key, value):
+        """
+        Caches a value, evicting the least recently used item if this cache is full.
+
+        :param key: Key to cache the value under.
+        :type key: hashable
+        :param value: Value to cache.
+        :type value: any
+        """
+        self._items[key] = value
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
@@ -0,0 +1,197 @@
+import os
+import threading
+
+
+class _Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, upper_bound in enumerate(self.buckets):
+            if value <= upper_bound:
+                self.bucket_counts[i] += 1
+                break
+
+    def cumulative_bucket_counts(self):
+        cumulative_counts = []
+        total = 0
+        for bucket_count in self.bucket_counts:
+            total += bucket_count
+            cumulative_counts.append(total)
+        return cumulative_counts
+
+
+def _format_labels(labels):
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+class RapidProMetrics(object):
+    DEFAULT_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+    def __init__(self, latency_buckets=DEFAULT_LATENCY_BUCKETS):
+        """
+        Collects request-level metrics from one or more RapidProClient instances: requests made per endpoint and
+        response status, request latencies, retries, time spent sleeping because of rate limits, and the sizes of
+        downloaded archives.
+
+        Pass an instance to `RapidProClient` to enable collection. Clients without one collect nothing.
+        Read the metrics with `snapshot`, or export them for Prometheus' node_exporter textfile collector with
+        `write_prometheus_textfile`.
+
+        :param latency_buckets: Upper bounds, in seconds, of the request latency histogram's buckets.
+        :type latency_buckets: iterable of float
+        """
+        self.latency_buckets = tuple(sorted(latency_buckets))
+
+        self._lock = threading.Lock()
+        self._requests = dict()  # of (method, endpoint, status) -> int
+        self._latencies = dict()  # of endpoint -> _Histogram
+        self._retries = dict()  # of status -> int
+        self._rate_limit_sleep_seconds = 0.0
+        self._archives_downloaded = 0
+        self._archive_bytes_downloaded = 0
+        self._archive_bytes_decompressed = 0
+
+    def record_request(self, method, endpoint, status, seconds):
+        """
+        :param method: HTTP method of the request, e.g. 'GET'.
+        :type method: str
+        :param endpoint: Rapid Pro endpoint requested, e.g. 'runs', or 'archive' for archive downloads.
+        :type endpoint: str
+        :param status: HTTP status code of the response, or 'connection_error' if no response was received.
+        :type status: int | str
+        :param seconds: Time taken by the request.
+        :type seconds: float
+        """
+        with self._lock:
+            key = (method.upper(), endpoint, str(status))
+            self._requests[key] = self._requests.get(key, 0) + 1
+
+            histogram = self._latencies.get(endpoint)
+            if histogram is None:
+                histogram = _Histogram(self.latency_buckets)
+                self._latencies[endpoint] = histogram
+            histogram.observe(seconds)
+
+    def record_retry(self, status):
+        """
+        :param status: HTTP status code of the failed response that is being retried.
+        :type status: int | str
+        """
+        with self._lock:
+            self._retries[str(status)] = self._retries.get(str(status), 0) + 1
+
+    def record_rate_limit_sleep(self, seconds):
+        """
+        :param seconds: Time about to be spent sleeping before retrying a rate-limited request.
+        :type seconds: float
+        """
+        with self._lock:
+            self._rate_limit_sleep_seconds += seconds
+
+    def record_archive_download(self, downloaded_bytes, decompressed_bytes):
+        """
+        :param downloaded_bytes: Size of the archive as downloaded.
+        :type downloaded_bytes: int
+        :param decompressed_bytes: Size of the archive after decompression.
+        :type decompressed_bytes: int
+        """
+        with self._lock:
+            self._archives_downloaded += 1
+            self._archive_bytes_downloaded += downloaded_bytes
+            self._archive_bytes_decompressed += decompressed_bytes
+
+    def snapshot(self):
+        """
+        :return: A copy of the metrics collected so far, as a json-serializable dictionary.
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                "requests": [
+                    {"method": method, "endpoint": endpoint, "status": status, "count": count}
+                    for (method, endpoint, status), count in sorted(self._requests.items())
+                ],
+                "request_latency_seconds": {
+                    endpoint: {
+                        "buckets": dict(zip([str(b) for b in histogram.buckets],
+                                            histogram.cumulative_bucket_counts())),
+                        "count": histogram.count,
+                        "sum": histogram.sum
+                    }
+                    for endpoint, histogram in sorted(self._latencies.items())
+                },
+                "retries": dict(sorted(self._retries.items())),
+                "rate_limit_sleep_seconds": self._rate_limit_sleep_seconds,
+                "archives_downloaded": self._archives_downloaded,
+                "archive_bytes_downloaded": self._archive_bytes_downloaded,
+                "archive_bytes_decompressed": self._archive_bytes_decompressed
+            }
+
+    def to_prometheus_text(self):
+        """
+        :return: The metrics collected so far, in Prometheus' text exposition format.
+        :rtype: str
+        """
+        with self._lock:
+            lines = [
+                "# HELP rapid_pro_client_requests_total Requests made to Rapid Pro.",
+                "# TYPE rapid_pro_client_requests_total counter"
+            ]
+            for (method, endpoint, status), count in sorted(self._requests.items()):
+                labels = _format_labels([("method", method), ("endpoint", endpoint), ("status", status)])
+                lines.append(f"rapid_pro_client_requests_total{labels} {count}")
+
+            lines.append("# HELP rapid_pro_client_request_duration_seconds Latency of requests made to Rapid Pro.")
+            lines.append("# TYPE rapid_pro_client_request_duration_seconds histogram")
+            for endpoint, histogram in sorted(self._latencies.items()):
+                for upper_bound, count in zip(histogram.buckets, histogram.cumulative_bucket_counts()):
+                    labels = _format_labels([("endpoint", endpoint), ("le", upper_bound)])
+                    lines.append(f"rapid_pro_client_request_duration_seconds_bucket{labels} {count}")
+                labels = _format_labels([("endpoint", endpoint), ("le", "+Inf")])
+                lines.append(f"rapid_pro_client_request_duration_seconds_bucket{labels} {histogram.count}")
+                labels = _format_labels([("endpoint", endpoint)])
+                lines.append(f"rapid_pro_client_request_duration_seconds_sum{labels} {histogram.sum}")
+                lines.append(f"rapid_pro_client_request_duration_seconds_count{labels} {histogram.count}")
+
+            lines.append("# HELP rapid_pro_client_retries_total Failed requests to Rapid Pro which were retried.")
+            lines.append("# TYPE rapid_pro_client_retries_total counter")
+            for status, count in sorted(self._retries.items()):
+                lines.append(f"rapid_pro_client_retries_total{_format_labels([('status', status)])} {count}")
+
+            lines.extend([
+                "# HELP rapid_pro_client_rate_limit_sleep_seconds_total Time spent waiting for Rapid Pro's rate limit.",
+                "# TYPE rapid_pro_client_rate_limit_sleep_seconds_total counter",
+                f"rapid_pro_client_rate_limit_sleep_seconds_total {self._rate_limit_sleep_seconds}",
+                "# HELP rapid_pro_client_archives_downloaded_total Archives downloaded from Rapid Pro.",
+                "# TYPE rapid_pro_client_archives_downloaded_total counter",
+                f"rapid_pro_client_archives_downloaded_total {self._archives_downloaded}",
+                "# HELP rapid_pro_client_archive_downloaded_bytes_total Bytes of archives downloaded from Rapid Pro.",
+                "# TYPE rapid_pro_client_archive_downloaded_bytes_total counter",
+                f"rapid_pro_client_archive_downloaded_bytes_total {self._archive_bytes_downloaded}",
+                "# HELP rapid_pro_client_archive_decompressed_bytes_total Bytes of archives after decompression.",
+                "# TYPE rapid_pro_client_archive_decompressed_bytes_total counter",
+                f"rapid_pro_client_archive_decompressed_bytes_total {self._archive_bytes_decompressed}"
+            ])
+
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus_textfile(self, file_path):
+        """
+        Writes the metrics collected so far to a file in Prometheus' text exposition format, for collection by
+        node_exporter's textfile collector.
+
+        The file is replaced atomically, so the collector never reads a partially written file.
+
+        :param file_path: Path to write to. Should end in '.prom' to be picked up by the textfile collector.
+        :type file_path: str
+        """
+        temp_file_path = f"{file_path}.{os.getpid()}.tmp"
+        with open(temp_file_path, "w") as f:
+            f.write(self.to_prometheus_text())
+        os.replace(temp_file_path, file_path)
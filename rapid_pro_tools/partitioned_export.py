@@ -0,0 +1,292 @@
+"""
+A partitioned, compressed layout for exported runs and messages, as written by `RapidProClient.export_all_data` with
+`layout="partitioned"`.
+
+Runs are partitioned by the month they were last modified in and by flow, and messages by the month they were created
+in, e.g. `runs/month=2020-01/flow=<flow-uuid>.jsonl.gz` and `messages/month=2020-01.jsonl.gz`. Each partition is a
+compressed JSONL file of serialized records, in ascending order of date. `partitions.json` lists every partition with
+its row count and time range, so that readers can select the partitions they need with `select_partitions` and read
+them independently, e.g. in parallel, with `read_partition`.
+"""
+import gzip
+import io
+import json
+import os
+import shutil
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from core_data_modules.logging import Logger
+from temba_client.utils import format_iso8601
+
+log = Logger(__name__)
+
+PARTITIONS_MANIFEST_FILE_NAME = "partitions.json"
+COMPRESSIONS = {"gzip": ".jsonl.gz", "zstd": ".jsonl.zst"}
+
+
+def run_partition(run):
+    """
+    :param run: Run to partition.
+    :type run: temba_client.v2.types.Run
+    :return: The run's partition: the month it was last modified in, and its flow.
+    :rtype: tuple of (str, str)
+    """
+    return ("month", run.modified_on.strftime("%Y-%m")), ("flow", run.flow.uuid)
+
+
+def message_partition(message):
+    """
+    :param message: Message to partition.
+    :type message: temba_client.v2.types.Message
+    :return: The message's partition: the month it was created in.
+    :rtype: tuple of (str, str)
+    """
+    return ("month", message.created_on.strftime("%Y-%m")),
+
+
+def _zstandard():
+    # (Imported only when zstd is used, because zstandard is an optional dependency)
+    try:
+        import zstandard
+    except ImportError:
+        zstandard = None
+    assert zstandard is not None, \
+        "zstd compression requires the zstandard package. Install with `pip install RapidProTools[zstd]`"
+    return zstandard
+
+
+def _compress(data, compression):
+    # Each chunk is compressed as a separate gzip member or zstd frame. Concatenations of these are valid gzip/zstd
+    # files, so chunks can be compressed in parallel and appended to their partition's file.
+    if compression == "gzip":
+        return gzip.compress(data, compresslevel=6)
+    else:
+        return _zstandard().ZstdCompressor(level=3).compress(data)
+
+
+class PartitionedExportWriter(object):
+    DEFAULT_MAX_WORKERS = 4
+    DEFAULT_CHUNK_BYTES = 8 * 1024 * 1024
+    DEFAULT_MAX_BUFFERED_BYTES = 64 * 1024 * 1024
+
+    def __init__(self, export_dir_path, endpoint, partition_fn, date_key, compression="gzip",
+                 max_workers=DEFAULT_MAX_WORKERS, chunk_bytes=DEFAULT_CHUNK_BYTES,
+                 max_buffered_bytes=DEFAULT_MAX_BUFFERED_BYTES):
+        """
+        Writes an endpoint's records to compressed partitions of an export directory.
+
+        Serialized records are buffered per partition. Once a partition's buffer reaches `chunk_bytes`, or the
+        buffers reach `max_buffered_bytes` in total, the largest buffer is compressed on a pool of `max_workers`
+        threads and appended to its partition's file, so that compression runs in parallel with fetching and
+        serializing. Any existing partitions of the endpoint are replaced.
+
+        Use as a context manager, or call `close`, to write the remaining buffers.
+
+        :param export_dir_path: Export directory. The partitions are written to `<export_dir_path>/<endpoint>/`.
+        :type export_dir_path: str
+        :param endpoint: Name of the endpoint being exported, e.g. 'runs'.
+        :type endpoint: str
+        :param partition_fn: Function which returns the partition of a record, as a tuple of (key, value) pairs.
+                             See `run_partition` and `message_partition`.
+        :type partition_fn: function of temba_client.serialization.TembaObject -> tuple of (str, str)
+        :param date_key: Function which returns the date of a record, for the partitions' time ranges.
+        :type date_key: function of temba_client.serialization.TembaObject -> datetime.datetime
+        :param compression: Compression to use, either 'gzip' or 'zstd'. 'zstd' requires the zstandard package
+                            (install with `pip install RapidProTools[zstd]`).
+        :type compression: str
+        :param max_workers: Maximum number of chunks to compress at once.
+        :type max_workers: int
+        :param chunk_bytes: Number of bytes of serialized records to buffer for a partition before compressing them.
+        :type chunk_bytes: int
+        :param max_buffered_bytes: Maximum number of bytes of serialized records to buffer across all partitions.
+        :type max_buffered_bytes: int
+        """
+        assert compression in COMPRESSIONS, f"Unsupported compression '{compression}', must be one of " \
+                                            f"{', '.join(COMPRESSIONS)}"
+        if compression == "zstd":
+            _zstandard()
+
+        self.export_dir_path = export_dir_path
+        self.endpoint = endpoint
+        self.partition_fn = partition_fn
+        self.date_key = date_key
+        self.compression = compression
+        self.max_workers = max_workers
+        self.chunk_bytes = chunk_bytes
+        self.max_buffered_bytes = max_buffered_bytes
+
+        shutil.rmtree(os.path.join(export_dir_path, endpoint), ignore_errors=True)
+
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._pending_chunks = deque()  # of (partition, future of compressed bytes), in the order submitted
+        self._buffers = dict()  # of partition -> list of serialized record lines
+        self._buffer_sizes = dict()  # of partition -> bytes in the partition's buffer
+        self._buffered_bytes = 0
+        self._stats = dict()  # of partition -> partition's manifest entry
+
+    def _relative_path(self, partition):
+        path_components = [self.endpoint] + [f"{key}={value}" for key, value in partition]
+        return os.path.join(*path_components) + COMPRESSIONS[self.compression]
+
+    def write(self, record):
+        """
+        :param record: Record to write.
+        :type record: temba_client.serialization.TembaObject
+        """
+        partition = self.partition_fn(record)
+        date = format_iso8601(self.date_key(record))
+        line = (json.dumps(record.serialize()) + "\n").encode("utf-8")
+
+        if partition not in self._stats:
+            self._stats[partition] = {
+                "path": self._relative_path(partition), **dict(partition), "compression": self.compression,
+                "row_count": 0, "min_date": date, "max_date": date
+            }
+            self._buffers[partition] = []
+            self._buffer_sizes[partition] = 0
+        stats = self._stats[partition]
+        stats["row_count"] += 1
+        stats["min_date"] = min(stats["min_date"], date)
+        stats["max_date"] = max(stats["max_date"], date)
+
+        self._buffers[partition].append(line)
+        self._buffer_sizes[partition] += len(line)
+        self._buffered_bytes += len(line)
+
+        if self._buffer_sizes[partition] >= self.chunk_bytes:
+            self._flush(partition)
+        elif self._buffered_bytes >= self.max_buffered_bytes:
+            self._flush(max(self._buffer_sizes, key=self._buffer_sizes.get))
+
+    def _flush(self, partition):
+        data = b"".join(self._buffers[partition])
+        self._buffers[partition] = []
+        self._buffered_bytes -= self._buffer_sizes[partition]
+        self._buffer_sizes[partition] = 0
+        if len(data) == 0:
+            return
+
+        self._pending_chunks.append((partition, self._executor.submit(_compress, data, self.compression)))
+        # Bound the number of compressed chunks waiting to be written.
+        while len(self._pending_chunks) > 2 * self.max_workers:
+            self._write_oldest_chunk()
+
+    def _write_oldest_chunk(self):
+        # Chunks are written in the order they were submitted, so each partition's records stay in order.
+        partition, future = self._pending_chunks.popleft()
+        file_path = os.path.join(self.export_dir_path, self._stats[partition]["path"])
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, "ab") as f:
+            f.write(future.result())
+
+    def close(self):
+        """
+        Writes the remaining buffered records.
+
+        :return: The manifest entry of each partition written, in order of path.
+        :rtype: list of dict
+        """
+        for partition in list(self._buffers):
+            self._flush(partition)
+        while len(self._pending_chunks) > 0:
+            self._write_oldest_chunk()
+        self._executor.shutdown()
+
+        partitions = sorted(self._stats.values(), key=lambda stats: stats["path"])
+        for stats in partitions:
+            stats["bytes"] = os.path.getsize(os.path.join(self.export_dir_path, stats["path"]))
+        log.info(f"Wrote {sum(stats['row_count'] for stats in partitions)} {self.endpoint} to {len(partitions)} "
+                 f"{self.compression} partitions")
+        return partitions
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self._executor.shutdown()
+        return False
+
+
+def write_partitions_manifest(export_dir_path, partitions):
+    """
+    :param export_dir_path: Export directory.
+    :type export_dir_path: str
+    :param partitions: Dictionary of endpoint -> the manifest entries returned by `PartitionedExportWriter.close`.
+    :type partitions: dict of str -> list of dict
+    """
+    file_path = os.path.join(export_dir_path, PARTITIONS_MANIFEST_FILE_NAME)
+    temp_file_path = f"{file_path}.{os.getpid()}.tmp"
+    with open(temp_file_path, "w") as f:
+        json.dump(partitions, f, indent=2)
+        f.write("\n")
+    os.replace(temp_file_path, file_path)
+
+
+def read_partitions_manifest(export_dir_path):
+    """
+    :param export_dir_path: Export directory.
+    :type export_dir_path: str
+    :return: Dictionary of endpoint -> the manifest entry of each of its partitions. Each entry has the partition's
+             'path', relative to the export directory, its partition keys (e.g. 'month' and 'flow'), and its
+             'compression', 'row_count', 'min_date', 'max_date', and size in 'bytes'.
+    :rtype: dict of str -> list of dict
+    """
+    with open(os.path.join(export_dir_path, PARTITIONS_MANIFEST_FILE_NAME)) as f:
+        return json.load(f)
+
+
+def select_partitions(manifest, endpoint, range_start_inclusive=None, range_end_exclusive=None, flow_uuids=None):
+    """
+    Selects the partitions of an endpoint which may contain records in a date range and from any of the given flows.
+
+    :param manifest: Manifest returned by `read_partitions_manifest`.
+    :type manifest: dict of str -> list of dict
+    :param endpoint: Endpoint to select partitions of, either 'runs' or 'messages'.
+    :type endpoint: str
+    :param range_start_inclusive: Start of the date range, or None for the beginning of time.
+    :type range_start_inclusive: datetime.datetime | None
+    :param range_end_exclusive: End of the date range, or None for the end of time.
+    :type range_end_exclusive: datetime.datetime | None
+    :param flow_uuids: UUIDs of the flows to select the partitions of, or None to select partitions of all flows.
+                       Only applies to endpoints which are partitioned by flow.
+    :type flow_uuids: iterable of str | None
+    :return: Manifest entries of the selected partitions.
+    :rtype: list of dict
+    """
+    start = None if range_start_inclusive is None else format_iso8601(range_start_inclusive)
+    end = None if range_end_exclusive is None else format_iso8601(range_end_exclusive)
+    flow_uuids = None if flow_uuids is None else set(flow_uuids)
+
+    # (Dates are all serialized in the same format, so can be compared as strings)
+    return [
+        partition for partition in manifest.get(endpoint, [])
+        if (start is None or partition["max_date"] >= start) and (end is None or partition["min_date"] < end) and
+           (flow_uuids is None or "flow" not in partition or partition["flow"] in flow_uuids)
+    ]
+
+
+def read_partition(export_dir_path, partition, clazz=None):
+    """
+    Reads the records in a partition.
+
+    :param export_dir_path: Export directory.
+    :type export_dir_path: str
+    :param partition: Manifest entry of the partition to read.
+    :type partition: dict
+    :param clazz: Type to deserialize the records to, e.g. temba_client.v2.Run, or None to return them serialized.
+    :type clazz: type of temba_client.serialization.TembaObject | None
+    :return: Iterator of the partition's records, in ascending order of date.
+    :rtype: iterator of (temba_client.serialization.TembaObject | dict)
+    """
+    file_path = os.path.join(export_dir_path, partition["path"])
+    with open(file_path, "rb") as f:
+        if partition["compression"] == "gzip":
+            decompressed_file = gzip.GzipFile(fileobj=f)
+        else:
+            decompressed_file = _zstandard().ZstdDecompressor().stream_reader(f, read_across_frames=True)
+
+        for line in io.TextIOWrapper(decompressed_file, encoding="utf-8"):
+            serialized_record = json.loads(line)
+            yield serialized_record if clazz is None else clazz.deserialize(serialized_record)
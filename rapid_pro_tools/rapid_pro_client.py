@@ -1,19 +1,35 @@
 import datetime
 import gzip
+import itertools
 import json
+import os
 import random
+import shutil
+import tempfile
 import time
-import urllib
 import warnings
-from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
-from core_data_modules.cleaners import PhoneCleaner
 from core_data_modules.logging import Logger
-from core_data_modules.traced_data import TracedData, Metadata
 from core_data_modules.util import TimeUtils, IOUtils
-from dateutil.relativedelta import relativedelta
 from temba_client.exceptions import TembaRateExceededError, TembaHttpError
-from temba_client.v2 import TembaClient, Broadcast, Run, Message
+from temba_client.v2 import Broadcast, Run, Message
+
+from rapid_pro_tools import delta_export, partitioned_export
+from rapid_pro_tools.archive_download import ResumableArchiveDownloader
+from rapid_pro_tools.archive_planner import ArchivePlanner
+from rapid_pro_tools.broadcast_tracker import BroadcastStatusTracker
+from rapid_pro_tools.cached_value import CachedValue
+from rapid_pro_tools.contact_index import ContactIndex
+from rapid_pro_tools.external_sort import ExternalSorter
+from rapid_pro_tools.flow_index import FlowIndex
+from rapid_pro_tools.http_session_pool import HttpSessionPool, PooledTembaClient
+from rapid_pro_tools.lru_cache import LRUCache
+from rapid_pro_tools.rate_limiter import RateLimiter
+from rapid_pro_tools.raw_export_log import raw_export_log_writer_for
+from rapid_pro_tools.time_sharded_fetch import TimeShardedFetcher
+from rapid_pro_tools.tracing import NoOpTracer, traced
 
 log = Logger(__name__)
 
@@ -21,29 +37,105 @@ log = Logger(__name__)
 class RapidProClient(object):
     MAX_RETRIES = 5
     MAX_BACKOFF_POWER = 6
+    DEFAULT_MAX_CONCURRENT_REQUESTS = 4
+    DEFAULT_CONVERSION_CHUNK_SIZE = 10000
+    DEFAULT_PHONE_UUID_CACHE_SIZE = 100000
+    # Archive listings include download links which expire (after 1 day, as at January 2020), and a new daily archive
+    # is created each day, so by default listings are only cached for an hour.
+    DEFAULT_ARCHIVES_CACHE_TTL = 60 * 60
     
-    def __init__(self, server, token):
+    def __init__(self, server, token, http_session_pool=None, flow_cache_ttl=None, org_cache_ttl=None,
+                 fields_cache_ttl=None, groups_cache_ttl=None, metrics=None, tracer=None,
+                 archives_cache_ttl=DEFAULT_ARCHIVES_CACHE_TTL, max_requests_per_second=None,
+                 archive_download_dir=None):
         """
         :param server: Server hostname, e.g. 'rapidpro.io'
         :type server: str
         :param token: Organization API token
         :type token: str
+        :param http_session_pool: Pool of keep-alive HTTP connections to use for API requests and archive downloads.
+                                  Pass the same pool to multiple clients to reuse connections between them.
+                                  If None, uses a pool shared by all clients in this process.
+        :type http_session_pool: rapid_pro_tools.http_session_pool.HttpSessionPool | None
+        :param flow_cache_ttl: Number of seconds to cache this workspace's flow list for, when looking up flows by
+                               name or id. If None, the flow list is cached until `invalidate_flow_cache` is called.
+        :type flow_cache_ttl: float | None
+        :param org_cache_ttl: Number of seconds to cache this workspace's org metadata for. If None, the org metadata
+                              is cached until `invalidate_metadata_cache` is called.
+        :type org_cache_ttl: float | None
+        :param fields_cache_ttl: Number of seconds to cache this workspace's contact fields for. If None, the fields
+                                 are cached until `invalidate_metadata_cache` is called.
+                                 Fields created or updated by this client are reflected in the cache immediately.
+        :type fields_cache_ttl: float | None
+        :param groups_cache_ttl: Number of seconds to cache this workspace's contact groups for. If None, the groups
+                                 are cached until `invalidate_metadata_cache` is called.
+                                 Groups created by this client are reflected in the cache immediately.
+        :type groups_cache_ttl: float | None
+        :param metrics: Metrics to record this client's requests, retries, rate-limit sleeps, and archive downloads in.
+                        Pass the same metrics to multiple clients to aggregate across them.
+                        If None, no metrics are recorded.
+        :type metrics: rapid_pro_tools.metrics.RapidProMetrics | None
+        :param tracer: Tracer to record spans of the phases of fetches and exports in, e.g. archive downloads,
+                       production fetches, de-duplication, and sorting. If None, no spans are recorded.
+        :type tracer: rapid_pro_tools.tracing.Tracer | None
+        :param archives_cache_ttl: Number of seconds to cache this workspace's archive listings for, when choosing
+                                   which archives to download. If None, the listings are cached until
+                                   `invalidate_archive_cache` is called.
+        :type archives_cache_ttl: float | None
+        :param max_requests_per_second: Maximum rate at which to make requests to this workspace's API, across all the
+                                        threads using this client. If None, the request rate is not limited.
+        :type max_requests_per_second: float | None
+        :param archive_download_dir: Directory to download archives to before they're decompressed. Interrupted
+                                     downloads resume from the partially downloaded file. If None, uses the system's
+                                     temporary directory.
+        :type archive_download_dir: str | None
+        """
+        if http_session_pool is None:
+            http_session_pool = HttpSessionPool.shared()
+        self.http_session_pool = http_session_pool
+        self.metrics = metrics
+        self.tracer = NoOpTracer() if tracer is None else tracer
+        rate_limiter = None if max_requests_per_second is None else RateLimiter(max_requests_per_second)
+        self.rapid_pro = PooledTembaClient(server, token, http_session_pool, metrics=metrics,
+                                           rate_limiter=rate_limiter)
+
+        self._flow_index = CachedValue(self._fetch_flow_index, ttl=flow_cache_ttl)
+        self._org = CachedValue(lambda: self.rapid_pro.get_org(retry_on_rate_exceed=True), ttl=org_cache_ttl)
+        self._fields = CachedValue(lambda: self.rapid_pro.get_fields().all(retry_on_rate_exceed=True),
+                                   ttl=fields_cache_ttl)
+        self._groups = CachedValue(lambda: self.rapid_pro.get_groups().all(retry_on_rate_exceed=True),
+                                   ttl=groups_cache_ttl)
+        self._archive_planners = {
+            archive_type: CachedValue(lambda archive_type=archive_type: self._fetch_archive_planner(archive_type),
+                                      ttl=archives_cache_ttl)
+            for archive_type in ["message", "run"]
+        }
+        self.archive_download_dir = archive_download_dir
+        self._archive_downloader = ResumableArchiveDownloader(http_session_pool, self._refresh_archive_download_url,
+                                                              metrics=metrics)
+
+    def invalidate_metadata_cache(self):
         """
-        self.rapid_pro = TembaClient(server, token)
+        Discards this client's cached org, contact field, and contact group metadata, so that each is fetched again
+        on its next use.
+        """
+        self._org.invalidate()
+        self._fields.invalidate()
+        self._groups.invalidate()
 
     def get_workspace_name(self):
         """
         :return: The name of this workspace.
         :rtype: str
         """
-        return self.rapid_pro.get_org(retry_on_rate_exceed=True).name
+        return self._org.get().name
 
     def get_workspace_uuid(self):
         """
         :return: The uuid of this workspace.
         :rtype: str
         """
-        return self.rapid_pro.get_org(retry_on_rate_exceed=True).uuid
+        return self._org.get().uuid
         
     def list_archives(self, archive_type=None):
         """
@@ -64,6 +156,17 @@ class RapidProClient(object):
 
         return self.rapid_pro.get_archives(archive_type=archive_type).all(retry_on_rate_exceed=True)
 
+    def _fetch_archive_planner(self, archive_type):
+        with self.tracer.span("list_archives", {"archive_type": archive_type}):
+            return ArchivePlanner(self.list_archives(archive_type))
+
+    def invalidate_archive_cache(self):
+        """
+        Discards this client's cached archive listings, so that the next archive download lists the archives again.
+        """
+        for planner in self._archive_planners.values():
+            planner.invalidate()
+
     def get_archive(self, archive_metadata):
         """
         Downloads the archive specified by an archive metadata object, and converts it into a valid list of Message
@@ -78,17 +181,127 @@ class RapidProClient(object):
             log.info(f"Skipping empty archive {archive_metadata.start_date} ({archive_metadata.download_url})...")
             return []
 
-        # Download the archive, which is in a gzipped JSONL format, and decompress.
+        # Download the archive, which is in a gzipped JSONL format, to a temporary file on disk, so that an interrupted
+        # download can be resumed, then decompress.
         log.info(f"Downloading {archive_metadata.record_count} records from {archive_metadata.period} archive "
-                 f"{archive_metadata.start_date} ({archive_metadata.download_url})...")
-        archive_response = urllib.request.urlopen(archive_metadata.download_url)
-        raw_file = BytesIO(archive_response.read())
+                 f"{archive_metadata.start_date}...")
+        with tempfile.TemporaryFile(dir=self.archive_download_dir) as archive_file:
+            with self.tracer.span("get_archive.download", {"archive_type": archive_metadata.archive_type,
+                                                           "period": archive_metadata.period}) as span:
+                downloaded_bytes = self._archive_downloader.download(archive_metadata, archive_file)
+                span.set_attribute("bytes", downloaded_bytes)
+
+            archive_file.seek(0)
+            with self.tracer.span("get_archive.decompress_and_deserialize") as span:
+                results, decompressed_bytes = self._deserialize_archive_and_measure(
+                    archive_metadata.archive_type, archive_file)
+                span.set_attribute("records", len(results))
+            assert len(results) == archive_metadata.record_count
+
+            if self.metrics is not None:
+                self.metrics.record_archive_download(downloaded_bytes, decompressed_bytes)
+
+        return results
+
+    def _refresh_archive_download_url(self, archive_metadata):
+        """
+        Lists the archives again, to get a new download link for an archive whose link has expired.
+        The cached archive listings are refreshed too, so that later downloads use new links.
+
+        :param archive_metadata: Metadata of the archive to get a new download link for.
+        :type archive_metadata: temba_client.v2.types.Archive
+        :return: New download link for the archive.
+        :rtype: str
+        """
+        archive_planner = self._archive_planners[archive_metadata.archive_type]
+        archive_planner.invalidate()
+        for archive in archive_planner.get().archives:
+            if archive.start_date == archive_metadata.start_date and archive.period == archive_metadata.period:
+                return archive.download_url
+
+        raise KeyError(f"{archive_metadata.period} {archive_metadata.archive_type} archive "
+                       f"{archive_metadata.start_date} is no longer available from Rapid Pro")
+
+    def download_indexed_archives(self, archive_type, store, range_start_inclusive=None, range_end_exclusive=None):
+        """
+        Downloads archives into a local store, where individual records can then be looked up by id with
+        `IndexedArchiveStore.lookup_runs` and `IndexedArchiveStore.lookup_messages`.
+
+        Archives already in the store are not downloaded again.
+
+        :param archive_type: The type of archives to download, either 'message' or 'run'.
+        :type archive_type: str
+        :param store: Store to download the archives into.
+        :type store: rapid_pro_tools.indexed_archive.IndexedArchiveStore
+        :param range_start_inclusive: Start of the date range to download the archives of, or None for the beginning
+                                      of time.
+        :type range_start_inclusive: datetime.datetime | None
+        :param range_end_exclusive: End of the date range to download the archives of, or None for the end of time.
+        :type range_end_exclusive: datetime.datetime | None
+        :return: Number of archives downloaded.
+        :rtype: int
+        """
+        archives = self._archive_planners[archive_type].get().plan(range_start_inclusive, range_end_exclusive)
+        archives = [archive for archive in archives if archive.record_count > 0 and not store.contains(archive)]
+
+        log.info(f"Downloading {len(archives)} {archive_type} archives into the indexed archive store at "
+                 f"'{store.dir_path}'...")
+        for archive_metadata in archives:
+            with tempfile.TemporaryFile(dir=self.archive_download_dir) as archive_file:
+                with self.tracer.span("get_archive.download", {"archive_type": archive_metadata.archive_type,
+                                                               "period": archive_metadata.period}) as span:
+                    downloaded_bytes = self._archive_downloader.download(archive_metadata, archive_file)
+                    span.set_attribute("bytes", downloaded_bytes)
+
+                archive_file.seek(0)
+                with self.tracer.span("download_indexed_archives.index") as span:
+                    record_count = store.add_archive(archive_metadata, archive_file)
+                    span.set_attribute("records", record_count)
+                assert record_count == archive_metadata.record_count
+
+                if self.metrics is not None:
+                    self.metrics.record_archive_download(downloaded_bytes, store.decompressed_size(archive_metadata))
+
+        return len(archives)
+
+    @staticmethod
+    def _deserialize_archive(archive_type, raw_file):
+        """
+        Decompresses and deserializes a downloaded archive.
+
+        :param archive_type: Type of the archive, either 'run' or 'message'.
+        :type archive_type: str
+        :param raw_file: Archive file, in the gzipped JSONL format Rapid Pro serves archives in.
+        :type raw_file: file-like
+        :return: Data in the archive.
+        :rtype: list of temba_client.v2.Message | list of temba_client.v2.Run
+        """
+        results, _ = RapidProClient._deserialize_archive_and_measure(archive_type, raw_file)
+        return results
+
+    @staticmethod
+    def _deserialize_archive_and_measure(archive_type, raw_file):
+        """
+        Decompresses and deserializes a downloaded archive, counting the decompressed bytes as they are read.
+
+        The decompressed size is counted rather than read from the gzip trailer, because the trailer only records the
+        size modulo 2^32, which is wrong for archives of 4GB or more.
+
+        :param archive_type: Type of the archive, either 'run' or 'message'.
+        :type archive_type: str
+        :param raw_file: Archive file, in the gzipped JSONL format Rapid Pro serves archives in.
+        :type raw_file: file-like
+        :return: Data in the archive, and the size of the archive in bytes after decompression.
+        :rtype: (list of temba_client.v2.Message | list of temba_client.v2.Run, int)
+        """
         decompressed_file = gzip.GzipFile(fileobj=raw_file)
 
         # Convert each of the decompressed results to a Run or Message object, depending on what the archive contains.
         results = []
-        if archive_metadata.archive_type == "run":
+        decompressed_bytes = 0
+        if archive_type == "run":
             for line in decompressed_file.readlines():
+                decompressed_bytes += len(line)
                 serialized_run = json.loads(line)
 
                 # Set the 'start' field to null if it doesn't exist.
@@ -102,15 +315,45 @@ class RapidProClient(object):
                 results.append(Run.deserialize(serialized_run))
         
         else:
-            assert archive_metadata.archive_type == "message", "Unsupported archive type, must be either 'run' or 'message'"
+            assert archive_type == "message", "Unsupported archive type, must be either 'run' or 'message'"
             for line in decompressed_file.readlines():
+                decompressed_bytes += len(line)
                 serialized_msg = json.loads(line)
 
                 results.append(Message.deserialize(serialized_msg))
 
-        assert len(results) == archive_metadata.record_count
+        return results, decompressed_bytes
 
-        return results
+    def _fetch_flow_index(self):
+        log.info("Fetching all flows...")
+        flows = self.rapid_pro.get_flows().all(retry_on_rate_exceed=True)
+        log.info(f"Downloaded {len(flows)} flows")
+        return FlowIndex(flows)
+
+    def _look_up_in_flow_index(self, look_up_fn):
+        """
+        Looks up flows in this client's cached flow index.
+
+        If the look-up finds nothing and the index came from the cache, the index is re-fetched and the look-up
+        retried once, in case the requested flow was created after the index was cached.
+
+        :param look_up_fn: Function which looks up the requested flows in a flow index.
+        :type look_up_fn: function of FlowIndex -> any
+        :return: Result of the look-up.
+        :rtype: any
+        """
+        was_cached = self._flow_index.is_fresh()
+        result = look_up_fn(self._flow_index.get())
+        if not result and was_cached:
+            self._flow_index.invalidate()
+            result = look_up_fn(self._flow_index.get())
+        return result
+
+    def invalidate_flow_cache(self):
+        """
+        Discards this client's cached flow list, so that the next flow look-up fetches the latest flows.
+        """
+        self._flow_index.invalidate()
 
     def get_flow_id(self, flow_name):
         """
@@ -121,11 +364,10 @@ class RapidProClient(object):
         :return: The Rapid Pro id for the given flow name.
         :rtype: str
         """
-        flows = self.rapid_pro.get_flows().all(retry_on_rate_exceed=True)
-        matching_flows = [f for f in flows if f.name == flow_name]
+        matching_flows = self._look_up_in_flow_index(lambda index: index.get_flows_with_name(flow_name))
 
         if len(matching_flows) == 0:
-            available_flow_names = [f.name for f in flows]
+            available_flow_names = [f.name for f in self._flow_index.get().flows]
             raise KeyError(f"Requested flow not found on RapidPro (Available flows: {', '.join(available_flow_names)})")
         if len(matching_flows) > 1:
             raise KeyError("Non-unique flow name")
@@ -146,11 +388,15 @@ class RapidProClient(object):
     def get_all_flow_ids(self):
         """
         Gets all the flow ids currently available on this Rapid Pro workspace.
+
+        This always fetches the latest flow list, and refreshes the cached flow list with it, because flows created
+        since the list was cached can't be detected from the cached list alone.
         
         :return: Ids of all flows on this Rapid Pro workspace.
         :rtype: list of str
         """
-        return [f.uuid for f in self.rapid_pro.get_flows().all(retry_on_rate_exceed=True)]
+        self._flow_index.invalidate()
+        return self._flow_index.get().get_all_flow_uuids()
 
     def get_flow_definitions_for_flow_ids(self, flow_ids):
         """
@@ -172,16 +418,15 @@ class RapidProClient(object):
         :return: The requested flow.
         :rtype: temba_client.v2.types.Flow
         """
-        flows = self.rapid_pro.get_flows(flow_id).all(retry_on_rate_exceed=True)
-        assert len(flows) > 0, f"Flow '{flow_id}' not found on Rapid Pro"
-        assert len(flows) < 2, f"{len(flows)} matching flows found, but only 1 was expected"
-        return flows[0]
+        flow = self._look_up_in_flow_index(lambda index: index.get_flow_with_uuid(flow_id))
+        assert flow is not None, f"Flow '{flow_id}' not found on Rapid Pro"
+        return flow
 
     def _get_archived_messages(self, created_after_inclusive=None, created_before_exclusive=None):
         """
         Gets the raw messages from Rapid Pro's archives.
         
-        Uses the created dates to determine which archives to download.
+        Uses the created dates to determine which archives to download. See `ArchivePlanner`.
         Filtering is done on creation date because this is the only timestamp metadata field Rapid Pro supports filtering
 
         :param created_after_inclusive: Start of the date-range to download messages from.
@@ -194,34 +439,35 @@ class RapidProClient(object):
         :return: Raw messages downloaded from Rapid Pro's archives.
         :rtype: list of temba_client.v2.types.Message
         """
-        messages = []
-        for archive_metadata in self.list_archives("message"):
-            # Determine the start and end dates for this archive
-            archive_start_date = archive_metadata.start_date
-            if archive_metadata.period == "daily":
-                archive_end_date = archive_start_date + relativedelta(days=1, microseconds=-1)
-            else:
-                assert archive_metadata.period == "monthly"
-                archive_end_date = archive_start_date + relativedelta(months=1, microseconds=-1)
-
-            if (created_after_inclusive is not None and archive_end_date < created_after_inclusive) or \
-                    (created_before_exclusive is not None and archive_start_date >= created_before_exclusive):
-                log.debug(f"Skipping {archive_metadata.period} archive with date range {archive_start_date} - "
-                          f"{archive_end_date}")
-                continue
-
-            for message in self.get_archive(archive_metadata):
-                # Skip messages from a datetime that is outside the date range of interest
-                if (created_after_inclusive is not None and message.modified_on < created_after_inclusive) or \
-                        (created_before_exclusive is not None and message.modified_on >= created_before_exclusive):
-                    continue
+        return list(itertools.chain.from_iterable(
+            self._iter_archived_messages(created_after_inclusive, created_before_exclusive)))
 
-                messages.append(message)
+    def _iter_archived_messages(self, created_after_inclusive=None, created_before_exclusive=None):
+        """
+        Iterates over the raw messages in each of Rapid Pro's archives which are in the given date range.
+        See `RapidProClient._get_archived_messages`.
+
+        :return: Iterator of the messages in the date range from each archive downloaded.
+        :rtype: iterator of list of temba_client.v2.types.Message
+        """
+        archives = self._archive_planners["message"].get().plan(created_after_inclusive, created_before_exclusive)
+        for archive_metadata in archives:
+            messages = []
+            archived_messages = self.get_archive(archive_metadata)
+            with self.tracer.span("filter_archive", {"records": len(archived_messages)}):
+                for message in archived_messages:
+                    # Skip messages from a datetime that is outside the date range of interest
+                    if (created_after_inclusive is not None and message.modified_on < created_after_inclusive) or \
+                            (created_before_exclusive is not None and message.modified_on >= created_before_exclusive):
+                        continue
 
-        return messages
+                    messages.append(message)
+            yield messages
 
+    @traced("get_raw_messages")
     def get_raw_messages(self, created_after_inclusive=None, created_before_exclusive=None,
-                         raw_export_log_file=None, ignore_archives=False):
+                         raw_export_log_file=None, ignore_archives=False, production_shard_count=1,
+                         max_concurrent_requests=DEFAULT_MAX_CONCURRENT_REQUESTS):
         """
         Gets the raw messages from RapidPro.
 
@@ -233,8 +479,15 @@ class RapidProClient(object):
                                          If set, only downloads messages created on Rapid Pro before that date,
                                          otherwise downloads until the end of time.
         :type created_before_exclusive: datetime.datetime | None
-        :param raw_export_log_file: File to write the raw data downloaded during this function call to as json.
-        :type raw_export_log_file: file-like | None
+        :param raw_export_log_file: File or RawExportLogWriter to log the raw data downloaded during this function
+                                    call to, as JSONL. Records are logged in the background as they are fetched.
+        :type raw_export_log_file: rapid_pro_tools.raw_export_log.RawExportLogWriter | file-like | None
+        :param production_shard_count: Number of time shards to divide the date-range into when fetching from the
+                                       production database. If greater than 1, the shards are fetched concurrently,
+                                       and busy shards are divided further. See `TimeShardedFetcher`.
+        :type production_shard_count: int
+        :param max_concurrent_requests: Maximum number of shards to fetch at once, when `production_shard_count` > 1.
+        :type max_concurrent_requests: int
         :return: Raw contacts downloaded from Rapid Pro.
         :rtype: list of temba_client.v2.types.Message
         """
@@ -247,49 +500,128 @@ class RapidProClient(object):
         if created_before_exclusive is not None:
             created_before_inclusive = created_before_exclusive - datetime.timedelta(microseconds=1)
 
-        if ignore_archives:
-            log.debug(f"Ignoring messages in archives (because `ignore_archives` argument was set to True)")
-            archived_messages = []
-        else:
-            archived_messages = self._get_archived_messages(
-                created_after_inclusive=created_after_inclusive,
-                created_before_exclusive=created_before_exclusive
-            )
-
-        log.info(f"Fetching messages from production Rapid Pro workspace...")
-        production_messages = self.rapid_pro.get_messages(after=created_after_inclusive, before=created_before_inclusive)\
-            .all(retry_on_rate_exceed=True)
+        # Fetched messages are logged in the background while the rest are still being fetched.
+        with self._raw_export_log(raw_export_log_file, "messages") as export_log:
+            if ignore_archives:
+                log.debug(f"Ignoring messages in archives (because `ignore_archives` argument was set to True)")
+                archived_messages = []
+            else:
+                with self.tracer.span("get_raw_messages.fetch_archives") as span:
+                    archived_messages = self._get_archived_messages(
+                        created_after_inclusive=created_after_inclusive,
+                        created_before_exclusive=created_before_exclusive
+                    )
+                    span.set_attribute("records", len(archived_messages))
+                export_log.write(archived_messages)
+
+            log.info(f"Fetching messages from production Rapid Pro workspace...")
+            with self.tracer.span("get_raw_messages.fetch_production") as span:
+                production_messages = self._fetch_production(
+                    lambda after, before: self.rapid_pro.get_messages(after=after, before=before),
+                    created_after_inclusive, created_before_inclusive, lambda message: message.created_on,
+                    lambda message: message.id, production_shard_count, max_concurrent_requests, export_log.write
+                )
+                span.set_attribute("records", len(production_messages))
 
         raw_messages = archived_messages + production_messages
         log.info(f"Fetched {len(raw_messages)} messages ({len(archived_messages)} from archives, "
                  f"{len(production_messages)} from production)")
 
         # Check that we only see each message once. 
-        seen_message_ids = set()
-        for message in raw_messages:
-            assert message.id not in seen_message_ids, f"Duplicate message {message.id} found in the downloaded data. " \
-                                                       f"This could be because a message with this id exists in both " \
-                                                       f"the archives and the production database."
-            seen_message_ids.add(message.id)
-
-        if raw_export_log_file is not None:
-            log.info(f"Logging {len(raw_messages)} fetched messages...")
-            json.dump([contact.serialize() for contact in raw_messages], raw_export_log_file)
-            raw_export_log_file.write("\n")
-            log.info(f"Logged fetched messages")
-        else:
-            log.debug("Not logging the raw export (argument 'raw_export_log_file' was None)")
+        with self.tracer.span("get_raw_messages.check_duplicates", {"records": len(raw_messages)}):
+            seen_message_ids = set()
+            for message in raw_messages:
+                assert message.id not in seen_message_ids, f"Duplicate message {message.id} found in the downloaded " \
+                                                           f"data. This could be because a message with this id " \
+                                                           f"exists in both the archives and the production database."
+                seen_message_ids.add(message.id)
 
         # Sort in ascending order of creation date
-        raw_messages = list(raw_messages)
-        raw_messages.reverse()
+        with self.tracer.span("get_raw_messages.sort", {"records": len(raw_messages)}):
+            raw_messages = list(raw_messages)
+            raw_messages.reverse()
 
         return raw_messages
 
+    def iter_raw_messages(self, created_after_inclusive=None, created_before_exclusive=None, raw_export_log_file=None,
+                          ignore_archives=False, max_records_in_memory=ExternalSorter.DEFAULT_MAX_RECORDS_IN_MEMORY,
+                          temp_dir=None):
+        """
+        Gets the raw messages from Rapid Pro's production database and, if needed, from its archives, using bounded
+        memory. Use instead of `get_raw_messages` when there are too many messages to hold in memory at once.
+
+        Each archive and page of messages is added to an `ExternalSorter` as it is fetched, which spills sorted
+        chunks to disk. Once everything has been fetched, the messages are checked for duplicates and the chunks are
+        merged into ascending order of creation date.
+
+        :param created_after_inclusive: Start of the date-range to download messages from.
+                                        If set, only downloads messages created on Rapid Pro since that date,
+                                        otherwise downloads from the beginning of time.
+        :type created_after_inclusive: datetime.datetime | None
+        :param created_before_exclusive: End of the date-range to download messages from.
+                                         If set, only downloads messages created on Rapid Pro before that date,
+                                         otherwise downloads until the end of time.
+        :type created_before_exclusive: datetime.datetime | None
+        :param raw_export_log_file: File or RawExportLogWriter to log the raw data downloaded to, as JSONL.
+                                    Records are logged in the background as they are fetched.
+        :type raw_export_log_file: rapid_pro_tools.raw_export_log.RawExportLogWriter | file-like | None
+        :param ignore_archives: If True, skips downloading messages from Rapid Pro's archives.
+        :type ignore_archives: bool
+        :param max_records_in_memory: Maximum number of messages to hold in memory while sorting, in addition to the
+                                      messages in the archive or page being fetched. See `ExternalSorter`.
+        :type max_records_in_memory: int
+        :param temp_dir: Directory to write sorted messages to while merging. If None, uses the system's temporary
+                         directory.
+        :type temp_dir: str | None
+        :return: Iterator of the raw messages downloaded from Rapid Pro, in ascending order of creation date.
+        :rtype: iterator of temba_client.v2.types.Message
+        """
+        created_before_inclusive = None
+        if created_before_exclusive is not None:
+            created_before_inclusive = created_before_exclusive - datetime.timedelta(microseconds=1)
+
+        archived_chunks = [] if ignore_archives else \
+            self._iter_archived_messages(created_after_inclusive, created_before_exclusive)
+        return self._iter_externally_sorted(
+            "messages", Message, archived_chunks,
+            self.rapid_pro.get_messages(after=created_after_inclusive, before=created_before_inclusive),
+            lambda message: message.created_on, lambda message: message.id,
+            raw_export_log_file, max_records_in_memory, temp_dir
+        )
+
+    def _iter_externally_sorted(self, data_name, clazz, archived_chunks, production_query, date_key, id_key,
+                                raw_export_log_file, max_records_in_memory, temp_dir):
+        """
+        Fetches chunks of records from archives and pages of records from production into an `ExternalSorter`, then
+        yields all the records in ascending order of `date_key`.
+        """
+        log.info(f"Fetching raw {data_name} using bounded memory...")
+        with ExternalSorter(clazz, date_key, id_key, max_records_in_memory, temp_dir) as sorter:
+            with self._raw_export_log(raw_export_log_file, data_name) as export_log:
+                with self.tracer.span(f"iter_raw_{data_name}.fetch_archives"):
+                    for chunk in archived_chunks:
+                        export_log.write(chunk)
+                        sorter.add(chunk)
+                archived_count = sorter.records_added
+
+                log.info(f"Fetching {data_name} from production Rapid Pro workspace...")
+                with self.tracer.span(f"iter_raw_{data_name}.fetch_production"):
+                    for page in production_query.iterfetches(retry_on_rate_exceed=True):
+                        export_log.write(page)
+                        sorter.add(page)
+
+            log.info(f"Fetched {sorter.records_added} {data_name} ({archived_count} from archives, "
+                     f"{sorter.records_added - archived_count} from production)")
+
+            yield from sorter.sorted_records()
+
     def get_groups(self, uuid=None, name=None):
         """
         Gets all matching contact groups from a rapid_pro workspace
 
+        If a uuid or name is given and no cached group matches it, the groups are re-fetched and the look-up retried
+        once, in case the requested group was created after the groups were cached.
+
         :param uuid: group UUID to filter on. If None, returns all groups in the workspace.
         :type uuid: str | None
         :param name: group name to filter on. If None, returns all groups in the workspace.
@@ -297,11 +629,26 @@ class RapidProClient(object):
         :return: List of groups matching the group query
         :rtype: list of temba_client.v2.types.Group
         """
-        return [group for group in self.rapid_pro.get_groups(uuid=uuid, name=name).all(retry_on_rate_exceed=True)]
+        # Filter the cached groups in the same way as Rapid Pro's API, which matches names case-insensitively.
+        def look_up(groups):
+            return [
+                group for group in groups
+                if (uuid is None or group.uuid == uuid) and (name is None or group.name.lower() == name.lower())
+            ]
+
+        was_cached = self._groups.is_fresh()
+        matching_groups = look_up(self._groups.get())
+        if len(matching_groups) == 0 and (uuid is not None or name is not None) and was_cached:
+            self._groups.invalidate()
+            matching_groups = look_up(self._groups.get())
+        return matching_groups
 
     def get_contacts(self, uuid=None, urn=None, group=None, deleted=None, before=None, after=None, reverse=None):
         """
-        Gets all matching contacts from a rapid_pro workspace
+        Gets all matching contacts from a rapid_pro workspace.
+
+        This makes at least one request per call, so to resolve many URNs or UUIDs to contacts, use a
+        `rapid_pro_tools.contact_index.ContactIndex` instead.
 
         :param uuid: contact UUID to filter on. If None, returns all contacts in the workspace.
         :type uuid: str | None
@@ -348,7 +695,8 @@ class RapidProClient(object):
         
         log.info("Sending a message to an individual...")
         log.debug(f"Sending to '{target_urn}' the message '{message}'...")
-        response = self.rapid_pro.create_broadcast(message, urns=[target_urn])
+        response = self._retry_on_rate_exceed(
+            lambda: self.rapid_pro.create_broadcast(message, urns=[target_urn]), idempotent=False)
         log.info(f"Message send request created with broadcast id {response.id}")
         return response.id
 
@@ -364,7 +712,7 @@ class RapidProClient(object):
         :type interrupt: bool
         :return: Ids of the Rapid Pro broadcasts created for this send request.
                  These ids may be used to check on the status of the broadcast by making further requests to Rapid Pro.
-                 e.g. using get_broadcast_for_broadcast_id.
+                 e.g. using get_broadcast_for_broadcast_id, or wait_for_broadcasts for many broadcasts.
         :rtype: list of int
         """
         urns = target_urns
@@ -379,20 +727,22 @@ class RapidProClient(object):
             batch.append(urn)
             if len(batch) >= 100:  # limit of 100 imposed by Rapid Pro's API
                 if interrupt:
-                    self.rapid_pro.bulk_interrupt_contacts(batch)
+                    self._retry_on_rate_exceed(lambda: self.rapid_pro.bulk_interrupt_contacts(batch))
                     interrupted += len(batch)
                     log.info(f"Interrupted {interrupted} / {len(urns)} URNs")
 
-                response = self.rapid_pro.create_broadcast(message, urns=batch)
+                response = self._retry_on_rate_exceed(
+                    lambda: self.rapid_pro.create_broadcast(message, urns=batch), idempotent=False)
                 broadcast_ids.append(response.id)
                 sent += len(batch)
                 batch = []
                 log.info(f"Sent {sent} / {len(urns)} URNs")
         if len(batch) > 0:
             if interrupt:
-                self.rapid_pro.bulk_interrupt_contacts(batch)
+                self._retry_on_rate_exceed(lambda: self.rapid_pro.bulk_interrupt_contacts(batch))
                 interrupted += len(batch)
-            response: Broadcast = self.rapid_pro.create_broadcast(message, urns=batch)
+            response: Broadcast = self._retry_on_rate_exceed(
+                lambda: self.rapid_pro.create_broadcast(message, urns=batch), idempotent=False)
             sent += len(batch)
             broadcast_ids.append(response.id)
             log.info(f"Interrupted {interrupted} / {len(urns)} URNs")
@@ -415,6 +765,34 @@ class RapidProClient(object):
             f"(expected exactly 1)"
         return matching_broadcasts[0]
 
+    def iter_broadcasts(self, created_after_inclusive=None):
+        """
+        Iterates over the pages of broadcasts in this workspace, newest first.
+
+        :param created_after_inclusive: If set, only fetches broadcasts created on or after this date.
+        :type created_after_inclusive: datetime.datetime | None
+        :return: Iterator of each page of broadcasts.
+        :rtype: iterator of list of temba_client.v2.Broadcast
+        """
+        return self.rapid_pro.get_broadcasts(after=created_after_inclusive).iterfetches(retry_on_rate_exceed=True)
+
+    def wait_for_broadcasts(self, broadcast_ids, timeout_seconds=None):
+        """
+        Waits for the given broadcasts to finish sending, polling their statuses in bulk.
+
+        See `BroadcastStatusTracker` for how the broadcasts are polled.
+
+        :param broadcast_ids: Ids of the broadcasts to wait for, e.g. as returned by `send_message_to_urns`.
+        :type broadcast_ids: list of int
+        :param timeout_seconds: Maximum number of seconds to wait, or None to wait for as long as it takes.
+        :type timeout_seconds: float | None
+        :return: Dictionary of status -> number of the broadcasts with that status, when all the broadcasts finished
+                 or the timeout expired.
+        :rtype: dict of (str | None) -> int
+        """
+        tracker = BroadcastStatusTracker(self, broadcast_ids)
+        return tracker.wait_until_finished(timeout_seconds)
+
     def interrupt_urns(self, urns):
         """
         Interrupts the given URNs from the flows they are currently in, if any.
@@ -431,21 +809,67 @@ class RapidProClient(object):
         for urn in urns:
             batch.append(urn)
             if len(batch) >= 100:  # limit of 100 imposed by Rapid Pro's API
-                self.rapid_pro.bulk_interrupt_contacts(batch)
+                self._retry_on_rate_exceed(lambda: self.rapid_pro.bulk_interrupt_contacts(batch))
                 interrupted += len(batch)
                 log.info(f"Interrupted {interrupted} / {len(urns)} URNs")
                 batch = []
         if len(batch) > 0:
-            self.rapid_pro.bulk_interrupt_contacts(batch)
+            self._retry_on_rate_exceed(lambda: self.rapid_pro.bulk_interrupt_contacts(batch))
             interrupted += len(batch)
             log.info(f"Interrupted {interrupted} / {len(urns)} URNs")
 
+    @staticmethod
+    def _fetch_production(query_fn, after_inclusive, before_inclusive, date_key, id_key, shard_count,
+                          max_concurrent_requests, on_fetched=None):
+        """
+        Fetches all the records in a date range from a production endpoint, either in one paginated sequence or, if
+        `shard_count` > 1, as concurrently fetched time shards.
+
+        If `on_fetched` is given, it is called with each page of records as it is fetched or, when fetching time
+        shards, with all the de-duplicated records once every shard has been fetched.
+
+        :return: The fetched records, in descending order of date, as returned by Rapid Pro's API.
+        :rtype: list of temba_client.serialization.TembaObject
+        """
+        if shard_count <= 1:
+            records = []
+            for page in query_fn(after=after_inclusive, before=before_inclusive).iterfetches(retry_on_rate_exceed=True):
+                if on_fetched is not None:
+                    on_fetched(page)
+                records.extend(page)
+            return records
+
+        fetcher = TimeShardedFetcher(query_fn, date_key, id_key, max_concurrent_requests)
+        records = fetcher.fetch(after_inclusive, before_inclusive, shard_count)
+        if on_fetched is not None:
+            on_fetched(records)
+        return records
+
+    @contextmanager
+    def _raw_export_log(self, raw_export_log_file, data_name):
+        """
+        Context manager which provides a RawExportLogWriter to log fetched records to as they are fetched.
+        On exit, waits for the records to be written, unless `raw_export_log_file` is itself a RawExportLogWriter, in
+        which case the caller is responsible for closing it.
+        """
+        if raw_export_log_file is None:
+            log.debug("Not logging the raw export (argument 'raw_export_log_file' was None)")
+
+        writer, owns_writer = raw_export_log_writer_for(raw_export_log_file)
+        try:
+            yield writer
+        finally:
+            if owns_writer:
+                with self.tracer.span(f"get_raw_{data_name}.write_export_log"):
+                    writer.close()
+                log.info(f"Logged {writer.records_written} fetched {data_name}")
+
     def _get_archived_runs(self, flow_id=None, last_modified_after_inclusive=None,
                            last_modified_before_exclusive=None):
         """
         Gets the raw runs for the given flow_id from Rapid Pro's archives.
         
-        Uses the last_modified dates to determine which archives to download.
+        Uses the last_modified dates to determine which archives to download. See `ArchivePlanner`.
 
         :param flow_id: Id of the flow to download the runs of. If None, downloads runs from all flows.
         :type flow_id: str | None
@@ -459,38 +883,41 @@ class RapidProClient(object):
         :return: Raw runs downloaded from Rapid Pro's archives.
         :rtype: list of temba_client.v2.types.Run
         """
-        runs = []
-        for archive_metadata in self.list_archives("run"):
-            # Determine the start and end dates for this archive
-            archive_start_date = archive_metadata.start_date
-            if archive_metadata.period == "daily":
-                archive_end_date = archive_start_date + relativedelta(days=1, microseconds=-1)
-            else:
-                assert archive_metadata.period == "monthly"
-                archive_end_date = archive_start_date + relativedelta(months=1, microseconds=-1)
-
-            if (last_modified_after_inclusive is not None and archive_end_date < last_modified_after_inclusive) or \
-                    (last_modified_before_exclusive is not None and archive_start_date >= last_modified_before_exclusive):
-                log.debug(f"Skipping {archive_metadata.period} archive with date range {archive_start_date} - "
-                          f"{archive_end_date}")
-                continue
-
-            for run in self.get_archive(archive_metadata):
-                # Skip runs from flows other than the flow of interest
-                if flow_id is not None and run.flow.uuid != flow_id:
-                    continue
+        return list(itertools.chain.from_iterable(
+            self._iter_archived_runs(flow_id, last_modified_after_inclusive, last_modified_before_exclusive)))
 
-                # Skip runs from a datetime that is outside the date range of interest
-                if (last_modified_after_inclusive is not None and run.modified_on < last_modified_after_inclusive) or \
-                        (last_modified_before_exclusive is not None and run.modified_on >= last_modified_before_exclusive):
-                    continue
+    def _iter_archived_runs(self, flow_id=None, last_modified_after_inclusive=None,
+                            last_modified_before_exclusive=None):
+        """
+        Iterates over the raw runs for the given flow_id in each of Rapid Pro's archives which are in the given date
+        range. See `RapidProClient._get_archived_runs`.
 
-                runs.append(run)
+        :return: Iterator of the runs in the date range from each archive downloaded.
+        :rtype: iterator of list of temba_client.v2.types.Run
+        """
+        archives = self._archive_planners["run"].get().plan(last_modified_after_inclusive,
+                                                             last_modified_before_exclusive)
+        for archive_metadata in archives:
+            runs = []
+            archived_runs = self.get_archive(archive_metadata)
+            with self.tracer.span("filter_archive", {"records": len(archived_runs)}):
+                for run in archived_runs:
+                    # Skip runs from flows other than the flow of interest
+                    if flow_id is not None and run.flow.uuid != flow_id:
+                        continue
+
+                    # Skip runs from a datetime that is outside the date range of interest
+                    if (last_modified_after_inclusive is not None and run.modified_on < last_modified_after_inclusive) or \
+                            (last_modified_before_exclusive is not None and run.modified_on >= last_modified_before_exclusive):
+                        continue
 
-        return runs
+                    runs.append(run)
+            yield runs
 
+    @traced("get_raw_runs")
     def get_raw_runs(self, flow_id=None, last_modified_after_inclusive=None, last_modified_before_exclusive=None,
-                     raw_export_log_file=None, ignore_archives=False):
+                     raw_export_log_file=None, ignore_archives=False, production_shard_count=1,
+                     max_concurrent_requests=DEFAULT_MAX_CONCURRENT_REQUESTS):
         """
         Gets the raw runs for the given flow_id from Rapid Pro's production database and, if needed, from its archives.
 
@@ -503,11 +930,17 @@ class RapidProClient(object):
         :param last_modified_before_exclusive: End of the date-range to download runs from.
                                                If set, only downloads runs last modified before that date,
                                                otherwise downloads until the end of time.
-        :param raw_export_log_file: File to write the raw data downloaded during this function call to,
-                                    as serialised json.
-        :type raw_export_log_file: file-like | None
+        :param raw_export_log_file: File or RawExportLogWriter to log the raw data downloaded during this function
+                                    call to, as JSONL. Records are logged in the background as they are fetched.
+        :type raw_export_log_file: rapid_pro_tools.raw_export_log.RawExportLogWriter | file-like | None
         :param ignore_archives: If True, skips downloading runs from Rapid Pro's archives.
         :type ignore_archives: bool
+        :param production_shard_count: Number of time shards to divide the date-range into when fetching from the
+                                       production database. If greater than 1, the shards are fetched concurrently,
+                                       and busy shards are divided further. See `TimeShardedFetcher`.
+        :type production_shard_count: int
+        :param max_concurrent_requests: Maximum number of shards to fetch at once, when `production_shard_count` > 1.
+        :type max_concurrent_requests: int
         :return: Raw runs downloaded from Rapid Pro.
         :rtype: list of temba_client.v2.types.Run
         """
@@ -521,19 +954,28 @@ class RapidProClient(object):
         if last_modified_before_exclusive is not None:
             last_modified_before_inclusive = last_modified_before_exclusive - datetime.timedelta(microseconds=1)
 
-        if ignore_archives:
-            log.debug(f"Ignoring runs in archives (because `ignore_archives` argument was set to True)")
-            archived_runs = []
-        else:
-            archived_runs = self._get_archived_runs(
-                flow_id=flow_id, last_modified_after_inclusive=last_modified_after_inclusive,
-                last_modified_before_exclusive=last_modified_before_exclusive
-            )
-
-        log.info(f"Fetching runs from production Rapid Pro workspace...")
-        production_runs = self.rapid_pro.get_runs(
-            flow=flow_id, after=last_modified_after_inclusive, before=last_modified_before_inclusive
-        ).all(retry_on_rate_exceed=True)
+        # Fetched runs are logged in the background while the rest are still being fetched.
+        with self._raw_export_log(raw_export_log_file, "runs") as export_log:
+            if ignore_archives:
+                log.debug(f"Ignoring runs in archives (because `ignore_archives` argument was set to True)")
+                archived_runs = []
+            else:
+                with self.tracer.span("get_raw_runs.fetch_archives") as span:
+                    archived_runs = self._get_archived_runs(
+                        flow_id=flow_id, last_modified_after_inclusive=last_modified_after_inclusive,
+                        last_modified_before_exclusive=last_modified_before_exclusive
+                    )
+                    span.set_attribute("records", len(archived_runs))
+                export_log.write(archived_runs)
+
+            log.info(f"Fetching runs from production Rapid Pro workspace...")
+            with self.tracer.span("get_raw_runs.fetch_production") as span:
+                production_runs = self._fetch_production(
+                    lambda after, before: self.rapid_pro.get_runs(flow=flow_id, after=after, before=before),
+                    last_modified_after_inclusive, last_modified_before_inclusive, lambda run: run.modified_on,
+                    lambda run: run.id, production_shard_count, max_concurrent_requests, export_log.write
+                )
+                span.set_attribute("records", len(production_runs))
 
         raw_runs = archived_runs + production_runs
         log.info(f"Fetched {len(raw_runs)} runs ({len(archived_runs)} from archives, "
@@ -542,27 +984,70 @@ class RapidProClient(object):
         # Check that we only see each run once. This shouldn't be possible, due to
         # https://github.com/nyaruka/rp-archiver/blob/7d3430b5260fa92abb62d828fc526af8e9d9d50a/archiver.go#L624,
         # but this check exists to be safe.
-        seen_run_ids = set()
-        for run in raw_runs:
-            assert run.id not in seen_run_ids, f"Duplicate run {run.id} found in the downloaded data. This could be " \
-                                               f"because a run with this id exists in both the archives and the " \
-                                               f"production database."
-            seen_run_ids.add(run.id)
-
-        if raw_export_log_file is not None:
-            log.info(f"Logging {len(raw_runs)} fetched runs...")
-            json.dump([contact.serialize() for contact in raw_runs], raw_export_log_file)
-            raw_export_log_file.write("\n")
-            log.info(f"Logged fetched runs")
-        else:
-            log.debug("Not logging the raw export (argument 'raw_export_log_file' was None)")
+        with self.tracer.span("get_raw_runs.check_duplicates", {"records": len(raw_runs)}):
+            seen_run_ids = set()
+            for run in raw_runs:
+                assert run.id not in seen_run_ids, f"Duplicate run {run.id} found in the downloaded data. This could " \
+                                                   f"be because a run with this id exists in both the archives and " \
+                                                   f"the production database."
+                seen_run_ids.add(run.id)
 
         # Sort in ascending order of modification date
-        raw_runs = list(raw_runs)
-        raw_runs.sort(key=lambda run: run.modified_on)
+        with self.tracer.span("get_raw_runs.sort", {"records": len(raw_runs)}):
+            raw_runs = list(raw_runs)
+            raw_runs.sort(key=lambda run: run.modified_on)
 
         return raw_runs
 
+    def iter_raw_runs(self, flow_id=None, last_modified_after_inclusive=None, last_modified_before_exclusive=None,
+                      raw_export_log_file=None, ignore_archives=False,
+                      max_records_in_memory=ExternalSorter.DEFAULT_MAX_RECORDS_IN_MEMORY, temp_dir=None):
+        """
+        Gets the raw runs for the given flow_id from Rapid Pro's production database and, if needed, from its archives,
+        using bounded memory. Use instead of `get_raw_runs` when there are too many runs to hold in memory at once.
+
+        Each archive and page of runs is added to an `ExternalSorter` as it is fetched, which spills sorted chunks to
+        disk. Once everything has been fetched, the runs are checked for duplicates and the chunks are merged into
+        ascending order of modification date.
+
+        :param flow_id: Id of the flow to download the runs of. If None, returns runs from all flows.
+        :type flow_id: str | None
+        :param last_modified_after_inclusive: Start of the date-range to download runs from.
+                                              If set, only downloads runs last modified since that date,
+                                              otherwise downloads from the beginning of time.
+        :type last_modified_after_inclusive: datetime.datetime | None
+        :param last_modified_before_exclusive: End of the date-range to download runs from.
+                                               If set, only downloads runs last modified before that date,
+                                               otherwise downloads until the end of time.
+        :type last_modified_before_exclusive: datetime.datetime | None
+        :param raw_export_log_file: File or RawExportLogWriter to log the raw data downloaded to, as JSONL.
+                                    Records are logged in the background as they are fetched.
+        :type raw_export_log_file: rapid_pro_tools.raw_export_log.RawExportLogWriter | file-like | None
+        :param ignore_archives: If True, skips downloading runs from Rapid Pro's archives.
+        :type ignore_archives: bool
+        :param max_records_in_memory: Maximum number of runs to hold in memory while sorting, in addition to the
+                                      runs in the archive or page being fetched. See `ExternalSorter`.
+        :type max_records_in_memory: int
+        :param temp_dir: Directory to write sorted runs to while merging. If None, uses the system's temporary
+                         directory.
+        :type temp_dir: str | None
+        :return: Iterator of the raw runs downloaded from Rapid Pro, in ascending order of modification date.
+        :rtype: iterator of temba_client.v2.types.Run
+        """
+        last_modified_before_inclusive = None
+        if last_modified_before_exclusive is not None:
+            last_modified_before_inclusive = last_modified_before_exclusive - datetime.timedelta(microseconds=1)
+
+        archived_chunks = [] if ignore_archives else \
+            self._iter_archived_runs(flow_id, last_modified_after_inclusive, last_modified_before_exclusive)
+        return self._iter_externally_sorted(
+            "runs", Run, archived_chunks,
+            self.rapid_pro.get_runs(flow=flow_id, after=last_modified_after_inclusive,
+                                    before=last_modified_before_inclusive),
+            lambda run: run.modified_on, lambda run: run.id,
+            raw_export_log_file, max_records_in_memory, temp_dir
+        )
+
     def get_raw_runs_for_flow_id(self, flow_id, last_modified_after_inclusive=None, last_modified_before_exclusive=None,
                                  raw_export_log_file=None, ignore_archives=False):
         warnings.warn("RapidProClient.get_raw_runs_for_flow_id is deprecated; use get_raw_runs instead")
@@ -570,7 +1055,8 @@ class RapidProClient(object):
                                  raw_export_log_file, ignore_archives)
 
     def get_raw_contacts(self, last_modified_after_inclusive=None, last_modified_before_exclusive=None,
-                         raw_export_log_file=None):
+                         raw_export_log_file=None, production_shard_count=1,
+                         max_concurrent_requests=DEFAULT_MAX_CONCURRENT_REQUESTS):
         """
         Gets the raw contacts from RapidPro.
 
@@ -582,8 +1068,15 @@ class RapidProClient(object):
                                                If set, only downloads contacts last modified before that date,
                                                otherwise downloads until the end of time.
         :type last_modified_before_exclusive: datetime.datetime | None
-        :param raw_export_log_file: File to write the raw data downloaded during this function call to as json.
-        :type raw_export_log_file: file-like | None
+        :param raw_export_log_file: File or RawExportLogWriter to log the raw data downloaded during this function
+                                    call to, as JSONL. Records are logged in the background as they are fetched.
+        :type raw_export_log_file: rapid_pro_tools.raw_export_log.RawExportLogWriter | file-like | None
+        :param production_shard_count: Number of time shards to divide the date-range into. If greater than 1, the
+                                       shards are fetched concurrently, and busy shards are divided further.
+                                       See `TimeShardedFetcher`.
+        :type production_shard_count: int
+        :param max_concurrent_requests: Maximum number of shards to fetch at once, when `production_shard_count` > 1.
+        :type max_concurrent_requests: int
         :return: Raw contacts downloaded from Rapid Pro.
         :rtype: list of temba_client.v2.types.Contact
         """
@@ -596,20 +1089,16 @@ class RapidProClient(object):
         if last_modified_before_exclusive is not None:
             last_modified_before_inclusive = last_modified_before_exclusive - datetime.timedelta(microseconds=1)
 
-        raw_contacts = self.rapid_pro.get_contacts(
-            after=last_modified_after_inclusive, before=last_modified_before_inclusive).all(retry_on_rate_exceed=True)
+        with self._raw_export_log(raw_export_log_file, "contacts") as export_log:
+            raw_contacts = self._fetch_production(
+                lambda after, before: self.rapid_pro.get_contacts(after=after, before=before),
+                last_modified_after_inclusive, last_modified_before_inclusive, lambda contact: contact.modified_on,
+                lambda contact: contact.uuid, production_shard_count, max_concurrent_requests, export_log.write
+            )
         assert len(set(c.uuid for c in raw_contacts)) == len(raw_contacts), "Non-unique contact UUID in RapidPro"
 
         log.info(f"Fetched {len(raw_contacts)} contacts")
 
-        if raw_export_log_file is not None:
-            log.info(f"Logging {len(raw_contacts)} fetched contacts...")
-            json.dump([contact.serialize() for contact in raw_contacts], raw_export_log_file)
-            raw_export_log_file.write("\n")
-            log.info(f"Logged fetched contacts")
-        else:
-            log.debug("Not logging the raw export (argument 'raw_export_log_file' was None)")
-
         # Sort in ascending order of modification date
         raw_contacts = list(raw_contacts)
         raw_contacts.reverse()
@@ -651,8 +1140,8 @@ class RapidProClient(object):
         :param prev_raw_data: List of Rapid Pro objects from a previous export, or None.
                               If None, all objects will be downloaded.
         :type prev_raw_data: list of temba_client.serialization.TembaObject | None
-        :param raw_export_log_file: File to write raw data fetched during the export to as json.
-        :type raw_export_log_file: file-like
+        :param raw_export_log_file: File or RawExportLogWriter to log raw data fetched during the export to.
+        :type raw_export_log_file: rapid_pro_tools.raw_export_log.RawExportLogWriter | file-like | None
         :return: Updated list of Rapid Pro objects.
         :rtype: list of temba_client.serialization.TembaObject
         """
@@ -679,8 +1168,8 @@ class RapidProClient(object):
         :param prev_raw_contacts: A list of Rapid Pro contact objects from a previous export, or None.
                                   If None, all contacts will be downloaded.
         :type prev_raw_contacts: list of temba_client.v2.types.Contact | None
-        :param raw_export_log_file: File to write the newly retrieved contacts to as json.
-        :type raw_export_log_file: file-like | None
+        :param raw_export_log_file: File or RawExportLogWriter to log the newly retrieved contacts to.
+        :type raw_export_log_file: rapid_pro_tools.raw_export_log.RawExportLogWriter | file-like | None
         :return: Updated list of Rapid Pro Contact objects.
         :rtype: list of temba_client.v2.types.Contact
         """
@@ -700,8 +1189,8 @@ class RapidProClient(object):
         :param prev_raw_runs: A list of Rapid Pro run objects from a previous export, or None.
                               If None, all runs for the specified flow will be downloaded.
         :type prev_raw_runs: list of temba_client.v2.types.Run | None
-        :param raw_export_log_file: File to write the newly retrieved runs to as json.
-        :type raw_export_log_file: file-like | None
+        :param raw_export_log_file: File or RawExportLogWriter to log the newly retrieved runs to.
+        :type raw_export_log_file: rapid_pro_tools.raw_export_log.RawExportLogWriter | file-like | None
         :param ignore_archives: If True, skips downloading runs from Rapid Pro's archives.
         :type ignore_archives: bool
         :return: Updated list of Rapid Pro Run objects.
@@ -737,10 +1226,14 @@ class RapidProClient(object):
         :return: All contact fields.
         :rtype: list of temba_client.v2.types.Field
         """
-        log.info("Fetching all fields...")
-        fields = self.rapid_pro.get_fields().all(retry_on_rate_exceed=True)
-        log.info(f"Downloaded {len(fields)} fields")
-        return fields
+        if self._fields.is_fresh():
+            fields = self._fields.get()
+            log.info(f"Using {len(fields)} cached fields")
+        else:
+            log.info("Fetching all fields...")
+            fields = self._fields.get()
+            log.info(f"Downloaded {len(fields)} fields")
+        return list(fields)
 
     def create_field(self, label, field_id=None):
         """
@@ -757,34 +1250,125 @@ class RapidProClient(object):
         """
         if field_id is None:
             log.info(f"Creating field with label '{label}'...")
-            rapid_pro_field = self._retry_on_rate_exceed(lambda: self.rapid_pro.create_field(label, "text"))
+            rapid_pro_field = self._retry_on_rate_exceed(lambda: self.rapid_pro.create_field(label, "text"),
+                                                         idempotent=False)
+            self._fields.update_if_cached(lambda fields: fields + [rapid_pro_field])
             log.info(f"Created field with id '{rapid_pro_field.key}'")
             return rapid_pro_field
         else:
             # Rapid Pro allows fields to be overwritten if they already exist.
-            # Check if the requested field id exists, and fail if it does.
+            # Check if the requested field id exists, and fail if it does. A field missing from the cached fields may
+            # have been created since they were fetched, so confirm with Rapid Pro before creating it.
+            if self._fields.is_fresh():
+                assert field_id not in {f.key for f in self._fields.get()}, \
+                    f"Field with id '{field_id}' already exists in workspace"
             fields = self.rapid_pro.get_fields(key=field_id).all(retry_on_rate_exceed=True)
             assert len(fields) == 0, f"Field with id '{field_id}' already exists in workspace"
 
-            # Create a field with the requested id. Rapid Pro doesn't allow us to specify the field id, but they're
-            # predictably generated from the label, so create a new field by setting the label to the field id
-            # we want. Rapid Pro uses underscores in its field ids but doesn't accept them in label names, so replace
-            # underscores with spaces first.
-            initial_label = field_id.replace("_", " ").lower()
-            log.info(f"Creating field with label '{initial_label}', to ensure the field id is '{field_id}'...")
-            rapid_pro_field = self._retry_on_rate_exceed(lambda: self.rapid_pro.create_field(initial_label, "text"))
-            log.info(f"Created field with id '{rapid_pro_field.key}'")
-            assert rapid_pro_field.key == field_id, \
-                f"The field id created by Rapid Pro, '{rapid_pro_field.key}', differs from the requested id " \
-                f"'{field_id}'. Please clean up the problematic field in Rapid Pro, and try again making sure " \
-                f"you request a valid id."
+            return self._create_field_with_id(label, field_id)
 
-            # Having created a field with the desired id, update its label to the one requested.
-            log.info(f"Updating field with id '{rapid_pro_field.key}' to have label '{label}'...")
-            rapid_pro_field = self._retry_on_rate_exceed(lambda: self.rapid_pro.update_field(rapid_pro_field, label, "text"))
-            log.info(f"Done. Created field with label '{rapid_pro_field.label}' and id '{rapid_pro_field.key}'")
+    def _create_field_with_id(self, label, field_id):
+        """
+        Creates a contact field with the given label and id, without first checking whether a field with this id
+        already exists.
 
-            return rapid_pro_field
+        :param label: The name of the contact field to create.
+        :type label: str
+        :param field_id: The id to request Rapid Pro to use for the new contact field.
+        :type field_id: str
+        :return: The contact field that was just created.
+        :rtype: temba_client.v2.types.Field
+        """
+        # Create a field with the requested id. Rapid Pro doesn't allow us to specify the field id, but they're
+        # predictably generated from the label, so create a new field by setting the label to the field id
+        # we want. Rapid Pro uses underscores in its field ids but doesn't accept them in label names, so replace
+        # underscores with spaces first.
+        initial_label = field_id.replace("_", " ").lower()
+        log.info(f"Creating field with label '{initial_label}', to ensure the field id is '{field_id}'...")
+        rapid_pro_field = self._retry_on_rate_exceed(lambda: self.rapid_pro.create_field(initial_label, "text"),
+                                                     idempotent=False)
+        self._fields.update_if_cached(lambda fields: fields + [rapid_pro_field])
+        log.info(f"Created field with id '{rapid_pro_field.key}'")
+        assert rapid_pro_field.key == field_id, \
+            f"The field id created by Rapid Pro, '{rapid_pro_field.key}', differs from the requested id " \
+            f"'{field_id}'. Please clean up the problematic field in Rapid Pro, and try again making sure " \
+            f"you request a valid id."
+
+        # Having created a field with the desired id, update its label to the one requested, if that differs from
+        # the label the field was created with.
+        if rapid_pro_field.label != label:
+            rapid_pro_field = self.update_field(rapid_pro_field.key, label, rapid_pro_field.value_type)
+        log.info(f"Done. Created field with label '{rapid_pro_field.label}' and id '{rapid_pro_field.key}'")
+
+        return rapid_pro_field
+
+    def ensure_fields(self, field_labels, max_concurrent_requests=DEFAULT_MAX_CONCURRENT_REQUESTS):
+        """
+        Ensures that this workspace has contact fields with the given ids and labels.
+
+        Fetches the workspace's current fields once, then creates only the fields that are missing and relabels only
+        the fields whose labels differ. These requests are made concurrently, retrying when Rapid Pro's rate limit is
+        exceeded. Fields in the workspace which are not in `field_labels` are left unchanged.
+
+        :param field_labels: Dictionary of field id -> label for each of the fields to ensure exist.
+                             The ids must be in a format which Rapid Pro will accept (see `create_field`).
+        :type field_labels: dict of str -> str
+        :param max_concurrent_requests: Maximum number of requests to make to Rapid Pro at once.
+        :type max_concurrent_requests: int
+        :return: The contact fields for each of the requested field ids, in the order given.
+        :rtype: list of temba_client.v2.types.Field
+        """
+        self._fields.invalidate()
+        existing_fields = {f.key: f for f in self.get_fields()}
+
+        fields_to_create = {field_id: label for field_id, label in field_labels.items()
+                            if field_id not in existing_fields}
+        fields_to_relabel = {field_id: label for field_id, label in field_labels.items()
+                             if field_id in existing_fields and existing_fields[field_id].label != label}
+        log.info(f"Ensuring {len(field_labels)} fields exist: creating {len(fields_to_create)}, "
+                 f"relabelling {len(fields_to_relabel)}, and leaving "
+                 f"{len(field_labels) - len(fields_to_create) - len(fields_to_relabel)} unchanged...")
+
+        with ThreadPoolExecutor(max_workers=max_concurrent_requests) as executor:
+            futures = dict()
+            for field_id, label in fields_to_create.items():
+                futures[field_id] = executor.submit(self._create_field_with_id, label, field_id)
+            for field_id, label in fields_to_relabel.items():
+                futures[field_id] = executor.submit(self.update_field, field_id, label,
+                                                    existing_fields[field_id].value_type)
+
+            ensured_fields = dict(existing_fields)
+            for field_id, future in futures.items():
+                ensured_fields[field_id] = future.result()
+
+        log.info(f"Ensured {len(field_labels)} fields exist")
+        return [ensured_fields[field_id] for field_id in field_labels]
+
+    def update_field(self, field_id, label, value_type=None):
+        """
+        Updates the label of the contact field with the given id.
+
+        :param field_id: Id of the contact field to update.
+        :type field_id: str
+        :param label: New label for the contact field.
+        :type label: str
+        :param value_type: Value type for the contact field, e.g. 'text' or 'numeric'. If None, keeps the field's
+                           current value type, which is fetched from Rapid Pro.
+        :type value_type: str | None
+        :return: The updated contact field.
+        :rtype: temba_client.v2.types.Field
+        """
+        if value_type is None:
+            fields = self.rapid_pro.get_fields(key=field_id).all(retry_on_rate_exceed=True)
+            assert len(fields) == 1, f"Field with id '{field_id}' does not exist in workspace"
+            value_type = fields[0].value_type
+
+        log.info(f"Updating field with id '{field_id}' to have label '{label}'...")
+        rapid_pro_field = self._retry_on_rate_exceed(
+            lambda: self.rapid_pro.update_field(field_id, label, value_type))
+        self._fields.update_if_cached(
+            lambda fields: [rapid_pro_field if f.key == rapid_pro_field.key else f for f in fields])
+        return rapid_pro_field
 
     def create_group(self, name):
         """
@@ -796,7 +1380,45 @@ class RapidProClient(object):
         :return: the new group.
         :rtype: temba_client.v2.types.Group
         """
-        return self._retry_on_rate_exceed(lambda: self.rapid_pro.create_group(name=name))
+        group = self._retry_on_rate_exceed(lambda: self.rapid_pro.create_group(name=name), idempotent=False)
+        self._groups.update_if_cached(lambda groups: groups + [group])
+        return group
+
+    def ensure_groups(self, names, max_concurrent_requests=DEFAULT_MAX_CONCURRENT_REQUESTS):
+        """
+        Ensures that this workspace has contact groups with the given names.
+
+        Fetches the workspace's current groups once, then concurrently creates only the groups that are missing,
+        retrying when Rapid Pro's rate limit is exceeded. Group names are matched case-insensitively, as in
+        `get_groups`.
+
+        :param names: Names of the groups to ensure exist.
+        :type names: list of str
+        :param max_concurrent_requests: Maximum number of requests to make to Rapid Pro at once.
+        :type max_concurrent_requests: int
+        :return: The contact groups for each of the requested names, in the order given.
+        :rtype: list of temba_client.v2.types.Group
+        """
+        self._groups.invalidate()
+        existing_groups = {g.name.lower(): g for g in self._groups.get()}
+
+        names_to_create = []
+        seen_names = set(existing_groups.keys())
+        for name in names:
+            if name.lower() not in seen_names:
+                names_to_create.append(name)
+                seen_names.add(name.lower())
+        log.info(f"Ensuring {len(names)} groups exist: creating {len(names_to_create)}, and leaving "
+                 f"{len(names) - len(names_to_create)} unchanged...")
+
+        with ThreadPoolExecutor(max_workers=max_concurrent_requests) as executor:
+            created_groups = executor.map(self.create_group, names_to_create)
+            ensured_groups = dict(existing_groups)
+            for name, group in zip(names_to_create, created_groups):
+                ensured_groups[name.lower()] = group
+
+        log.info(f"Ensured {len(names)} groups exist")
+        return [ensured_groups[name.lower()] for name in names]
 
 
     def create_contact(self, name=None, language=None, urns=None, contact_fields=None, groups=None):
@@ -816,20 +1438,28 @@ class RapidProClient(object):
         :return: the new contact
         :rtype: temba_client.v2.types.Contact
         """
-        return self._retry_on_rate_exceed(lambda: self.rapid_pro.create_contact(name=name, language=language, urns=urns,
-                                                                                fields=contact_fields, groups=groups))
+        return self._retry_on_rate_exceed(
+            lambda: self.rapid_pro.create_contact(name=name, language=language, urns=urns, fields=contact_fields,
+                                                  groups=groups),
+            idempotent=False)
 
-    @classmethod
-    def _retry_on_rate_exceed(cls, request):
+    def _retry_on_rate_exceed(self, request, idempotent=True):
         """
         Calls the given request function. If the Rapid Pro server fails with a rate exceeded error, retries up to 
-        cls.MAX_RETRIES times using binary exponential backoff.
+        self.MAX_RETRIES times using binary exponential backoff. If the request is idempotent and fails with a 500 or
+        504 error, retries immediately, up to the same limit.
+
+        Requests which create something (e.g. broadcasts, contacts, or groups) must not be retried on 500 or 504 errors,
+        because Rapid Pro may have completed the request anyway, so a retry could create it twice (e.g. sending the
+        same messages twice). Rate exceeded errors are always retried, because those requests were never processed.
         
         This function is needed because while the Rapid Pro API supports auto-retrying on get requests,
         it does not for create/update/delete requests.
         
         :param request: Function which runs the request when called.
         :type request: function
+        :param idempotent: Whether the request can safely be made more than once.
+        :type idempotent: bool
         :return: Result of the request.
         :rtype: any
         """
@@ -840,33 +1470,37 @@ class RapidProClient(object):
             except TembaRateExceededError as ex:
                 retries += 1
 
-                if retries >= cls.MAX_RETRIES or not ex.retry_after:
+                if retries >= self.MAX_RETRIES or not ex.retry_after:
                     raise ex
 
                 server_wait_time = ex.retry_after
-                backoff_wait_time = random.uniform(0, 2 ** (min(retries, cls.MAX_BACKOFF_POWER)))
+                backoff_wait_time = random.uniform(0, 2 ** (min(retries, self.MAX_BACKOFF_POWER)))
 
                 log.debug(f"Rate exceeded. Sleeping for {server_wait_time + backoff_wait_time} seconds")
+                if self.metrics is not None:
+                    self.metrics.record_retry(429)
+                    self.metrics.record_rate_limit_sleep(server_wait_time + backoff_wait_time)
 
                 time.sleep(server_wait_time + backoff_wait_time)
             except TembaHttpError as ex:
                 retries += 1
 
-                if retries >= cls.MAX_RETRIES:
+                if retries >= self.MAX_RETRIES or not idempotent:
                     raise ex
 
-                if ex.caused_by.response.status_code == 504:
+                status_code = ex.caused_by.response.status_code
+                if status_code in {500, 504}:
                     # (Don't log the details in the error message, because the detail string contains a URL which may
                     # include a phone number)
-                    log.debug(f"TembaHttpError 504, retrying...")
-
-                if ex.caused_by.response.status_code == 500:
-                    log.debug(f"TembaHttpError 500, retrying...")
-
+                    log.debug(f"TembaHttpError {status_code}, retrying...")
+                    if self.metrics is not None:
+                        self.metrics.record_retry(status_code)
                 else:
                     raise ex
 
-    def export_all_data(self, export_dir_path):
+    @traced("export_all_data")
+    def export_all_data(self, export_dir_path, delta=False, layout="jsonl", compression="gzip",
+                        max_compression_workers=partitioned_export.PartitionedExportWriter.DEFAULT_MAX_WORKERS):
         """
         Exports all the data available from Rapid Pro's API, including archives, to the specified directory.
 
@@ -880,11 +1514,63 @@ class RapidProClient(object):
          - There's no underlying 'export all data' API provided by Rapid Pro, so this only exports data from endpoints
            which were known about last time this function was updated.
 
+        If `delta` is True and a previous export was made to `export_dir_path`, only the records of the endpoints
+        which support it (see `delta_export.INCREMENTAL_ENDPOINTS`) which are dated after the latest record in the
+        previous export are fetched, with archives only downloaded for the date-range needed. These are written with
+        full copies of the other endpoints as a new delta segment, which can later be merged into the full export
+        with `delta_export.compact`. Note that runs and contacts are fetched by modification date but messages,
+        broadcasts, and channel events only by creation date, so later changes to those aren't included in deltas.
+
+        If `layout` is 'partitioned', messages and runs are written as compressed partitions by month (and, for runs,
+        by flow), with a manifest of the partitions' row counts and time ranges, rather than as single JSONL files.
+        See `rapid_pro_tools.partitioned_export`. Messages and runs are then fetched with bounded memory, using
+        `iter_raw_messages` and `iter_raw_runs`. Delta exports are only supported with the 'jsonl' layout.
+
         :param export_dir_path: Directory to export the data to.
         :type export_dir_path: str
-        """
+        :param delta: Whether to export only the data which has changed since the previous export to this directory.
+        :type delta: bool
+        :param layout: Layout to export messages and runs in, either 'jsonl' or 'partitioned'.
+        :type layout: str
+        :param compression: Compression to use for the partitions when `layout` is 'partitioned', either 'gzip' or
+                            'zstd'.
+        :type compression: str
+        :param max_compression_workers: Maximum number of threads to compress partitions with, when `layout` is
+                                        'partitioned'.
+        :type max_compression_workers: int
+        """
+        assert layout in {"jsonl", "partitioned"}, f"Unsupported layout '{layout}', must be 'jsonl' or 'partitioned'"
+        partitions_manifest_path = os.path.join(export_dir_path, partitioned_export.PARTITIONS_MANIFEST_FILE_NAME)
+        assert not delta or (layout == "jsonl" and not os.path.exists(partitions_manifest_path)), \
+            "Delta exports are only supported with the 'jsonl' layout"
         IOUtils.ensure_dirs_exist(export_dir_path)
 
+        watermarks = delta_export.read_watermarks(export_dir_path) if delta else None
+        if delta and watermarks is None:
+            log.info(f"No previous export found at '{export_dir_path}', so exporting all the data")
+        if watermarks is None:
+            output_dir_path = export_dir_path
+            new_watermarks = dict()
+        else:
+            segment_dir_path = delta_export.new_segment_dir_path(export_dir_path)
+            output_dir_path = f"{segment_dir_path}.tmp"
+            IOUtils.ensure_dirs_exist(output_dir_path)
+            new_watermarks = dict(watermarks)
+            log.info(f"Exporting the data changed since the previous export to '{export_dir_path}', to the delta "
+                     f"segment '{segment_dir_path}'...")
+
+        def export_after(endpoint):
+            if watermarks is None or endpoint not in watermarks:
+                return None
+            return watermarks[endpoint] + datetime.timedelta(microseconds=1)
+
+        def update_watermark(endpoint, item):
+            if endpoint not in delta_export.INCREMENTAL_ENDPOINTS:
+                return
+            date = getattr(item, delta_export.INCREMENTAL_ENDPOINTS[endpoint]["date_key"])
+            if endpoint not in new_watermarks or date > new_watermarks[endpoint]:
+                new_watermarks[endpoint] = date
+
         # Export the straightforward cases
         endpoints = {
             "boundaries": self.rapid_pro.get_boundaries,
@@ -906,15 +1592,22 @@ class RapidProClient(object):
             "resthook_subscribers": self.rapid_pro.get_resthook_subscribers,
         }
         for endpoint, export_func in endpoints.items():
-            export_file_path = f"{export_dir_path}/{endpoint}.jsonl"
+            export_file_path = f"{output_dir_path}/{endpoint}.jsonl"
             log.info(f"Exporting {endpoint} to '{export_file_path}'...")
 
-            with open(export_file_path, "w") as f:
+            if endpoint in delta_export.INCREMENTAL_ENDPOINTS:
+                query = export_func(after=export_after(endpoint))
+            else:
+                query = export_func()
+            with self.tracer.span("export_all_data.export_endpoint", {"endpoint": endpoint}) as span, \
+                    open(export_file_path, "w") as f:
                 items_exported = 0
-                for batch in export_func().iterfetches(retry_on_rate_exceed=True):
+                for batch in query.iterfetches(retry_on_rate_exceed=True):
                     for item in batch:
                         items_exported += 1
                         f.write(json.dumps(item.serialize()) + "\n")
+                        update_watermark(endpoint, item)
+                span.set_attribute("records", items_exported)
                 log.info(f"Done. Exported {items_exported} {endpoint}")
 
         # Now handle the special cases...
@@ -922,40 +1615,104 @@ class RapidProClient(object):
         # Export endpoints which have archives, using the relevant RapidProClient 'get' functions because these handle
         # fetching from archives transparently.
         endpoints_with_archives = {
-            "messages": self.get_raw_messages,
-            "runs": self.get_raw_runs
+            "messages": lambda after: self.get_raw_messages(created_after_inclusive=after),
+            "runs": lambda after: self.get_raw_runs(last_modified_after_inclusive=after)
         }
-        for endpoint, export_func in endpoints_with_archives.items():
-            export_file_path = f"{export_dir_path}/{endpoint}.jsonl"
-            with open(export_file_path, "w") as f:
-                log.info(f"Exporting {endpoint}, including those in archives, to {export_file_path}...")
-                items_exported = 0
-                for item in export_func():
-                    f.write(json.dumps(item.serialize()) + "\n")
-                    items_exported += 1
-                log.info(f"Done. Exported {items_exported} {endpoint}")
+        if layout == "partitioned":
+            self._export_partitioned(output_dir_path, compression, max_compression_workers, update_watermark)
+        else:
+            for endpoint in endpoints_with_archives:
+                shutil.rmtree(f"{output_dir_path}/{endpoint}", ignore_errors=True)
+            if os.path.exists(partitions_manifest_path):
+                os.remove(partitions_manifest_path)
+
+            for endpoint, export_func in endpoints_with_archives.items():
+                export_file_path = f"{output_dir_path}/{endpoint}.jsonl"
+                with self.tracer.span("export_all_data.export_endpoint", {"endpoint": endpoint}) as span, \
+                        open(export_file_path, "w") as f:
+                    log.info(f"Exporting {endpoint}, including those in archives, to {export_file_path}...")
+                    items = export_func(export_after(endpoint))
+                    with self.tracer.span("export_all_data.write", {"endpoint": endpoint}):
+                        items_exported = 0
+                        for item in items:
+                            f.write(json.dumps(item.serialize()) + "\n")
+                            update_watermark(endpoint, item)
+                            items_exported += 1
+                    span.set_attribute("records", items_exported)
+                    log.info(f"Done. Exported {items_exported} {endpoint}")
 
         # Export the org data, which needs special treatment because it's not a list.
-        export_file_path = f"{export_dir_path}/org.json"
+        export_file_path = f"{output_dir_path}/org.json"
         log.info(f"Exporting org to '{export_file_path}'...")
-        org = self.rapid_pro.get_org(retry_on_rate_exceed=True)
-        with open(export_file_path, "w") as f:
-            f.write(json.dumps(org.serialize()))
+        with self.tracer.span("export_all_data.export_endpoint", {"endpoint": "org"}):
+            org = self.rapid_pro.get_org(retry_on_rate_exceed=True)
+            self._org.set(org)
+            with open(export_file_path, "w") as f:
+                f.write(json.dumps(org.serialize()))
         log.info(f"Done. Exported org")
 
         # Export the definitions data, which needs special treatment because this endpoint returns no data by default
         # (unlike all the other endpoints which return everything by default).
-        export_file_path = f"{export_dir_path}/definitions.json"
+        export_file_path = f"{output_dir_path}/definitions.json"
         log.info(f"Exporting definitions to '{export_file_path}'")
-        all_flow_ids = self.get_all_flow_ids()
-        definitions = self.get_flow_definitions_for_flow_ids(all_flow_ids)
-        with open(export_file_path, "w") as f:
-            f.write(json.dumps(definitions.serialize()))
+        with self.tracer.span("export_all_data.export_endpoint", {"endpoint": "definitions"}):
+            all_flow_ids = self.get_all_flow_ids()
+            definitions = self.get_flow_definitions_for_flow_ids(all_flow_ids)
+            with open(export_file_path, "w") as f:
+                f.write(json.dumps(definitions.serialize()))
         log.info(f"Done. Exported definitions for {len(definitions.flows)} flows, {len(definitions.campaigns)} "
                  f"campaigns, and {len(definitions.triggers)} triggers")
 
+        if watermarks is None:
+            # This full export supersedes any delta segments from before it.
+            delta_export.remove_segments(export_dir_path)
+        else:
+            os.rename(output_dir_path, segment_dir_path)
+            log.info(f"Wrote the delta segment '{segment_dir_path}'")
+        delta_export.write_watermarks(export_dir_path, new_watermarks)
+
+    def _export_partitioned(self, export_dir_path, compression, max_compression_workers, on_exported):
+        """
+        Exports all messages and runs, including those in archives, as compressed partitions.
+
+        :param export_dir_path: Directory to export to.
+        :type export_dir_path: str
+        :param compression: Compression to use for the partitions, either 'gzip' or 'zstd'.
+        :type compression: str
+        :param max_compression_workers: Maximum number of threads to compress partitions with.
+        :type max_compression_workers: int
+        :param on_exported: Function to call with each endpoint and record exported.
+        :type on_exported: function of (str, temba_client.serialization.TembaObject) -> None
+        """
+        endpoints = {
+            "messages": (self.iter_raw_messages, partitioned_export.message_partition,
+                         lambda message: message.created_on),
+            "runs": (self.iter_raw_runs, partitioned_export.run_partition, lambda run: run.modified_on)
+        }
+        partitions = dict()  # of endpoint -> manifest entries of its partitions
+        for endpoint, (export_func, partition_fn, date_key) in endpoints.items():
+            unpartitioned_file_path = f"{export_dir_path}/{endpoint}.jsonl"
+            if os.path.exists(unpartitioned_file_path):
+                os.remove(unpartitioned_file_path)
+
+            log.info(f"Exporting {endpoint}, including those in archives, to {compression} partitions in "
+                     f"'{export_dir_path}/{endpoint}'...")
+            with self.tracer.span("export_all_data.export_endpoint", {"endpoint": endpoint}) as span, \
+                    partitioned_export.PartitionedExportWriter(export_dir_path, endpoint, partition_fn, date_key,
+                                                               compression, max_compression_workers) as writer:
+                items_exported = 0
+                for item in export_func():
+                    writer.write(item)
+                    on_exported(endpoint, item)
+                    items_exported += 1
+                partitions[endpoint] = writer.close()
+                span.set_attribute("records", items_exported)
+            log.info(f"Done. Exported {items_exported} {endpoint} to {len(partitions[endpoint])} partitions")
+
+        partitioned_export.write_partitions_manifest(export_dir_path, partitions)
+
     @staticmethod
-    def convert_runs_to_traced_data(user, raw_runs, raw_contacts, phone_uuids, test_contacts=None):
+    def convert_runs_to_traced_data(user, raw_runs, raw_contacts, phone_uuids, test_contacts=None, process_count=1):
         """
         Converts raw data fetched from Rapid Pro to TracedData.
 
@@ -963,77 +1720,127 @@ class RapidProClient(object):
         :type user: str
         :param raw_runs: Raw run objects to convert to TracedData.
         :type raw_runs: list of temba_client.v2.types.Run
-        :param raw_contacts: Raw contact objects to use when converting to TracedData.
-        :type raw_contacts: list of temba_client.v2.types.Contact
+        :param raw_contacts: Raw contact objects to use when converting to TracedData, or a contact index to look the
+                             contacts up in.
+        :type raw_contacts: list of temba_client.v2.types.Contact | rapid_pro_tools.contact_index.ContactIndex
         :param phone_uuids: Phone number <-> UUID table.
         :type phone_uuids: id_infrastructure.firestore_uuid_table.FirestoreUuidTable
         :param test_contacts: Rapid Pro contact UUIDs of test contacts.
                               Runs from any of those test contacts will be tagged with {'test_run': True}
         :type test_contacts: list of str | None
+        :param process_count: Number of processes to convert the runs with. If greater than 1, the runs are converted
+                              by a pool of worker processes, using the phone number <-> UUID lookups made here in
+                              one batch request. The returned TracedData is in the same order either way.
+        :type process_count: int
         :return: Raw data fetched from Rapid Pro converted to TracedData.
         :rtype: list of TracedData
         """
-        if test_contacts is None:
-            test_contacts = []
+        # (Imported here because TracedData and the phone cleaners are slow to import, and are only needed here)
+        from core_data_modules.traced_data import Metadata
+        from rapid_pro_tools.run_converter import RunConverter
+
+        # Share one Metadata object between all the converted runs, rather than inspecting the call stack for every run.
+        metadata = Metadata(user, Metadata.get_call_location(), TimeUtils.utc_now_as_iso_string())
+        converter = RunConverter(metadata, test_contacts)
 
         log.info(f"Converting {len(raw_runs)} raw runs to TracedData...")
 
-        contacts_lut = {c.uuid: c for c in raw_contacts}
+        if isinstance(raw_contacts, ContactIndex):
+            contacts_lut = raw_contacts.contacts_lut
+        else:
+            contacts_lut = {c.uuid: c for c in raw_contacts}
+        convertible_runs = RunConverter.select_convertible_runs(raw_runs, contacts_lut)
 
-        runs_with_uuids = []
-        phone_numbers = []
-        for run in raw_runs:
-            if run.contact.uuid not in contacts_lut:
-                # Sometimes contact uuids which appear in `runs` do not appear in `contact_runs`.
-                # I have only observed this happen for contacts which were created very recently.
-                # This test skips the run in this case; it should be included next time this script is executed.
-                log.warning(f"Run found with Rapid Pro Contact UUID '{run.contact.uuid}', "
-                            f"but this id is not present in the downloaded contacts")
-                continue
+        phone_numbers = list(dict.fromkeys(phone_number for _, _, phone_number in convertible_runs))
+        phone_to_uuid_lut = phone_uuids.data_to_uuid_batch(phone_numbers)
 
-            contact_urns = contacts_lut[run.contact.uuid].urns
-            if len(contact_urns) == 0:
-                log.warning(f"Ignoring contact with no urn. URNs: {contact_urns} "
-                            f"(Rapid Pro Contact UUID: {run.contact.uuid})")
-                continue
+        if process_count > 1:
+            traced_runs = converter.convert_runs_in_parallel(convertible_runs, phone_to_uuid_lut, process_count)
+        else:
+            traced_runs = converter.convert_runs(convertible_runs, phone_to_uuid_lut)
 
-            phone_numbers.append(PhoneCleaner.normalise_phone(contact_urns[0]))
-            runs_with_uuids.append(run)
+        log.info(f"Converted {len(traced_runs)} raw runs to TracedData")
 
-        phone_to_uuid_lut = phone_uuids.data_to_uuid_batch(phone_numbers)
+        return traced_runs
 
-        traced_runs = []
-        for run in runs_with_uuids:
-            contact_urns = contacts_lut[run.contact.uuid].urns
-            run_dict = {
-                "avf_phone_id": phone_to_uuid_lut[PhoneCleaner.normalise_phone(contact_urns[0])],
-                "urn_type": contact_urns[0].split(":")[0],
-                f"run_id - {run.flow.name}": run.id
-            }
-
-            for category, response in run.values.items():
-                run_dict[category.title() + " (Category) - " + run.flow.name] = response.category
-                run_dict[category.title() + " (Value) - " + run.flow.name] = response.value
-                # Convert from "input" to "text" here to match terminology in Rapid Pro's Excel exports.
-                run_dict[category.title() + " (Text) - " + run.flow.name] = response.input
-                run_dict[category.title() + " (Name) - " + run.flow.name] = response.name
-                run_dict[category.title() + " (Time) - " + run.flow.name] = response.time.isoformat()
-                run_dict[category.title() + " (Run ID) - " + run.flow.name] = run.id
-
-            if run.contact.uuid in test_contacts:
-                run_dict["test_run"] = True
-            else:
-                assert len(contact_urns) == 1, \
-                    f"A non-test contact has multiple URNs (Rapid Pro Contact UUID: {run.contact.uuid})"
+    @staticmethod
+    def convert_runs_to_traced_data_chunks(user, raw_runs, contacts, phone_uuids, test_contacts=None,
+                                           chunk_size=DEFAULT_CONVERSION_CHUNK_SIZE,
+                                           phone_uuid_cache_size=DEFAULT_PHONE_UUID_CACHE_SIZE):
+        """
+        Converts raw runs fetched from Rapid Pro to TracedData, one chunk of runs at a time.
 
-            run_dict[f"run_created_on - {run.flow.name}"] = run.created_on.isoformat()
-            run_dict[f"run_modified_on - {run.flow.name}"] = run.modified_on.isoformat()
-            run_dict[f"run_exited_on - {run.flow.name}"] = None if run.exited_on is None else run.exited_on.isoformat()
-            run_dict[f"run_exit_type - {run.flow.name}"] = run.exit_type
+        This produces the same TracedData as `RapidProClient.convert_runs_to_traced_data`, but reads `raw_runs`
+        lazily and yields the converted runs as they are produced, so that peak memory depends on `chunk_size`
+        rather than on the total number of runs. The contacts who made each chunk's runs are looked up per chunk,
+        and the phone number -> UUID lookups for each chunk are made in one batch request, for the phone numbers
+        which aren't already in a bounded cache of recent lookups.
 
-            traced_runs.append(
-                TracedData(run_dict, Metadata(user, Metadata.get_call_location(), TimeUtils.utc_now_as_iso_string())))
+        :param user: Identifier of the user running this program, for TracedData Metadata.
+        :type user: str
+        :param raw_runs: Raw run objects to convert to TracedData.
+        :type raw_runs: iterable of temba_client.v2.types.Run
+        :param contacts: Contact index to look up the contacts who made the runs in, or a function which, given the
+                         Rapid Pro contact UUIDs of a chunk's runs, returns a dictionary of contact UUID -> contact for
+                         those contacts. Use a function to avoid holding all of the project's contacts in memory at
+                         once, e.g. by reading them from a database or a sorted file.
+        :type contacts: rapid_pro_tools.contact_index.ContactIndex |
+                        function of list of str -> (dict of str -> temba_client.v2.types.Contact)
+        :param phone_uuids: Phone number <-> UUID table.
+        :type phone_uuids: id_infrastructure.firestore_uuid_table.FirestoreUuidTable
+        :param test_contacts: Rapid Pro contact UUIDs of test contacts.
+                              Runs from any of those test contacts will be tagged with {'test_run': True}
+        :type test_contacts: list of str | None
+        :param chunk_size: Number of runs to read and convert at a time.
+        :type chunk_size: int
+        :param phone_uuid_cache_size: Maximum number of phone number -> UUID lookups to cache between chunks.
+        :type phone_uuid_cache_size: int
+        :return: Generator of lists of TracedData, one list per chunk of `raw_runs`. Runs which can't be converted
+                 are skipped, so a list may contain fewer than `chunk_size` items.
+        :rtype: generator of list of TracedData
+        """
+        from core_data_modules.traced_data import Metadata
+        from rapid_pro_tools.run_converter import RunConverter
+
+        metadata = Metadata(user, Metadata.get_call_location(), TimeUtils.utc_now_as_iso_string())
+        converter = RunConverter(metadata, test_contacts)
+        phone_uuid_cache = LRUCache(phone_uuid_cache_size)
+        lookup_contacts = contacts.contacts_by_uuid if isinstance(contacts, ContactIndex) else contacts
+
+        runs_converted = 0
+        raw_runs = iter(raw_runs)
+        while True:
+            chunk = list(itertools.islice(raw_runs, chunk_size))
+            if len(chunk) == 0:
+                break
 
-        log.info(f"Converted {len(traced_runs)} raw runs to TracedData")
+            contacts_lut = lookup_contacts(list(dict.fromkeys(run.contact.uuid for run in chunk)))
+            convertible_runs = RunConverter.select_convertible_runs(chunk, contacts_lut)
 
-        return traced_runs
+            phone_to_uuid_lut = dict()
+            uncached_phone_numbers = []
+            for _, _, phone_number in convertible_runs:
+                if phone_number in phone_to_uuid_lut:
+                    continue
+                cached_uuid = phone_uuid_cache.get(phone_number)
+                if cached_uuid is None:
+                    uncached_phone_numbers.append(phone_number)
+                    phone_to_uuid_lut[phone_number] = None
+                else:
+                    phone_to_uuid_lut[phone_number] = cached_uuid
+
+            if len(uncached_phone_numbers) > 0:
+                resolved_uuids = phone_uuids.data_to_uuid_batch(uncached_phone_numbers)
+                # (Don't log the unresolved phone numbers themselves, because they identify people)
+                unresolved_count = sum(1 for phone_number in uncached_phone_numbers
+                                       if resolved_uuids.get(phone_number) is None)
+                assert unresolved_count == 0, f"{unresolved_count} phone numbers were not resolved to UUIDs"
+                for phone_number in uncached_phone_numbers:
+                    phone_to_uuid_lut[phone_number] = resolved_uuids[phone_number]
+                    phone_uuid_cache.put(phone_number, resolved_uuids[phone_number])
+
+            traced_runs = converter.convert_runs(convertible_runs, phone_to_uuid_lut)
+            runs_converted += len(traced_runs)
+            log.info(f"Converted {runs_converted} raw runs to TracedData so far")
+
+            yield traced_runs
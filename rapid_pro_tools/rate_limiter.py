@@ -0,0 +1,31 @@
+import threading
+import time
+
+
+class RateLimiter(object):
+    def __init__(self, max_per_second):
+        """
+        Limits the rate at which an action is performed, across all the threads which share this limiter, by spacing
+        the actions evenly.
+
+        :param max_per_second: Maximum number of actions to allow per second.
+        :type max_per_second: float
+        """
+        assert max_per_second > 0, "max_per_second must be positive"
+        self.max_per_second = max_per_second
+
+        self._interval = 1.0 / max_per_second
+        self._lock = threading.Lock()
+        self._next_time = 0.0
+
+    def acquire(self):
+        """
+        Blocks until the next action may be performed.
+        """
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next_time - now
+            self._next_time = max(now, self._next_time) + self._interval
+
+        if wait > 0:
+            time.sleep(wait)
@@ -0,0 +1,179 @@
+import gzip
+import json
+import queue
+import threading
+
+from core_data_modules.logging import Logger
+
+log = Logger(__name__)
+
+_GZIP_MAGIC_NUMBER = b"\x1f\x8b"
+_END_OF_LOG = object()
+
+
+class RawExportLogWriter(object):
+    DEFAULT_MAX_QUEUED_BATCHES = 16
+
+    def __init__(self, f, max_queued_batches=DEFAULT_MAX_QUEUED_BATCHES, close_file=False):
+        """
+        Writes a raw export log incrementally, on a background thread, so that records can be logged while data is
+        still being fetched.
+
+        Batches of records passed to `write` are queued, then serialized and written by the background thread as
+        JSONL, one serialized record per line. The queue is bounded, so `write` blocks if the writer falls behind
+        rather than holding an unbounded amount of data in memory.
+
+        Pass an instance as the `raw_export_log_file` argument of RapidProClient's `get_raw_*` and
+        `update_raw_*_with_latest_modified` methods to keep logging in the background across calls. Call `close`
+        (or use as a context manager) when finished, to wait for all queued records to be written.
+        Read logs back with `iter_raw_export_log`.
+
+        :param f: Text file to write to.
+        :type f: file-like
+        :param max_queued_batches: Maximum number of batches to queue before `write` blocks.
+        :type max_queued_batches: int
+        :param close_file: Whether to close `f` when this writer is closed.
+        :type close_file: bool
+        """
+        self.f = f
+        self.close_file = close_file
+        self.records_written = 0
+
+        self._queue = queue.Queue(maxsize=max_queued_batches)
+        self._error = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._write_queued_batches, name="RawExportLogWriter", daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def open(cls, file_path, compress=None, max_queued_batches=DEFAULT_MAX_QUEUED_BATCHES):
+        """
+        Opens a raw export log file for writing, appending to it if it already exists.
+
+        :param file_path: Path of the log file.
+        :type file_path: str
+        :param compress: Whether to gzip the log. If None, the log is gzipped if `file_path` ends in '.gz'.
+        :type compress: bool | None
+        :param max_queued_batches: Maximum number of batches to queue before `write` blocks.
+        :type max_queued_batches: int
+        :rtype: RawExportLogWriter
+        """
+        if compress is None:
+            compress = file_path.endswith(".gz")
+
+        if compress:
+            f = gzip.open(file_path, "at")
+        else:
+            f = open(file_path, "a")
+
+        return cls(f, max_queued_batches, close_file=True)
+
+    def _write_queued_batches(self):
+        while True:
+            batch = self._queue.get()
+            if batch is _END_OF_LOG:
+                return
+
+            # After a failure, keep consuming batches so that `write` never blocks forever, but stop writing them.
+            if self._error is not None:
+                continue
+
+            try:
+                for record in batch:
+                    self.f.write(json.dumps(record.serialize()) + "\n")
+                self.records_written += len(batch)
+            except Exception as ex:
+                self._error = ex
+
+    def _raise_if_failed(self):
+        if self._error is not None:
+            raise self._error
+
+    def write(self, records):
+        """
+        Queues records to be written to the log.
+
+        :param records: Records to log.
+        :type records: list of temba_client.serialization.TembaObject
+        """
+        assert not self._closed, "Cannot write to a closed RawExportLogWriter"
+        self._raise_if_failed()
+        if len(records) > 0:
+            self._queue.put(list(records))
+
+    def close(self):
+        """
+        Waits for all queued records to be written, then flushes the log, and closes the file if this writer opened it.
+        Raises the error that stopped the background thread, if any.
+        """
+        if self._closed:
+            return
+        self._closed = True
+
+        self._queue.put(_END_OF_LOG)
+        self._thread.join()
+        try:
+            self._raise_if_failed()
+            self.f.flush()
+        finally:
+            if self.close_file:
+                self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+class _NoOpRawExportLogWriter(object):
+    def write(self, records):
+        pass
+
+    def close(self):
+        pass
+
+
+def raw_export_log_writer_for(raw_export_log_file):
+    """
+    Returns a writer for the `raw_export_log_file` argument of a RapidProClient method, and whether the caller should
+    close it when finished.
+
+    :param raw_export_log_file: A RawExportLogWriter, which is used as is, a text file, which is wrapped in a new
+                                RawExportLogWriter, or None, in which case nothing is logged.
+    :type raw_export_log_file: RawExportLogWriter | file-like | None
+    :return: Tuple of (writer, whether the caller owns the writer and should close it).
+    :rtype: (RawExportLogWriter, bool)
+    """
+    if raw_export_log_file is None:
+        return _NoOpRawExportLogWriter(), False
+    if isinstance(raw_export_log_file, RawExportLogWriter):
+        return raw_export_log_file, False
+    return RawExportLogWriter(raw_export_log_file), True
+
+
+def iter_raw_export_log(file_path):
+    """
+    Iterates over the serialized records in a raw export log.
+
+    Reads both the current format, JSONL with one record per line, and the earlier format, in which each line is a
+    JSON list of all the records fetched by one call. Gzipped logs are detected and decompressed automatically.
+
+    :param file_path: Path of the log file.
+    :type file_path: str
+    :return: Iterator of the serialized records, in the order they were logged.
+    :rtype: iterator of dict
+    """
+    with open(file_path, "rb") as f:
+        is_gzipped = f.read(len(_GZIP_MAGIC_NUMBER)) == _GZIP_MAGIC_NUMBER
+
+    with (gzip.open(file_path, "rt") if is_gzipped else open(file_path)) as f:
+        for line in f:
+            if line.strip() == "":
+                continue
+            logged = json.loads(line)
+            if isinstance(logged, list):
+                yield from logged
+            else:
+                yield logged
@@ -0,0 +1,212 @@
+import math
+from concurrent.futures import ProcessPoolExecutor
+
+from core_data_modules.cleaners import PhoneCleaner
+from core_data_modules.logging import Logger
+from core_data_modules.traced_data import TracedData
+
+log = Logger(__name__)
+
+
+def _convert_run_partition(metadata, test_contacts, partition):
+    """
+    Converts a partition of runs to TracedData. Module-level so that it can be run in a worker process.
+
+    :param metadata: Metadata to attach to every converted run.
+    :type metadata: core_data_modules.traced_data.Metadata
+    :param test_contacts: Rapid Pro contact UUIDs of test contacts.
+    :type test_contacts: set of str
+    :param partition: List of (run, contact URNs, de-identified phone id) to convert.
+    :type partition: list of (temba_client.v2.types.Run, list of str, str)
+    :return: The runs, converted to TracedData, in partition order.
+    :rtype: list of TracedData
+    """
+    converter = RunConverter(metadata, test_contacts)
+    return [converter.convert_run(run, contact_urns, avf_phone_id) for run, contact_urns, avf_phone_id in partition]
+
+
+class RunConverter(object):
+    def __init__(self, metadata, test_contacts=None):
+        """
+        Converts raw runs to TracedData, caching the TracedData keys generated for each flow and flow result so that
+        they are only built once per conversion rather than once per run.
+
+        :param metadata: Metadata to attach to every TracedData object produced by this converter.
+        :type metadata: core_data_modules.traced_data.Metadata
+        :param test_contacts: Rapid Pro contact UUIDs of test contacts.
+                              Runs from any of those test contacts will be tagged with {'test_run': True}
+        :type test_contacts: iterable of str | None
+        """
+        self.metadata = metadata
+        self.test_contacts = set() if test_contacts is None else set(test_contacts)
+
+        self._flow_keys = dict()  # of flow name -> dict of run property -> TracedData key
+        self._result_keys = dict()  # of (flow name, result key) -> tuple of TracedData keys
+
+    def _get_flow_keys(self, flow_name):
+        flow_keys = self._flow_keys.get(flow_name)
+        if flow_keys is None:
+            flow_keys = {
+                "run_id": f"run_id - {flow_name}",
+                "created_on": f"run_created_on - {flow_name}",
+                "modified_on": f"run_modified_on - {flow_name}",
+                "exited_on": f"run_exited_on - {flow_name}",
+                "exit_type": f"run_exit_type - {flow_name}"
+            }
+            self._flow_keys[flow_name] = flow_keys
+        return flow_keys
+
+    def _get_result_keys(self, flow_name, category):
+        result_keys = self._result_keys.get((flow_name, category))
+        if result_keys is None:
+            title = category.title()
+            result_keys = (
+                title + " (Category) - " + flow_name,
+                title + " (Value) - " + flow_name,
+                # Convert from "input" to "text" here to match terminology in Rapid Pro's Excel exports.
+                title + " (Text) - " + flow_name,
+                title + " (Name) - " + flow_name,
+                title + " (Time) - " + flow_name,
+                title + " (Run ID) - " + flow_name
+            )
+            self._result_keys[(flow_name, category)] = result_keys
+        return result_keys
+
+    @staticmethod
+    def select_convertible_runs(raw_runs, contacts_lut):
+        """
+        Selects the runs which can be converted to TracedData, i.e. those whose contact is known and has a URN, and
+        normalises the phone number of each selected run's contact.
+
+        :param raw_runs: Raw run objects to select from.
+        :type raw_runs: iterable of temba_client.v2.types.Run
+        :param contacts_lut: Dictionary of Rapid Pro contact UUID -> contact.
+        :type contacts_lut: dict of str -> temba_client.v2.types.Contact
+        :return: List of (run, contact URNs, normalised phone number) for each convertible run, in input order.
+        :rtype: list of (temba_client.v2.types.Run, list of str, str)
+        """
+        convertible_runs = []
+        for run in raw_runs:
+            contact = contacts_lut.get(run.contact.uuid)
+            if contact is None:
+                # Sometimes contact uuids which appear in `runs` do not appear in `contact_runs`.
+                # I have only observed this happen for contacts which were created very recently.
+                # This test skips the run in this case; it should be included next time this script is executed.
+                log.warning(f"Run found with Rapid Pro Contact UUID '{run.contact.uuid}', "
+                            f"but this id is not present in the downloaded contacts")
+                continue
+
+            contact_urns = contact.urns
+            if len(contact_urns) == 0:
+                log.warning(f"Ignoring contact with no urn. URNs: {contact_urns} "
+                            f"(Rapid Pro Contact UUID: {run.contact.uuid})")
+                continue
+
+            convertible_runs.append((run, contact_urns, PhoneCleaner.normalise_phone(contact_urns[0])))
+        return convertible_runs
+
+    def convert_run(self, run, contact_urns, avf_phone_id):
+        """
+        Converts a raw run to TracedData.
+
+        :param run: Run to convert.
+        :type run: temba_client.v2.types.Run
+        :param contact_urns: URNs of the contact who made this run.
+        :type contact_urns: list of str
+        :param avf_phone_id: De-identified id of the contact's first URN.
+        :type avf_phone_id: str
+        :return: The run, converted to TracedData.
+        :rtype: TracedData
+        """
+        flow_name = run.flow.name
+        flow_keys = self._get_flow_keys(flow_name)
+
+        run_dict = {
+            "avf_phone_id": avf_phone_id,
+            "urn_type": contact_urns[0].split(":")[0],
+            flow_keys["run_id"]: run.id
+        }
+
+        for category, response in run.values.items():
+            category_key, value_key, text_key, name_key, time_key, run_id_key = \
+                self._get_result_keys(flow_name, category)
+            run_dict[category_key] = response.category
+            run_dict[value_key] = response.value
+            run_dict[text_key] = response.input
+            run_dict[name_key] = response.name
+            run_dict[time_key] = response.time.isoformat()
+            run_dict[run_id_key] = run.id
+
+        if run.contact.uuid in self.test_contacts:
+            run_dict["test_run"] = True
+        else:
+            assert len(contact_urns) == 1, \
+                f"A non-test contact has multiple URNs (Rapid Pro Contact UUID: {run.contact.uuid})"
+
+        run_dict[flow_keys["created_on"]] = run.created_on.isoformat()
+        run_dict[flow_keys["modified_on"]] = run.modified_on.isoformat()
+        run_dict[flow_keys["exited_on"]] = None if run.exited_on is None else run.exited_on.isoformat()
+        run_dict[flow_keys["exit_type"]] = run.exit_type
+
+        return TracedData(run_dict, self.metadata)
+
+    def convert_runs(self, convertible_runs, phone_to_uuid_lut):
+        """
+        Converts runs selected by `RunConverter.select_convertible_runs` to TracedData.
+
+        :param convertible_runs: List of (run, contact URNs, normalised phone number) to convert.
+        :type convertible_runs: iterable of (temba_client.v2.types.Run, list of str, str)
+        :param phone_to_uuid_lut: Dictionary of normalised phone number -> de-identified id, containing at least
+                                  every normalised phone number in `convertible_runs`.
+        :type phone_to_uuid_lut: dict of str -> str
+        :return: The runs, converted to TracedData, in input order.
+        :rtype: list of TracedData
+        """
+        return [
+            self.convert_run(run, contact_urns, phone_to_uuid_lut[phone_number])
+            for run, contact_urns, phone_number in convertible_runs
+        ]
+
+    def convert_runs_in_parallel(self, convertible_runs, phone_to_uuid_lut, process_count,
+                                 partitions_per_process=4):
+        """
+        Converts runs selected by `RunConverter.select_convertible_runs` to TracedData, using a pool of worker
+        processes.
+
+        The runs are split into contiguous partitions. Each worker is sent only the runs, contact URNs and
+        de-identified phone ids for the partitions it converts, and the converted partitions are reassembled in
+        input order.
+
+        :param convertible_runs: List of (run, contact URNs, normalised phone number) to convert.
+        :type convertible_runs: list of (temba_client.v2.types.Run, list of str, str)
+        :param phone_to_uuid_lut: Dictionary of normalised phone number -> de-identified id, containing at least
+                                  every normalised phone number in `convertible_runs`.
+        :type phone_to_uuid_lut: dict of str -> str
+        :param process_count: Number of worker processes to convert with.
+        :type process_count: int
+        :param partitions_per_process: Number of partitions to split the runs into for each worker process.
+                                       Using several partitions per process balances the load between processes
+                                       when some runs take longer to convert than others.
+        :type partitions_per_process: int
+        :return: The runs, converted to TracedData, in input order.
+        :rtype: list of TracedData
+        """
+        if len(convertible_runs) == 0:
+            return []
+
+        partition_size = math.ceil(len(convertible_runs) / (process_count * partitions_per_process))
+        partitions = []
+        for i in range(0, len(convertible_runs), partition_size):
+            partitions.append([
+                (run, contact_urns, phone_to_uuid_lut[phone_number])
+                for run, contact_urns, phone_number in convertible_runs[i:i + partition_size]
+            ])
+        log.info(f"Converting {len(convertible_runs)} runs in {len(partitions)} partitions using "
+                 f"{process_count} processes...")
+
+        traced_runs = []
+        with ProcessPoolExecutor(max_workers=process_count) as executor:
+            for converted_partition in executor.map(_convert_run_partition, [self.metadata] * len(partitions),
+                                                    [self.test_contacts] * len(partitions), partitions):
+                traced_runs.extend(converted_partition)
+        return traced_runs
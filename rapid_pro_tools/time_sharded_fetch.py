@@ -0,0 +1,143 @@
+import datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from core_data_modules.logging import Logger
+
+log = Logger(__name__)
+
+
+class TimeShardedFetcher(object):
+    # Lower bound of the range to shard when fetching from the beginning of time. Records older than this are still
+    # fetched, by the first shard, which is left open-ended.
+    DEFAULT_EARLIEST_DATE = datetime.datetime(2015, 1, 1, tzinfo=datetime.timezone.utc)
+    DEFAULT_MIN_SHARD_DURATION = datetime.timedelta(minutes=1)
+
+    def __init__(self, query_fn, date_key, id_key, max_concurrent_requests,
+                 earliest_date=DEFAULT_EARLIEST_DATE, min_shard_duration=DEFAULT_MIN_SHARD_DURATION):
+        """
+        Fetches a date range from a cursor-paginated Rapid Pro endpoint as several concurrently fetched time shards,
+        rather than one page after another.
+
+        Shards are split adaptively. Rapid Pro returns records in descending order of the date it filters them by, so
+        the first page of a shard holds all of the shard's records newer than the oldest record in that page. If the
+        shard holds more than one page, the rest of it, up to and including the oldest date in the first page, is
+        split in two and both halves are fetched concurrently. Sparse periods therefore cost one request each, while
+        busy periods are divided until each part fits in a page. Once the rest of a shard is shorter than
+        `min_shard_duration`, it is paginated as normal instead.
+
+        :param query_fn: Function which returns a temba_client CursorQuery for the records in a date range.
+                         `after` and `before` are inclusive, and either may be None for an open-ended range.
+        :type query_fn: function of (after: datetime.datetime | None, before: datetime.datetime | None) ->
+                        temba_client.clients.CursorQuery
+        :param date_key: Function which returns the date the endpoint filters each record by.
+        :type date_key: function of temba_client.serialization.TembaObject -> datetime.datetime
+        :param id_key: Function which returns a unique id for each record. Records fetched by more than one shard
+                       are de-duplicated by this id, keeping the most recently modified version.
+        :type id_key: function of temba_client.serialization.TembaObject -> hashable
+        :param max_concurrent_requests: Maximum number of shards to fetch at once.
+        :type max_concurrent_requests: int
+        :param earliest_date: Start of the range to divide into shards when fetching from the beginning of time.
+        :type earliest_date: datetime.datetime
+        :param min_shard_duration: Duration below which shards are paginated rather than split further.
+        :type min_shard_duration: datetime.timedelta
+        """
+        self.query_fn = query_fn
+        self.date_key = date_key
+        self.id_key = id_key
+        self.max_concurrent_requests = max_concurrent_requests
+        self.earliest_date = earliest_date
+        self.min_shard_duration = min_shard_duration
+
+    @staticmethod
+    def _split(start, end, shard_count):
+        """
+        Splits the inclusive range [start, end] into `shard_count` contiguous, non-overlapping inclusive ranges.
+        """
+        shard_duration = (end - start) / shard_count
+        shards = []
+        shard_start = start
+        for i in range(shard_count):
+            shard_end = end if i == shard_count - 1 else start + shard_duration * (i + 1)
+            shards.append((shard_start, shard_end))
+            shard_start = shard_end + datetime.timedelta(microseconds=1)
+        return shards
+
+    def _fetch_shard(self, shard):
+        """
+        Fetches the first page of a shard, and either the rest of the shard or, if the rest is long enough to be
+        split, the two halves of the rest to fetch instead.
+
+        :return: Tuple of (records fetched, list of shards still to fetch).
+        :rtype: (list of temba_client.serialization.TembaObject, list of ((datetime, bool), (datetime, bool)))
+        """
+        (start, open_start), (end, open_end) = shard
+        fetches = self.query_fn(after=None if open_start else start, before=None if open_end else end)\
+            .iterfetches(retry_on_rate_exceed=True)
+
+        records = next(fetches, [])
+        if fetches.get_cursor() is None:
+            return records, []
+
+        # There is more than one page of records in this shard. Everything newer than the oldest record in the first
+        # page has been fetched, so only the rest of the shard remains. The rest includes the oldest date itself, in
+        # case other records share it; any records fetched twice as a result are de-duplicated later.
+        rest_end = min(self.date_key(record) for record in records)
+        if rest_end - start > self.min_shard_duration:
+            first_half, second_half = self._split(start, rest_end, 2)
+            return records, [
+                ((first_half[0], open_start), (first_half[1], False)),
+                ((second_half[0], False), (second_half[1], False))
+            ]
+
+        for fetch in fetches:
+            records.extend(fetch)
+        return records, []
+
+    def fetch(self, after_inclusive, before_inclusive, shard_count):
+        """
+        Fetches all the records in a date range.
+
+        :param after_inclusive: Start of the date range, or None to fetch from the beginning of time.
+        :type after_inclusive: datetime.datetime | None
+        :param before_inclusive: End of the date range, or None to fetch until now.
+        :type before_inclusive: datetime.datetime | None
+        :param shard_count: Number of shards to initially divide the date range into.
+        :type shard_count: int
+        :return: The records in the date range, de-duplicated, in descending order of `date_key`, matching the order
+                 Rapid Pro's API returns records in.
+        :rtype: list of temba_client.serialization.TembaObject
+        """
+        start = self.earliest_date if after_inclusive is None else after_inclusive
+        end = datetime.datetime.now(datetime.timezone.utc) if before_inclusive is None else before_inclusive
+        start = min(start, end)
+
+        # Shards are pairs of ((start, is open-ended), (end, is open-ended)). The outermost shards are left
+        # open-ended if the requested range is, so that records outside [earliest_date, now] are still fetched.
+        shards = self._split(start, end, shard_count)
+        pending_shards = [
+            ((shard_start, i == 0 and after_inclusive is None),
+             (shard_end, i == len(shards) - 1 and before_inclusive is None))
+            for i, (shard_start, shard_end) in enumerate(shards)
+        ]
+
+        latest_records = dict()  # of id -> most recently modified version of the record with that id
+        requested_shards = 0
+        with ThreadPoolExecutor(max_workers=self.max_concurrent_requests) as executor:
+            running = set()
+            while len(pending_shards) > 0 or len(running) > 0:
+                running.update(executor.submit(self._fetch_shard, shard) for shard in pending_shards)
+                requested_shards += len(pending_shards)
+                pending_shards = []
+
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    records, new_shards = future.result()
+                    pending_shards.extend(new_shards)
+                    for record in records:
+                        record_id = self.id_key(record)
+                        prev_record = latest_records.get(record_id)
+                        if prev_record is None or record.modified_on > prev_record.modified_on:
+                            latest_records[record_id] = record
+
+        log.info(f"Fetched {len(latest_records)} records in {requested_shards} time shards")
+        return sorted(latest_records.values(), key=self.date_key, reverse=True)
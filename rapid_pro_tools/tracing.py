@@ -0,0 +1,278 @@
+import functools
+import json
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+
+
+def _max_rss_bytes():
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, but in kilobytes on Linux.
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class Span(object):
+    def __init__(self, tracer, name, attributes=None):
+        """
+        A timed phase of work, created by `Tracer.span`. Use as a context manager.
+        """
+        self.tracer = tracer
+        self.name = name
+        self.attributes = dict() if attributes is None else dict(attributes)
+
+        self.trace_id = None
+        self.span_id = None
+        self.parent_span_id = None
+        self.start_time_ns = None
+        self.end_time_ns = None
+        self.error = None
+        self._start_perf_counter = None
+        self._start_max_rss_bytes = None
+        self._start_traced_bytes = None
+        self._peak_traced_bytes = None
+
+    def set_attribute(self, key, value):
+        """
+        Sets an attribute of this span, e.g. the number of records processed during it.
+
+        :param key: Attribute name.
+        :type key: str
+        :param value: Attribute value.
+        :type value: str | int | float | bool
+        """
+        self.attributes[key] = value
+
+    def __enter__(self):
+        parent = self.tracer._current_span()
+        self.trace_id = os.urandom(16).hex() if parent is None else parent.trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_span_id = None if parent is None else parent.span_id
+        self.tracer._push_span(self)
+
+        if self.tracer.trace_memory:
+            self.tracer._start_tracking_memory(self)
+        self._start_max_rss_bytes = _max_rss_bytes()
+        self.start_time_ns = int(time.time() * 1e9)
+        self._start_perf_counter = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration_seconds = time.perf_counter() - self._start_perf_counter
+        self.end_time_ns = self.start_time_ns + int(duration_seconds * 1e9)
+
+        max_rss_bytes = _max_rss_bytes()
+        self.attributes["duration_seconds"] = duration_seconds
+        self.attributes["memory.process_max_rss_bytes"] = max_rss_bytes
+        self.attributes["memory.process_max_rss_growth_bytes"] = max_rss_bytes - self._start_max_rss_bytes
+        if self.tracer.trace_memory:
+            self.tracer._stop_tracking_memory(self)
+            self.attributes["memory.peak_traced_bytes"] = self._peak_traced_bytes
+            self.attributes["memory.peak_traced_increase_bytes"] = self._peak_traced_bytes - self._start_traced_bytes
+        if exc_type is not None:
+            self.error = f"{exc_type.__name__}: {exc_value}"
+
+        self.tracer._pop_span(self)
+        return False
+
+    def to_otlp(self):
+        """
+        :return: This span in OpenTelemetry's OTLP/JSON span format.
+        :rtype: dict
+        """
+        otlp_span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,  # SPAN_KIND_INTERNAL
+            "startTimeUnixNano": str(self.start_time_ns),
+            "endTimeUnixNano": str(self.end_time_ns),
+            "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in self.attributes.items()],
+            "status": {"code": 1} if self.error is None else {"code": 2, "message": self.error}
+        }
+        if self.parent_span_id is not None:
+            otlp_span["parentSpanId"] = self.parent_span_id
+        return otlp_span
+
+
+def traced(name):
+    """
+    Decorates a method of an object with a `tracer` attribute so that each call to the method is recorded as a span.
+
+    :param name: Name of the span.
+    :type name: str
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.tracer.span(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class _NoOpSpan(object):
+    def set_attribute(self, key, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+class NoOpTracer(object):
+    """
+    Tracer which records nothing. Used by RapidProClient when tracing is disabled.
+    """
+    _span = _NoOpSpan()
+
+    def span(self, name, attributes=None):
+        return self._span
+
+
+class Tracer(object):
+    def __init__(self, service_name="rapid_pro_tools", trace_memory=False):
+        """
+        Records tracing spans of the phases of work done by RapidProClient (listing and downloading archives,
+        fetching from production, de-duplicating, sorting, writing logs, etc.), with their timings and memory use,
+        so that slow exports can be diagnosed after the fact.
+
+        Every span records the process' resident memory high-water mark when it ended
+        (`memory.process_max_rss_bytes`), and how much that high-water mark grew during the span
+        (`memory.process_max_rss_growth_bytes`). The growth is 0 for any phase which stays below the peak of an
+        earlier phase, so it is not the phase's own peak.
+
+        To measure each phase's own peak, enable `trace_memory`. Each span then also records the peak memory
+        allocated by Python while it was open (`memory.peak_traced_bytes`), and how far that peak rose above the
+        memory allocated when the span started (`memory.peak_traced_increase_bytes`). These are measured with
+        tracemalloc, which slows allocation-heavy code down considerably, and count allocations made by every thread,
+        so are only the phase's own when no other work runs at the same time. Memory allocated outside of Python's
+        allocators, e.g. by zlib, is not counted.
+
+        Spans started while another span is active on the same thread are recorded as its children.
+        Finished spans are written with `write_otlp_json` in OpenTelemetry's OTLP/JSON format, which can be read by
+        e.g. the OpenTelemetry Collector's otlpjsonfile receiver and forwarded to any tracing backend.
+
+        :param service_name: Name of the service to attribute the spans to.
+        :type service_name: str
+        :param trace_memory: Whether to measure each span's peak memory with tracemalloc. Starts tracemalloc if it
+                             isn't already tracing. Requires Python 3.9 or later.
+        :type trace_memory: bool
+        """
+        self.service_name = service_name
+        self.trace_memory = trace_memory
+
+        self._lock = threading.Lock()
+        self._finished_spans = []
+        self._thread_local = threading.local()
+        self._memory_tracked_spans = []  # of the open spans whose peak memory is being tracked, on any thread
+
+        if trace_memory:
+            assert hasattr(tracemalloc, "reset_peak"), "trace_memory requires Python 3.9 or later"
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+
+    def span(self, name, attributes=None):
+        """
+        Creates a span which times the work done within its context. Use `Span.set_attribute` within the context to
+        record details of the work done, such as the number of records processed.
+
+        :param name: Name of the phase this span times.
+        :type name: str
+        :param attributes: Initial attributes of the span.
+        :type attributes: dict of str -> (str | int | float | bool) | None
+        :rtype: Span
+        """
+        return Span(self, name, attributes)
+
+    def _span_stack(self):
+        stack = getattr(self._thread_local, "stack", None)
+        if stack is None:
+            stack = []
+            self._thread_local.stack = stack
+        return stack
+
+    def _current_span(self):
+        stack = self._span_stack()
+        return stack[-1] if len(stack) > 0 else None
+
+    def _push_span(self, span):
+        self._span_stack().append(span)
+
+    def _pop_span(self, span):
+        stack = self._span_stack()
+        assert stack[-1] is span, "Spans must be ended in the reverse order they were started"
+        stack.pop()
+        with self._lock:
+            self._finished_spans.append(span)
+
+    def _sample_memory_peak(self):
+        # tracemalloc has a single process-wide peak, so fold the peak since the last sample into every open span
+        # before resetting it, so that resets made for one span don't lose the peaks of others.
+        # (Must be called with self._lock held)
+        _, peak_traced_bytes = tracemalloc.get_traced_memory()
+        for span in self._memory_tracked_spans:
+            span._peak_traced_bytes = max(span._peak_traced_bytes, peak_traced_bytes)
+        tracemalloc.reset_peak()
+
+    def _start_tracking_memory(self, span):
+        with self._lock:
+            self._sample_memory_peak()
+            span._start_traced_bytes, _ = tracemalloc.get_traced_memory()
+            span._peak_traced_bytes = span._start_traced_bytes
+            self._memory_tracked_spans.append(span)
+
+    def _stop_tracking_memory(self, span):
+        with self._lock:
+            self._sample_memory_peak()
+            self._memory_tracked_spans.remove(span)
+
+    def finished_spans(self):
+        """
+        :return: The spans which have finished so far, in the order they finished.
+        :rtype: list of Span
+        """
+        with self._lock:
+            return list(self._finished_spans)
+
+    def to_otlp_json(self):
+        """
+        :return: The finished spans as an OTLP/JSON ExportTraceServiceRequest.
+        :rtype: dict
+        """
+        return {
+            "resourceSpans": [{
+                "resource": {
+                    "attributes": [{"key": "service.name", "value": {"stringValue": self.service_name}}]
+                },
+                "scopeSpans": [{
+                    "scope": {"name": "rapid_pro_tools"},
+                    "spans": [span.to_otlp() for span in self.finished_spans()]
+                }]
+            }]
+        }
+
+    def write_otlp_json(self, file_path):
+        """
+        Writes the spans finished so far to a file as one line of OTLP/JSON, in the format read by the OpenTelemetry
+        Collector's otlpjsonfile receiver. Overwrites the file if it already exists.
+
+        :param file_path: Path to write to.
+        :type file_path: str
+        """
+        with open(file_path, "w") as f:
+            f.write(json.dumps(self.to_otlp_json()) + "\n")
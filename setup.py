@@ -5,6 +5,7 @@ setup(
     version="0.3.10",
     url="https://github.com/AfricasVoices/RapidProTools",
     packages=["rapid_pro_tools"],
-    install_requires=["rapidpro-python", "python-dateutil",
-                      "coredatamodules @ git+https://github.com/AfricasVoices/CoreDataModules"]
+    install_requires=["rapidpro-python", "python-dateutil", "requests",
+                      "coredatamodules @ git+https://github.com/AfricasVoices/CoreDataModules"],
+    extras_require={"async": ["aiohttp"], "zstd": ["zstandard"]}
 )